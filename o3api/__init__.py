@@ -1,5 +1,7 @@
-from flask import render_template
+from flask import jsonify, render_template
 import connexion
+import o3api.warmup as o3warmup
+import o3api.watcher as o3watcher
 
 from os import getenv
 import logging
@@ -43,8 +45,41 @@ def home():
 
     return render_template('index.html')
 
+# Probes for k8s: liveness and readiness (warm-up progress)
+@app.route('/healthz')
+def healthz():
+    """Liveness probe, the process is up and serving
+
+    :return: status ok
+    """
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness probe: 503 while the warm-up is running
+
+    :return: warm-up progress
+    """
+    status = 200 if o3warmup.is_ready() else 503
+    return jsonify(o3warmup.get_state()), status
+
+# Background services of the server, started from the serving path only:
+# importing o3api (offline tools o3api-batch, o3api-pyramid,
+# o3api-loadtest, tests) does not start any thread
+def create_app():
+    """Start the warm-up and the periodic scan for changed data files,
+    return the application. Used by gunicorn as 'o3api:create_app()',
+    with --preload the warm-up is done before workers fork and the scan
+    is restarted in every worker
+
+    :return: the application instance
+    """
+    o3warmup.start()
+    o3watcher.watcher.start()
+    return app
+
 # from app import routes
 
 if __name__ == "__main__":
-    app.run(host=o3api_listen_ip,
-            port=o3api_port)
+    create_app().run(host=o3api_listen_ip,
+                     port=o3api_port)
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Cost-based admission control for /api/plot.
+# The cost of a request is estimated before execution as the number of
+# data points to process (models x time points x latitude points
+# x pressure levels),
+# using only the coordinates stored in the netCDF files (see o3api.catalog).
+# PDF requests are weighted with admission_conf['pdf_factor'].
+# Every identity has a budget (token bucket), and the total cost of
+# requests in flight is limited. The state is kept per worker process.
+
+import logging
+import numpy as np
+import o3api.catalog as o3catalog
+import o3api.config as cfg
+import threading
+import time
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+# configuration for API
+BEGIN = cfg.api_conf['begin']
+END = cfg.api_conf['end']
+MONTH = cfg.api_conf['month']
+LAT_MIN = cfg.api_conf['lat_min']
+LAT_MAX = cfg.api_conf['lat_max']
+LEVEL_MIN = cfg.api_conf['level_min']
+LEVEL_MAX = cfg.api_conf['level_max']
+BANDS = cfg.api_conf['bands']
+
+# configuration for netCDF
+TCO3 = cfg.netCDF_conf['tco3']
+TCO3Return = cfg.netCDF_conf['tco3_r']
+
+# configuration for admission control
+adm_c = cfg.admission_conf
+
+
+class AdmissionError(Exception):
+    """Base exception for rejected requests
+
+    :param message: Error message
+    :param retry_after: Seconds after which the request may be retried
+    """
+    status = 503
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = int(np.ceil(retry_after))
+
+
+class QuotaExceeded(AdmissionError):
+    """The identity has exhausted its budget (HTTP 429)
+    """
+    status = 429
+
+
+class Overloaded(AdmissionError):
+    """The service has too much work in flight (HTTP 503)
+    """
+    status = 503
+
+
+def estimate_model_cost(plot_type, model_name, **kwargs):
+    """Estimate the number of data points to process for one model
+
+    :param plot_type: The plot type (e.g. tco3_zm, vmro3_zm, ...)
+    :param model_name: The model to process
+    :param kwargs: The provided in the API call parameters
+    :return: number of (time x latitude x level) points in the requested window
+    :rtype: int
+    """
+    lat_min = min(kwargs[LAT_MIN], kwargs[LAT_MAX])
+    lat_max = max(kwargs[LAT_MIN], kwargs[LAT_MAX])
+    if plot_type == TCO3Return:
+        # derived from tco3_zm, bands may cover all latitudes
+        plot_type = TCO3
+        if any(kwargs.get(BANDS) or []):
+            lat_min, lat_max = -90, 90
+    cost = 0
+    for path in o3catalog.catalog.get_datafiles(model_name, plot_type):
+        coords = o3catalog.read_file_coords(path)
+        t_sel = (coords.years >= kwargs[BEGIN]) & (coords.years <= kwargs[END])
+        if len(kwargs[MONTH]) > 0:
+            t_sel &= np.isin(coords.months, kwargs[MONTH])
+        n_lat = np.count_nonzero((coords.lats >= lat_min) &
+                                 (coords.lats <= lat_max))
+        n_lev = 1
+        if coords.levels is not None:
+            lev_sel = np.ones(coords.levels.shape, dtype=bool)
+            if kwargs.get(LEVEL_MIN) is not None:
+                lev_sel &= coords.levels >= kwargs[LEVEL_MIN]
+            if kwargs.get(LEVEL_MAX) is not None:
+                lev_sel &= coords.levels <= kwargs[LEVEL_MAX]
+            n_lev = max(int(np.count_nonzero(lev_sel)), 1)
+        cost += int(np.count_nonzero(t_sel))*max(int(n_lat), 1)*n_lev
+    return cost
+
+
+def estimate_field_cost(plot_type, model_name):
+    """Estimate the number of data points of the whole field of the model,
+    e.g. read to build its tile pyramid (see o3api.pyramid)
+
+    :param plot_type: The plot type (e.g. tco3_zm, vmro3_zm, ...)
+    :param model_name: The model
+    :return: number of (time x latitude x level) points in the files
+    :rtype: int
+    """
+    cost = 0
+    for path in o3catalog.catalog.get_datafiles(model_name, plot_type):
+        coords = o3catalog.read_file_coords(path)
+        n_lev = 1 if coords.levels is None else max(coords.levels.size, 1)
+        cost += coords.years.size*max(coords.lats.size, 1)*n_lev
+    return cost
+
+
+def estimate_cost(plot_type, model_names, pdf=False, **kwargs):
+    """Estimate the cost of the request
+
+    :param plot_type: The plot type (e.g. tco3_zm, vmro3_zm, ...)
+    :param model_names: The models to process
+    :param pdf: Whether a PDF plot is requested
+    :param kwargs: The provided in the API call parameters
+    :return: estimated cost (weighted number of data points)
+    :rtype: float
+    """
+    cost = sum(estimate_model_cost(plot_type, m, **kwargs)
+               for m in model_names)
+    if pdf:
+        cost *= adm_c['pdf_factor']
+    return float(cost)
+
+
+class AdmissionController:
+    """Enforce per-identity budgets and the global in-flight cost limit
+
+    Every identity owns a token bucket of `identity_budget` cost units
+    refilled with `identity_refill` units per second. A full bucket is the
+    same as none, so full buckets are dropped once per refill period
+    (identities include remote addresses of unauthenticated calls).
+
+    :param identity_budget: Budget (bucket capacity) per identity
+    :param identity_refill: Refill rate of the budget per second, > 0
+    :param max_inflight_cost: Limit for the total cost of running requests
+    :param retry_after_busy: Retry-After (s) returned if overloaded
+    """
+    def __init__(self, identity_budget, identity_refill, max_inflight_cost,
+                 retry_after_busy=5):
+        if not identity_refill > 0: # an exhausted budget would never refill
+            raise ValueError("identity_refill must be > 0, got {}".format(
+                             identity_refill))
+        self.identity_budget = identity_budget
+        self.identity_refill = identity_refill
+        self.max_inflight_cost = max_inflight_cost
+        self.retry_after_busy = retry_after_busy
+        self._buckets = {} # identity -> (tokens, last update)
+        self._pruned = time.time()
+        self._inflight = 0.
+        self._lock = threading.Lock()
+
+    def _refill(self, identity, now):
+        """Return the budget currently available for the identity
+        """
+        tokens, last = self._buckets.get(identity,
+                                         (self.identity_budget, now))
+        return min(self.identity_budget,
+                   tokens + (now - last)*self.identity_refill)
+
+    def _prune(self, now):
+        """Drop the buckets refilled to the whole budget
+        """
+        self._buckets = { identity: bucket
+                          for identity, bucket in self._buckets.items()
+                          if self._refill(identity, now) <
+                             self.identity_budget }
+        self._pruned = now
+
+    def admit(self, identity, cost):
+        """Admit the request or raise an :class:`AdmissionError`
+
+        A request larger than the whole budget or the in-flight limit
+        is admitted once the budget is full or nothing else is running,
+        so that it is delayed, but never rejected forever.
+
+        :param identity: Who sends the request
+        :param cost: Estimated cost of the request
+        :return: cost to pass to :meth:`release`
+        """
+        now = time.time()
+        with self._lock:
+            if now - self._pruned >= self.identity_budget/self.identity_refill:
+                self._prune(now)
+            tokens = self._refill(identity, now)
+            needed = min(cost, self.identity_budget)
+            if tokens < needed:
+                raise QuotaExceeded(
+                    "Budget of {} is exhausted: request cost {:.0f}, "
+                    "available {:.0f}".format(identity, cost, tokens),
+                    (needed - tokens)/self.identity_refill)
+            if (self._inflight > 0 and
+                self._inflight + cost > self.max_inflight_cost):
+                raise Overloaded(
+                    "Service is busy: {:.0f} in flight, request cost {:.0f}"
+                    .format(self._inflight, cost), self.retry_after_busy)
+            self._buckets[identity] = (tokens - cost, now)
+            self._inflight += cost
+        logger.debug("[ADMISSION] {} admitted with cost {:.0f}, in flight: "
+                     "{:.0f}".format(identity, cost, self._inflight))
+        return cost
+
+    def release(self, cost):
+        """Mark the admitted request as finished
+
+        :param cost: Value returned by :meth:`admit`
+        """
+        with self._lock:
+            self._inflight = max(0., self._inflight - cost)
+
+    def stats(self):
+        """Return current state of the controller
+
+        :rtype: dict
+        """
+        with self._lock:
+            return { 'inflight_cost': self._inflight,
+                     'identities': len(self._buckets) }
+
+
+controller = AdmissionController(adm_c['identity_budget'],
+                                 adm_c['identity_refill'],
+                                 adm_c['max_inflight_cost'],
+                                 adm_c['retry_after_busy'])
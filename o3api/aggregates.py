@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Materialized means of standard latitude bands (tropics, mid-latitudes,
+# polar caps, ...). For every model and plot type the mean over each band
+# is stored for every time point, so a request for a standard band is
+# served by selecting its period and months from the stored series instead
+# of reading the netCDF files. Month sets (annual, DJF, ..., October) need
+# no extra storage: they select time points of the same series.
+# The band means are computed at the first request of the model (one read
+# of the whole field) and stored per data fingerprint, changed data gets
+# new band means, those of the old data are removed.
+
+import collections
+import hashlib
+import logging
+import numpy as np
+import o3api.config as cfg
+import o3api.latgrid as o3latgrid
+import o3api.pyramid as o3pyramid
+import os
+import threading
+import time
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+
+def band_means(values, lats, bands):
+    """Means over every latitude band skipping NaNs, one matrix product
+    for all bands with the weights of the grid, see :mod:`o3api.latgrid`
+
+    :param values: (lat, time) array
+    :param lats: Latitudes of the values
+    :param bands: Bands as (lat_min, lat_max)
+    :return: (time, band) array, NaN where a band has no data
+    """
+    weights = o3latgrid.get_grid(lats).band_matrix(bands)
+    valid = ~np.isnan(values)
+    sums = weights @ np.where(valid, values, 0.).astype(np.float64)
+    counts = weights @ valid
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums/counts).T
+
+
+class AggregateStore:
+    """Stored means of standard latitude bands per model
+
+    :param directory: Directory of the stored band means
+    :param bands: Standard bands as (lat_min, lat_max)
+    :param max_loaded: Models kept in memory in this process
+    """
+    def __init__(self, directory, bands, max_loaded=256):
+        self.directory = directory
+        self.bands = [ (float(a), float(b)) for a, b in bands ]
+        self.max_loaded = max_loaded
+        self._lock = threading.Lock()
+        self._build_locks = {} # path -> lock
+        self._loaded = collections.OrderedDict() # path -> (values, time)
+        self._checked = False
+        self.hits = 0
+        self.builds = 0
+        self.build_s = 0.
+        self.errors = 0
+        self.disabled = None # reason, if the directory is not writable
+
+    def _disable(self, error):
+        """Stop using the store in this process: the band means can not
+        be written, every request would read the whole field for nothing
+        """
+        with self._lock:
+            if self.disabled is None:
+                self.disabled = str(error)
+                logger.error("[AGGREGATES] {} is not writable, store "
+                             "disabled: {}".format(self.directory, error))
+
+    def _check_directory(self):
+        """Whether the directory of the store can be written,
+        checked once per process
+
+        :rtype: bool
+        """
+        with self._lock:
+            if self._checked:
+                return self.disabled is None
+            self._checked = True
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if not os.access(self.directory, os.W_OK | os.X_OK):
+                raise PermissionError("no write access")
+        except OSError as e:
+            self._disable(e)
+        return self.disabled is None
+
+    def _path(self, entry, dtype):
+        """File of the band means of the catalog entry
+        """
+        key = repr((entry.fingerprint, self.bands, np.dtype(dtype).name,
+                    o3latgrid.grids.weighting))
+        return os.path.join(self.directory, entry.plot_type, entry.model,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest() +
+                            ".npz")
+
+    def _build(self, entry, path, dtype):
+        """Compute and store the band means of the model
+        """
+        time_start = time.time()
+        model_dir = os.path.dirname(path)
+        try: # before reading the field
+            os.makedirs(model_dir, exist_ok=True)
+        except OSError as e:
+            self._disable(e)
+            raise
+        values, lats, time_axis = o3pyramid.TilePyramid.read_field(entry)
+        means = band_means(values, lats, self.bands).T.astype(dtype)
+        tmp_path = path + ".{}.{}.tmp".format(os.getpid(),
+                                              threading.get_ident())
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, values=means,
+                         time=time_axis.astype('datetime64[ns]'))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self._disable(e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        # band means of older data of the model
+        for other in os.listdir(model_dir):
+            if other != os.path.basename(path) and not other.endswith(".tmp"):
+                try:
+                    os.remove(os.path.join(model_dir, other))
+                except OSError:
+                    pass
+        elapsed = time.time() - time_start
+        with self._lock:
+            self.builds += 1
+            self.build_s += elapsed
+        logger.info("[AGGREGATES] built {} {} in {:.2f}s".format(
+                    entry.model, entry.plot_type, elapsed))
+
+    def _load(self, entry, dtype):
+        """Band means and time axis of the model, built if needed
+        """
+        path = self._path(entry, dtype)
+        with self._lock:
+            loaded = self._loaded.get(path)
+            if loaded is not None:
+                self._loaded.move_to_end(path)
+                return loaded
+            build_lock = self._build_locks.setdefault(path, threading.Lock())
+        with build_lock:
+            if not os.path.isfile(path):
+                self._build(entry, path, dtype)
+            with np.load(path) as stored:
+                loaded = (stored['values'], stored['time'])
+        with self._lock:
+            self._loaded[path] = loaded
+            while len(self._loaded) > self.max_loaded:
+                self._loaded.popitem(last=False)
+        return loaded
+
+    def discard(self, entry):
+        """Drop the band means of the model other than those of the
+        catalog entry (older data), they are built at next request
+
+        :param entry: Current catalog entry (o3api.catalog.ModelEntry)
+        :return: number of dropped files
+        """
+        keep = [ self._path(entry, dtype) for dtype in ['float32', 'float64'] ]
+        model_dir = os.path.dirname(keep[0])
+        with self._lock:
+            for other in [ p for p in self._loaded
+                           if os.path.dirname(p) == model_dir and
+                           p not in keep ]:
+                del self._loaded[other]
+        removed = 0
+        if os.path.isdir(model_dir):
+            for other in os.listdir(model_dir):
+                path = os.path.join(model_dir, other)
+                if path not in keep and not other.endswith(".tmp"):
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except OSError:
+                        pass
+        return removed
+
+    def get_band(self, entry, lat_min, lat_max, dtype):
+        """Stored mean of the band for every time point, if it is a
+        standard band
+
+        :param entry: Catalog entry of the model (o3api.catalog.ModelEntry)
+        :param lat_min: Minimum latitude of the request
+        :param lat_max: Maximum latitude of the request
+        :param dtype: Floating point type of the values
+        :return: means, time axis; None if the band is not stored
+        """
+        band = (float(lat_min), float(lat_max))
+        if band not in self.bands or not entry.files:
+            return None
+        if not self._check_directory():
+            return None
+        try:
+            values, time_axis = self._load(entry, dtype)
+        except (OSError, ValueError) as e:
+            logger.warning("[AGGREGATES] {} {} not available: {}".format(
+                           entry.model, entry.plot_type, e))
+            with self._lock:
+                self.errors += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return values[self.bands.index(band)], time_axis
+
+    def stats(self):
+        """Return counters of this process
+
+        :rtype: dict
+        """
+        with self._lock:
+            return { 'bands': [ list(band) for band in self.bands ],
+                     'loaded': len(self._loaded),
+                     'hits': self.hits,
+                     'builds': self.builds,
+                     'build_s': round(self.build_s, 4),
+                     'errors': self.errors,
+                     'disabled': self.disabled }
+
+
+store = AggregateStore(cfg.aggregates_conf['path'],
+                       cfg.aggregates_conf['bands'],
+                       cfg.aggregates_conf['max_loaded'])
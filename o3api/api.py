@@ -25,30 +25,41 @@
 #       e.g. raise OSError("no files to open")
 
 
+import o3api.admission as o3admission
+import o3api.aggregates as o3aggregates
+import o3api.catalog as o3catalog
+import o3api.compute as o3compute
 import o3api.config as cfg
+import o3api.decompose as o3decompose
+import o3api.export as o3export
+import o3api.fileaccess as o3fileaccess
+import o3api.filecache as o3filecache
+import o3api.latgrid as o3latgrid
 import o3api.plothelpers as phlp
 import o3api.plots as o3plots
+import o3api.pyramid as o3pyramid
+import o3api.resultstore as o3resultstore
+import o3api.scheduler as o3scheduler
+import o3api.shmcache as o3shmcache
+import o3api.smoothing as o3smoothing
+import o3api.watcher as o3watcher
 import json
 import logging
-import matplotlib.style as mplstyle
-mplstyle.use('fast') # faster?
-import matplotlib.pyplot as plt
+import logging.handlers
 import numpy as np
 
 import os
-import pkg_resources
-import pandas as pd
 import time
 
-import cProfile
 import io
-import pstats
+import threading
+import yaml
 
 from flask import send_file
-from flask import jsonify, make_response, request
-from fpdf import FPDF
+from flask import Response, g, has_request_context, jsonify, make_response, request
 from functools import wraps
 from io import BytesIO
+from werkzeug.exceptions import HTTPException
 
 # conigure python logger
 logger = logging.getLogger('__name__') #o3api
@@ -57,6 +68,7 @@ logger.setLevel(cfg.log_level)
 
 ## Authorization
 from flaat import Flaat
+from flaat import tokentools
 flaat = Flaat()
 
 # list of trusted OIDC providers
@@ -70,16 +82,48 @@ END = cfg.api_conf['end']
 MONTH = cfg.api_conf['month']
 LAT_MIN = cfg.api_conf['lat_min']
 LAT_MAX = cfg.api_conf['lat_max']
+LEVEL_MIN = cfg.api_conf['level_min']
+LEVEL_MAX = cfg.api_conf['level_max']
+LEVEL_TIME = cfg.api_conf['level_time']
+BANDS = cfg.api_conf['bands']
+TRES = cfg.api_conf['tres']
+LRES = cfg.api_conf['lres']
+TX = cfg.api_conf['tx']
+TY = cfg.api_conf['ty']
+FORMAT = cfg.api_conf['format']
+SMOOTH = cfg.api_conf['smooth']
+COMPONENT = cfg.api_conf['component']
+
+# configuration for netCDF
+TCO3 = cfg.netCDF_conf['tco3']
+VMRO3 = cfg.netCDF_conf['vmro3']
+TCO3Return = cfg.netCDF_conf['tco3_r']
 
 # configuration for plotting
 plot_c = cfg.plot_conf
 
+# pyplot is not thread safe, serialize drawing in threaded workers
+pyplot_lock = threading.Lock()
+
+# package metadata, read at first use
+package_metadata = None
+
+# defaults of the /plot parameters from swagger.yml, read at first use
+plot_defaults = None
+
+# logger to record requests, handler is configured at first use
+request_logger = logging.getLogger('o3api.requests')
+request_logger.propagate = False
+request_log_handler = None
+
 
 def _profile(func):
     """Decorate function for profiling
     """
     @wraps(func)
     def wrapper(*args, **kwargs):
+        import cProfile
+        import pstats
         pr = cProfile.Profile()
         pr.enable()
         retval = func(*args, **kwargs)
@@ -103,6 +147,7 @@ def _catch_error(f):
         try:
             return f(*args, **kwargs)
         except Exception as e:
+            status = getattr(e, 'status', 500)
             e_message = []
             e_message.append({ 'status': 'Error',
                                'object': str(type(e)),
@@ -112,6 +157,7 @@ def _catch_error(f):
             #raise BadRequest(e)
 
             if request.headers['Accept'] == "application/pdf":
+                from fpdf import FPDF
                 pdf = FPDF()
                 pdf.add_page()
                 pdf.set_font("Arial", size = 14)
@@ -126,15 +172,144 @@ def _catch_error(f):
                 response = make_response(send_file(buffer_resp,
                                          as_attachment=True,
                                          attachment_filename='Error.pdf',
-                                         mimetype='application/pdf'), 500)
+                                         mimetype='application/pdf'), status)
             else:
-                response = make_response(jsonify(e_message), 500)
+                response = make_response(jsonify(e_message), status)
+
+            if hasattr(e, 'retry_after'):
+                response.headers['Retry-After'] = str(e.retry_after)
               
             logger.debug("Response: {}".format(dict(response.headers)))
             return response
 
     return wrap
 
+class AdminRequired(PermissionError):
+    """The call is restricted to the groups of admin_conf
+    (HTTP 403, or 401 without valid token)
+    """
+    def __init__(self, message, status=403):
+        super().__init__(message)
+        self.status = status
+
+def _admin_required(func):
+    """Decorate function to restrict it to the members of any of
+    admin_conf['groups'] (claim admin_conf['claim'] of the OIDC token),
+    to nobody if no group is configured
+    """
+    @wraps(func)
+    def wrap(*args, **kwargs):
+        if not cfg.admin_conf['groups']:
+            raise AdminRequired("{} is disabled, no O3API_ADMIN_GROUPS"
+                                .format(func.__name__))
+        try:
+            flaat.group_required(group=cfg.admin_conf['groups'],
+                                 claim=cfg.admin_conf['claim'],
+                                 match='one')(lambda: None)()
+        except HTTPException as e:
+            raise AdminRequired(e.description, status=e.code)
+        return func(*args, **kwargs)
+
+    return wrap
+
+def _fixed_cost(cost_key):
+    """Decorate function to set the cost of the request (admission
+    control, scheduling) from admin_conf instead of estimating it
+
+    :param cost_key: Key of the cost in admin_conf
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrap(*args, **kwargs):
+            if has_request_context():
+                g.o3api_cost = cfg.admin_conf[cost_key]
+            return func(*args, **kwargs)
+
+        return wrap
+
+    return decorator
+
+def _get_identity():
+    """Identify who sends the request: issuer and subject from
+    the OIDC access token or, without a token, the remote address
+
+    :return: identity
+    :rtype: string
+    """
+    token = tokentools.get_access_token_from_request(request)
+    info = flaat.get_info_thats_in_at(token) if token else None
+    if info and 'body' in info and 'sub' in info['body']:
+        return "{}@{}".format(info['body']['sub'], info['body'].get('iss', ''))
+    return request.remote_addr or 'anonymous'
+
+def _get_request_cost(**kwargs):
+    """Estimate the cost of the request (once per request),
+    metadata calls and tiles of built pyramids have zero cost
+
+    :param kwargs: The provided in the API call parameters
+    :return: estimated cost, see :mod:`o3api.admission`
+    :rtype: float
+    """
+    if 'o3api_cost' not in g:
+        if BEGIN in kwargs:
+            pdf = request.headers.get('Accept') == "application/pdf"
+            g.o3api_cost = o3admission.estimate_cost(
+                               kwargs[PTYPE], phlp.clean_models(**kwargs),
+                               pdf=pdf, **kwargs)
+        elif isinstance(kwargs.get('body'), list):
+            # batch: sum of the valid items, see plot_batch
+            g.o3api_cost = 0.
+            for item in kwargs['body'][:cfg.batch_conf['max_items']]:
+                try:
+                    params = _batch_params(item)
+                    g.o3api_cost += o3admission.estimate_cost(
+                        params[PTYPE], phlp.clean_models(**params), **params)
+                except Exception:
+                    continue # reported as the error of the item
+        elif TRES in kwargs:
+            # tile: the whole field is read if the pyramid is not built
+            model = kwargs[MODEL].strip().strip('\"')
+            g.o3api_cost = 0.
+            if not o3pyramid.pyramid.is_built(model, kwargs[PTYPE]):
+                g.o3api_cost = float(o3admission.estimate_field_cost(
+                                         kwargs[PTYPE], model))
+        else:
+            g.o3api_cost = 0.
+    return g.o3api_cost
+
+def _admission_control(func):
+    """Decorate function to estimate the cost of the request and admit
+    or reject it according to the budgets, see :mod:`o3api.admission`
+    """
+    @wraps(func)
+    def wrap(*args, **kwargs):
+        if not cfg.admission_conf['enabled'] or not has_request_context():
+            return func(*args, **kwargs)
+
+        cost = _get_request_cost(**kwargs)
+        ticket = o3admission.controller.admit(_get_identity(), cost)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            o3admission.controller.release(ticket)
+
+    return wrap
+
+def _schedule(func):
+    """Decorate function to wait for a slot on the lane corresponding
+    to the cost of the request, see :mod:`o3api.scheduler`
+    """
+    @wraps(func)
+    def wrap(*args, **kwargs):
+        if not cfg.scheduler_conf['enabled'] or not has_request_context():
+            return func(*args, **kwargs)
+
+        with o3scheduler.scheduler.run(_get_request_cost(**kwargs),
+                                       _get_identity()):
+            return func(*args, **kwargs)
+
+    return wrap
+
 def _timeit(func):
     """Measure time of the function
     """
@@ -148,6 +323,202 @@ def _timeit(func):
         return f
     return wrap
 
+def _get_request_logger():
+    """Configure (once) and return the logger to record requests
+
+    :return: logger writing to the rotating request log
+    """
+    global request_log_handler
+    if (request_log_handler is None or
+        request_log_handler.baseFilename != 
+        os.path.abspath(cfg.O3API_REQUEST_LOG)):
+        if request_log_handler is not None:
+            request_logger.removeHandler(request_log_handler)
+            request_log_handler.close()
+        request_log_handler = logging.handlers.RotatingFileHandler(
+                      cfg.O3API_REQUEST_LOG,
+                      maxBytes=cfg.request_log_conf['max_bytes'],
+                      backupCount=cfg.request_log_conf['backup_count'])
+        request_log_handler.setFormatter(logging.Formatter('%(message)s'))
+        request_logger.addHandler(request_log_handler)
+        request_logger.setLevel(logging.INFO)
+    return request_logger
+
+def _normalize_request(**kwargs):
+    """Normalize API call parameters for the request log
+
+    :param kwargs: The provided in the API call parameters
+    :return: all API parameters (cfg.api_conf) of the call, with cleaned
+             models and sorted months
+    :rtype: dict
+    """
+    params = {}
+    for key in cfg.api_conf.values():
+        if key in kwargs and key not in [MODEL, MONTH]:
+            params[key] = kwargs[key]
+    if MODEL in kwargs:
+        if type(kwargs[MODEL]) is list:
+            params[MODEL] = phlp.clean_models(**kwargs)
+        else:
+            params[MODEL] = [ kwargs[MODEL].strip().strip('\"') ]
+    if MONTH in kwargs:
+        params[MONTH] = sorted(kwargs[MONTH])
+    if 'body' in kwargs: # plot_batch, parameter sets as sent
+        params['body'] = kwargs['body']
+    return params
+
+def _record_request(func):
+    """Decorate function to record the request parameters and timing
+    in the request log, if $O3API_REQUEST_LOG is set
+    """
+    @wraps(func)
+    def wrap(*args, **kwargs):
+        if not cfg.O3API_REQUEST_LOG:
+            return func(*args, **kwargs)
+
+        time_start = time.time()
+        response = func(*args, **kwargs)
+        duration = time.time() - time_start
+        record = {
+            'ts': round(time_start, 3),
+            'endpoint': func.__name__,
+            'accept': request.headers.get('Accept', ''),
+            'params': _normalize_request(**kwargs),
+            'status': getattr(response, 'status_code', 200),
+            'duration': round(duration, 4)
+        }
+        try:
+            _get_request_logger().info(json.dumps(record))
+        except (OSError, TypeError) as e:
+            logger.warning("Failed to record the request: {}".format(e))
+        return response
+
+    return wrap
+
+def _to_json_values(values):
+    """Convert values to a list for JSON, rounded according to
+    precision_conf (float32 values are not extended to float64 digits)
+
+    :param values: numpy array
+    :return: values, NaN as None
+    :rtype: list
+    """
+    decimals = cfg.precision_conf['decimals']
+    if decimals is None and values.dtype == np.float32:
+        decimals = 4
+    if decimals is not None:
+        values = np.round(values.astype(np.float64), decimals)
+    missing = np.isnan(values)
+    if missing.any(): # e.g. no ozone return in the period
+        return np.where(missing, None, values.astype(object)).tolist()
+    return values.tolist()
+
+def _json_series(data, model):
+    """Series of the model as JSON
+
+    :param data: Processing object of the request (o3api.plots)
+    :param model: model to process
+    :return: JSON with points (x,y)
+    """
+    return _json_curve(model, data.get_raw_data(model))
+
+def _json_curve(model, curve):
+    """Curve of the model as JSON
+
+    :param model: The model
+    :param curve: pandas series indexed by time
+    :return: JSON with points (x,y)
+    """
+    return { MODEL: model,
+             "x": curve.index.tolist(),
+             "y": _to_json_values(curve.values) }
+
+def _json_level_time(data, model):
+    """(level x time) field of the model as JSON
+
+    :param data: Processing object of the request (o3api.plots)
+    :param model: model to process
+    :return: JSON with time (x), levels (hPa) and values[level][time]
+    """
+    field = data.get_level_time(model)
+    return { MODEL: model,
+             "x": field.index.tolist(),
+             "levels": field.columns.tolist(),
+             "z": _to_json_values(field.values.T) }
+
+def _get_plot_defaults():
+    """Defaults of the optional parameters of /plot in swagger.yml,
+    used for the requests of a batch
+
+    :rtype: dict
+    """
+    global plot_defaults
+    if plot_defaults is None:
+        with open(os.path.join(os.path.dirname(__file__),
+                               'swagger.yml')) as f:
+            spec = yaml.safe_load(f)
+        plot_defaults = { p['name']: p['default']
+                          for p in spec['paths']['/plot']['post']['parameters']
+                          if 'default' in p and not p.get('required') }
+    return plot_defaults
+
+def _parse_bool(key, value):
+    """Boolean parameter given as JSON boolean or as in the query
+
+    :param key: Name of the parameter
+    :param value: true/false, "true"/"false" (any case) or None
+    :rtype: bool
+    """
+    if value is None or isinstance(value, bool):
+        return bool(value)
+    if isinstance(value, str) and value.lower() in ['true', 'false']:
+        return value.lower() == 'true'
+    raise o3plots.InvalidRequest("Invalid {}: {}, expected true or false"
+                                 .format(key, value))
+
+def _batch_params(item):
+    """Check the parameters of one request of a batch,
+    set the defaults and convert them as for /api/plot
+
+    :param item: Parameters of the request (dict)
+    :return: parameters for :func:`o3api.plots.set_data_processing`
+    :rtype: dict
+    """
+    if not isinstance(item, dict):
+        raise o3plots.InvalidRequest("Parameters must be an object, got {}"
+                                     .format(item))
+    params = dict(_get_plot_defaults(), **item)
+    for key in [PTYPE, MODEL]:
+        if key not in params:
+            raise o3plots.InvalidRequest("{} is required".format(key))
+    if params[PTYPE] not in [TCO3, VMRO3, TCO3Return]:
+        raise o3plots.InvalidRequest("Unknown {}: {}".format(PTYPE,
+                                                             params[PTYPE]))
+    # arrays may be given as in the query, comma separated
+    for key in [MODEL, MONTH, BANDS]:
+        if isinstance(params.get(key), str):
+            params[key] = params[key].split(',')
+    try:
+        for key in [BEGIN, END]:
+            params[key] = int(params[key])
+        params[MONTH] = [ int(m) for m in params[MONTH] if m != '' ]
+        for key in [LAT_MIN, LAT_MAX, LEVEL_MIN, LEVEL_MAX]:
+            if params.get(key) is not None:
+                params[key] = float(params[key])
+    except (TypeError, ValueError) as e:
+        raise o3plots.InvalidRequest("Invalid parameter: {}".format(e))
+    params[LEVEL_TIME] = _parse_bool(LEVEL_TIME, params.get(LEVEL_TIME))
+    if params[LEVEL_TIME] and params[PTYPE] != VMRO3:
+        raise o3plots.InvalidRequest(
+                  "{} is only available for {}".format(LEVEL_TIME, VMRO3))
+    if params.get(SMOOTH) is not None:
+        if params[PTYPE] == TCO3Return or params[LEVEL_TIME]:
+            raise o3plots.InvalidRequest(
+                      "{} is only available for series of {} and {}".format(
+                      SMOOTH, TCO3, VMRO3))
+        o3smoothing.parse(params[SMOOTH])
+    return params
+
 @_catch_error
 def get_metadata(*args, **kwargs):
     """Return information about the package
@@ -155,6 +526,11 @@ def get_metadata(*args, **kwargs):
     :return: The o3api package info
     :rtype: dict
     """
+    global package_metadata
+    if package_metadata is not None:
+        return dict(package_metadata)
+
+    import pkg_resources
     module = __name__.split('.', 1)
     pkg = pkg_resources.get_distribution(module[0])
     meta = {
@@ -178,8 +554,56 @@ def get_metadata(*args, **kwargs):
         iline += 1
     
     logger.debug(F"Found metadata: {meta}")    
-    return meta
+    package_metadata = meta
+    return dict(meta)
+
+@_catch_error
+def get_stats(*args, **kwargs):
+    """Return statistics of the service internals
+
+    :return: admission control, scheduler and cache statistics
+    :rtype: dict
+    """
+    stats = {
+        'admission': o3admission.controller.stats(),
+        'aggregates': (o3aggregates.store.stats()
+                       if cfg.aggregates_conf['enabled'] else {}),
+        'scheduler': o3scheduler.scheduler.stats(),
+        'catalog': o3catalog.catalog.stats(),
+        'compute': o3compute.backend.stats(),
+        'file_access': o3fileaccess.file_manager.stats(),
+        'file_cache': (o3filecache.file_cache.stats()
+                       if cfg.file_cache_conf['enabled'] else {}),
+        'lat_grid': o3latgrid.grids.stats(),
+        'pyramid': o3pyramid.pyramid.stats(),
+        'result_store': (o3resultstore.result_store.stats()
+                         if cfg.result_store_conf['enabled'] else {}),
+        'series_cache': o3plots.series_cache.stats(),
+        'shm_cache': (o3shmcache.shm_cache.stats()
+                      if cfg.shm_cache_conf['enabled'] else {}),
+        'watcher': o3watcher.watcher.stats()
+    }
+    logger.debug(F"Stats: {stats}")
+    return stats
+
+@flaat.login_required() # Require only authorized people to call api method
+@_catch_error
+@_admin_required
+@_fixed_cost('rescan_cost')
+@_admission_control
+@_schedule
+def rescan(*args, **kwargs):
+    """Scan the data files now and refresh the changed models,
+    see :mod:`o3api.watcher`. Only for O3API_ADMIN_GROUPS.
+
+    :return: added, changed, removed models and refreshed items
+    :rtype: dict
+    """
+    report = o3watcher.watcher.scan()
+    logger.debug(F"Rescan: {report}")
+    return report
 
+@_record_request
 @_catch_error
 def list_models(*args, **kwargs):
     """Return the list of available Ozone models
@@ -187,23 +611,15 @@ def list_models(*args, **kwargs):
     :return: The list of available models
     :rtype: dict
     """
-    models = []
-    for mdir in os.listdir(cfg.O3AS_DATA_BASEPATH):
-        m_path = os.path.join(cfg.O3AS_DATA_BASEPATH, mdir)
-        if (os.path.isdir(m_path)):
-            netcdf_ok = False
-            for f in os.listdir(m_path):
-                if ".nc" in f:
-                    netcdf_ok = True
-            models.append(mdir) if netcdf_ok else ''
-    
-    models.sort()
+    models = o3catalog.catalog.list_models()
     models_dict = { "models": models }
     logger.debug(F"Model list: {models_dict}")
 
     return models_dict
 
+@_record_request
 @_catch_error
+@_schedule
 def get_model_info(*args, **kwargs):
     """Return information about the Ozone model
 
@@ -223,9 +639,41 @@ def get_model_info(*args, **kwargs):
     logger.debug(F"{model} model info: {info_dict}")
     return info_dict
 
+@flaat.login_required() # Require only authorized people to call api method
+@_record_request
+@_catch_error
+@_admission_control
+@_schedule
+def get_tile(*args, **kwargs):
+    """Return a tile of the (lat x time) field of the model,
+    see :mod:`o3api.pyramid`
+
+    :param kwargs: The provided in the API call parameters
+    :return: JSON with time (x), latitudes and values[lat][time]
+    :rtype: dict
+    """
+    model = kwargs[MODEL].strip().strip('\"')
+    tile = o3pyramid.pyramid.get_tile(model, kwargs[PTYPE],
+                                      kwargs[TRES], kwargs[LRES],
+                                      kwargs[TX], kwargs[TY])
+    return { PTYPE: kwargs[PTYPE],
+             MODEL: model,
+             TRES: kwargs[TRES],
+             LRES: kwargs[LRES],
+             TX: kwargs[TX],
+             TY: kwargs[TY],
+             'n_tx': tile['n_tx'],
+             'n_ty': tile['n_ty'],
+             'x': [ str(t) for t in tile['time'] ],
+             'lat': tile['lat'].tolist(),
+             'z': _to_json_values(tile['values']) }
+
 #@_profile
 @flaat.login_required() # Require only authorized people to call api method   
+@_record_request
 @_catch_error
+@_admission_control
+@_schedule
 def plot(*args, **kwargs):
     """Main plotting routine
 
@@ -241,10 +689,31 @@ def plot(*args, **kwargs):
 
     # set how to process data (tco3_zm, vmro3_zm, etc)
     data = o3plots.set_data_processing(plot_type, **kwargs)
-    __get_raw_data = data.get_raw_data
     __get_plot_data = data.get_plot_data
     __get_ref1980 = data.get_ref1980
 
+    level_time = kwargs.get(LEVEL_TIME, False)
+    if level_time and plot_type != VMRO3:
+        raise o3plots.InvalidRequest(
+                  "{} is only available for {}".format(LEVEL_TIME, VMRO3))
+
+    smooth = kwargs.get(SMOOTH)
+    if smooth is not None:
+        if plot_type == TCO3Return or level_time:
+            raise o3plots.InvalidRequest(
+                      "{} is only available for series of {} and {}".format(
+                      SMOOTH, TCO3, VMRO3))
+        o3smoothing.parse(smooth)
+
+    @_timeit
+    def __return_level_time(model):
+        """Function to return the (level x time) field as JSON
+
+        :param model: model to process
+        :return: JSON with time (x), levels (hPa) and values[level][time]
+        """
+        return _json_level_time(data, model)
+
     @_timeit
     def __return_json(model):
         """Function to return JSON
@@ -252,46 +721,74 @@ def plot(*args, **kwargs):
         :param model: model to process
         :return: JSON with points (x,y)
         """
-        curve = __get_raw_data(model)
-        observed = { MODEL: model,
-                    "x": curve.index.tolist(),
-                    "y": curve.values.tolist(),
-                   }
-        return observed
+        return _json_series(data, model)
 
     @_timeit
     def __return_plot(model):
-        """Function to draw the plot
+        """Function to get the data for the plot
 
         :param model: model to process
+        :return: curve ready for plotting
         """
-        curve = __get_plot_data(model)
-        curve.plot()
+        return __get_plot_data(model)
 
-    if request.headers['Accept'] == "application/pdf":
+    if request.headers['Accept'] == "application/pdf" and level_time:
         figure_file = phlp.set_filename(**kwargs) + ".pdf"
-        fig = plt.figure(num=None, figsize=(plot_c[plot_type]['fig_size']), 
-                         dpi=150, facecolor='w',
-                         edgecolor='k')
+        fields = [ data.get_level_time(m) for m in models ]
+
+        buffer_plot = BytesIO()
+        plt = phlp.get_pyplot()
+        with pyplot_lock:
+            fig = phlp.plot_level_time(models, fields, **kwargs)
+            plt.savefig(buffer_plot, format='pdf', bbox_inches='tight')
+            plt.close(fig)
+        buffer_plot.seek(0)
 
-        [ __return_plot(m) for m in models ]
+        response = send_file(buffer_plot,
+                             as_attachment=True,
+                             attachment_filename=figure_file,
+                             mimetype='application/pdf')
+    elif request.headers['Accept'] == "application/pdf":
+        figure_file = phlp.set_filename(**kwargs) + ".pdf"
+        # process data outside of the lock, only drawing is serialized
+        if plot_type == TCO3Return:
+            curves = [ __return_plot(m) for m in models ]
+        else:
+            # all models smoothed together, see o3api/smoothing.py
+            curves = o3smoothing.smooth_series(
+                         [ data.get_raw_data(m) for m in models ],
+                         smooth or plot_c[plot_type].get('smooth'))
+        # return years are relative to 1980 already, no reference line
+        ref1980 = None
+        if plot_type != TCO3Return:
+            values1980 = [ __get_ref1980(m) for m in models ]
+            ref1980 = np.nanmean(values1980)
+            logger.debug(F"ref1980 values: {values1980} and the mean: {ref1980}")
 
-        #phlp.set_figure_attr(fig, **kwargs)
+        buffer_plot = BytesIO()  # store in IO buffer, not a file
+        plt = phlp.get_pyplot()
+        with pyplot_lock:
+            fig = plt.figure(num=None,
+                             figsize=(plot_c[plot_type]['fig_size']),
+                             dpi=150, facecolor='w',
+                             edgecolor='k')
+
+            if plot_type == TCO3Return:
+                [ curve.plot(style='o-') for curve in curves ]
+            else:
+                [ curve.plot() for curve in curves ]
 
-        values1980 = [ __get_ref1980(m) for m in models ]
-        ref1980 = np.nanmean(values1980)
-        xmin, xmax = plt.xlim()
-        plt.hlines(ref1980, xmin, xmax, 
-                   colors='k', # 'dimgray'..? 
-                   linestyles='dashed',
-                   zorder=256) # big zorder for above all 
-        logger.debug(F"ref1980 values: {values1980} and the mean: {ref1980}")
+            if ref1980 is not None:
+                xmin, xmax = plt.xlim()
+                plt.hlines(ref1980, xmin, xmax,
+                           colors='k', # 'dimgray'..?
+                           linestyles='dashed',
+                           zorder=256) # big zorder for above all
 
-        phlp.set_figure_attr(fig, **kwargs)
+            phlp.set_figure_attr(fig, **kwargs)
 
-        buffer_plot = BytesIO()  # store in IO buffer, not a file
-        plt.savefig(buffer_plot, format='pdf', bbox_inches='tight')
-        plt.close(fig)
+            plt.savefig(buffer_plot, format='pdf', bbox_inches='tight')
+            plt.close(fig)
         buffer_plot.seek(0)
 
         response = send_file(buffer_plot,
@@ -305,7 +802,14 @@ def plot(*args, **kwargs):
         fig_type = { PTYPE: plot_type}
         __json_append(fig_type)
     
-        [ __json_append(__return_json(m)) for m in models ]
+        if smooth is not None:
+            curves = o3smoothing.smooth_series(
+                         [ data.get_raw_data(m) for m in models ], smooth)
+            json_output += [ _json_curve(m, c) for m, c in zip(models,
+                                                               curves) ]
+        else:
+            __return = __return_level_time if level_time else __return_json
+            [ __json_append(__return(m)) for m in models ]
         
         response = json_output
 
@@ -313,3 +817,160 @@ def plot(*args, **kwargs):
        "[TIME] Total time from getting the request: {}".format(time.time() -
                                                                time_start))
     return response
+
+def _batch_item_npz(arrays, index, output):
+    """Add the result of one batch request to the arrays of the .npz
+
+    :param arrays: dict of arrays, extended
+    :param index: Position of the request in the batch
+    :param output: JSON result of the request (as /api/plot)
+    """
+    prefix = "{}/".format(index)
+    for j, observed in enumerate(output[1:]):
+        name = "{}{}/".format(prefix, j)
+        arrays[name + MODEL] = np.array(observed[MODEL])
+        x = np.array(observed["x"])
+        # time as datetime64, no objects (loaded without pickle)
+        arrays[name + "x"] = x.astype('datetime64[ns]') if x.dtype == object \
+                             else x
+        for key in ["y", "levels", "z"]:
+            if key in observed:
+                arrays[name + key] = np.array(observed[key], dtype=float)
+
+@flaat.login_required() # Require only authorized people to call api method
+@_record_request
+@_catch_error
+@_admission_control
+@_schedule
+def plot_batch(*args, **kwargs):
+    """Evaluate several plot requests (JSON) in one call.
+    The requests are processed one after the other, the whole field of
+    every model (tco3_zm) is read once for all its periods, months and
+    latitude bands. An invalid or failing request gives the error as
+    its result, the others are returned as usual.
+
+    :param kwargs: The provided in the API call parameters, body:
+                   list of parameter sets as for /api/plot
+    :return: per request: status and result (as /api/plot) or error;
+             with Accept application/octet-stream a .npz file
+    """
+    items = kwargs.get('body') or []
+    if len(items) > cfg.batch_conf['max_items']:
+        raise o3plots.InvalidRequest("Too many requests in the batch: {} > {}"
+                                     .format(len(items),
+                                             cfg.batch_conf['max_items']))
+    time_start = time.time()
+    shared_fields = {} # (plot type, model) -> field, read once
+    results = []
+    for item in items:
+        try:
+            params = _batch_params(item)
+            models = phlp.clean_models(**params)
+            data = o3plots.set_data_processing(params[PTYPE],
+                                               shared_fields=shared_fields,
+                                               **params)
+            output = [ { PTYPE: params[PTYPE] } ]
+            if params.get(SMOOTH) is not None:
+                curves = o3smoothing.smooth_series(
+                             [ data.get_raw_data(m) for m in models ],
+                             params[SMOOTH])
+                output += [ _json_curve(m, c) for m, c in zip(models,
+                                                              curves) ]
+            else:
+                json_item = (_json_level_time if params[LEVEL_TIME] else
+                             _json_series)
+                output += [ json_item(data, m) for m in models ]
+            results.append({ 'status': 200, 'result': output })
+        except Exception as e:
+            logger.debug("[BATCH] {} failed: {}".format(item, e))
+            results.append({ 'status': getattr(e, 'status', 500),
+                             'error': { 'object': str(type(e)),
+                                        'message': '{}'.format(e) } })
+    logger.info("[TIME] Batch of {} requests, {} fields read: {}".format(
+                len(items), len(shared_fields), time.time() - time_start))
+
+    if request.headers.get('Accept') == "application/octet-stream":
+        arrays = { 'status': np.array([ r['status'] for r in results ]) }
+        for i, result in enumerate(results):
+            if 'result' in result:
+                _batch_item_npz(arrays, i, result['result'])
+            else:
+                arrays["{}/error".format(i)] = np.array(
+                                                   result['error']['message'])
+        buffer_npz = BytesIO()
+        np.savez(buffer_npz, **arrays)
+        buffer_npz.seek(0)
+        return send_file(buffer_npz,
+                         as_attachment=True,
+                         attachment_filename='o3api-batch.npz',
+                         mimetype='application/octet-stream')
+    return results
+
+@flaat.login_required() # Require only authorized people to call api method
+@_record_request
+@_catch_error
+@_admission_control
+@_schedule
+def export(*args, **kwargs):
+    """Export the series of all requested models as one file
+    (netCDF or Parquet) on a common time axis, with the 1980 references
+    and the request parameters as metadata. The file is written one
+    model at a time and sent in chunks.
+
+    :param kwargs: The provided in the API call parameters, as /api/plot
+                   and format (netcdf, parquet)
+    :return: the file as attachment
+    """
+    plot_type = kwargs[PTYPE]
+    models = phlp.clean_models(**kwargs)
+    output_format = kwargs.pop(FORMAT, 'netcdf')
+    time_start = time.time()
+    path = o3export.export(plot_type, models, output_format, **kwargs)
+    suffix, mimetype = o3export.FORMATS[output_format]
+    size = os.path.getsize(path)
+    logger.info("[TIME] Export of {} models ({} bytes): {}".format(
+                len(models), size, time.time() - time_start))
+
+    response = Response(o3export.stream_file(path), mimetype=mimetype,
+                        direct_passthrough=True)
+    # also if the body is never sent (e.g. the client went away)
+    response.call_on_close(lambda: o3export.remove_file(path))
+    response.headers['Content-Length'] = str(size)
+    response.headers['Content-Disposition'] = \
+        "attachment; filename={}{}".format(phlp.set_filename(**kwargs),
+                                           suffix)
+    return response
+
+@flaat.login_required() # Require only authorized people to call api method
+@_record_request
+@_catch_error
+@_admission_control
+@_schedule
+def decompose(*args, **kwargs):
+    """Trend, seasonal cycle, residual or anomaly (relative to the 1980
+    reference) of the series of all requested models, see
+    :mod:`o3api.decompose`. All components are computed together and
+    cached, only the requested one is returned.
+
+    :param kwargs: The provided in the API call parameters, as /api/plot
+                   and component (trend, seasonal, residual, anomaly)
+    :return: JSON with points (x,y) per model, x the months (1..12) for
+             the seasonal cycle
+    """
+    plot_type = kwargs[PTYPE]
+    if plot_type not in [TCO3, VMRO3]:
+        raise o3plots.InvalidRequest(
+                  "Decomposition is only available for {} and {}".format(
+                  TCO3, VMRO3))
+    component = kwargs.get(COMPONENT, 'trend')
+    if component not in o3decompose.COMPONENTS:
+        raise o3plots.InvalidRequest("Components are {}, got {}".format(
+                                     o3decompose.COMPONENTS, component))
+    models = phlp.clean_models(**kwargs)
+    data = o3plots.set_data_processing(plot_type, **kwargs)
+    frame = o3decompose.get_components(data, models)[component]
+
+    json_output = [{ PTYPE: plot_type, COMPONENT: component }]
+    json_output += [ _json_curve(m, frame.iloc[:, i].dropna())
+                     for i, m in enumerate(models) ]
+    return json_output
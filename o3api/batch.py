@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Offline computation of series for a grid of models x latitude bands x
+# month sets, without the REST API. The processing classes of o3api.plots
+# are used directly in a pool of processes; all series of a model are
+# computed by one process, so the data of the model is read once (the
+# whole tco3_zm field is shared by the selections, see shared_fields of
+# DataSelection). The result is one netCDF file with the series as
+# (model, band, months, time) and the 1980 reference values, or a Parquet
+# table (one row per point, needs pyarrow or fastparquet).
+#
+# The grid is a YAML or JSON file, e.g.:
+#
+#   ptype: tco3_zm
+#   models: [CCMI-1_ACCESS-refC2, CCMI-1_CCCma-CMAM-refC2] # default all
+#   begin: 1960
+#   end: 2100
+#   bands: ["-90:-60", "-60:-35", "-20:20", "35:60", "60:90"]
+#   months: [[], [12, 1, 2], [3, 4, 5], [10]] # [] whole year
+#
+# $ o3api-batch grid.yaml --output series.nc [--workers 8]
+
+import argparse
+import json
+import logging
+import multiprocessing
+import numpy as np
+import o3api.catalog as o3catalog
+import o3api.config as cfg
+import o3api.plots as o3plots
+import os
+import sys
+import time
+import xarray as xr
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+# configuration for netCDF
+TCO3 = cfg.netCDF_conf['tco3']
+VMRO3 = cfg.netCDF_conf['vmro3']
+
+# configuration for API
+api_c = cfg.api_conf
+
+# defaults of the grid, as in swagger.yml
+GRID_DEFAULTS = { 'ptype': TCO3, 'begin': 1959, 'end': 2100,
+                  'bands': ["-10:10"], 'months': [[]] }
+
+
+def months_label(months):
+    """Label of the month set, e.g. '12,1,2', 'all' for the whole year
+
+    :rtype: string
+    """
+    return ",".join(str(m) for m in months) if months else "all"
+
+
+def load_grid(path):
+    """Read the parameter grid (YAML or JSON), set the defaults
+
+    :param path: Path to the grid file (.yaml, .yml or .json)
+    :return: ptype, models, begin, end, bands as (lat_min, lat_max),
+             month sets, level_min, level_max
+    :rtype: dict
+    """
+    with open(path) as f:
+        if os.path.splitext(path)[1].lower() in ['.yaml', '.yml']:
+            import yaml
+            grid = yaml.safe_load(f)
+        else:
+            grid = json.load(f)
+    grid = dict(GRID_DEFAULTS, **(grid or {}))
+    if grid['ptype'] not in [TCO3, VMRO3]:
+        raise ValueError("Series are computed for {} and {}, got {}".format(
+                         TCO3, VMRO3, grid['ptype']))
+    if not grid.get('models'):
+        grid['models'] = o3catalog.catalog.list_models()
+    grid['bands'] = o3plots.ProcessForTCO3Return.parse_bands(
+                        [ b if isinstance(b, str) else "{}:{}".format(*b)
+                          for b in grid['bands'] ], -10, 10)
+    grid['months'] = [ [ int(m) for m in months ]
+                       for months in grid['months'] ]
+    grid.setdefault('level_min', None)
+    grid.setdefault('level_max', None)
+    return grid
+
+
+def _init_worker(data_path):
+    """Set up a worker process
+    """
+    cfg.O3AS_DATA_BASEPATH = data_path
+
+
+def process_model(model, grid):
+    """Compute all series of the model (in a worker process)
+
+    :param model: The model to process
+    :param grid: Parameter grid from :func:`load_grid`
+    :return: list of (band index, months index, time, values, ref1980)
+    """
+    shared_fields = {}
+    results = []
+    for i_months, months in enumerate(grid['months']):
+        for i_band, (lat_min, lat_max) in enumerate(grid['bands']):
+            kwargs = { api_c['begin']: grid['begin'],
+                       api_c['end']: grid['end'],
+                       api_c['month']: months,
+                       api_c['lat_min']: lat_min,
+                       api_c['lat_max']: lat_max,
+                       api_c['level_min']: grid['level_min'],
+                       api_c['level_max']: grid['level_max'],
+                       'shared_fields': shared_fields }
+            data = o3plots.set_data_processing(grid['ptype'], **kwargs)
+            series = data.get_raw_data(model)
+            results.append((i_band, i_months,
+                            series.index.values.astype('datetime64[M]'),
+                            series.values, data.get_ref1980(model)))
+    return results
+
+
+def _model_size(model, plot_type):
+    """Size of the data files of the model, to start with large models
+    """
+    entry = o3catalog.catalog.get_entry(model, plot_type)
+    return sum(size for _, _, size in entry.fingerprint)
+
+
+def run_batch(grid, workers=None, progress=None):
+    """Compute the series of the grid in a pool of processes,
+    one task per model
+
+    :param grid: Parameter grid from :func:`load_grid`
+    :param workers: Number of processes, default the number of CPUs;
+                    1 computes in this process
+    :param progress: Function called with (done, total, model, error)
+                     after every model
+    :return: series and references 1980, failed models with the error
+    :rtype: xarray Dataset, dict
+    """
+    models = sorted(grid['models'],
+                    key=lambda m: -_model_size(m, grid['ptype']))
+    workers = workers or os.cpu_count() or 1
+    results = {}
+    failed = {}
+
+    def _done(model, result=None, error=None):
+        if error is None:
+            results[model] = result
+        else:
+            failed[model] = error
+            logger.warning("[BATCH] {} failed: {}".format(model, error))
+        if progress is not None:
+            progress(len(results) + len(failed), len(models), model, error)
+
+    if workers == 1:
+        for model in models:
+            try:
+                _done(model, process_model(model, grid))
+            except Exception as e:
+                _done(model, error=str(e))
+    else:
+        ctx = multiprocessing.get_context('fork' if sys.platform != 'win32'
+                                          else 'spawn')
+        with ProcessPoolExecutor(max_workers=min(workers, len(models) or 1),
+                                 mp_context=ctx,
+                                 initializer=_init_worker,
+                                 initargs=(cfg.O3AS_DATA_BASEPATH,)) as pool:
+            futures = { pool.submit(process_model, model, grid): model
+                        for model in models }
+            for future in as_completed(futures):
+                try:
+                    _done(futures[future], future.result())
+                except Exception as e:
+                    _done(futures[future], error=str(e))
+
+    return to_dataset(grid, [ m for m in grid['models'] if m in results ],
+                      results), failed
+
+
+def to_dataset(grid, models, results):
+    """Collect the series as (model, band, months, time), time points
+    not selected by a month set are NaN
+
+    :param grid: Parameter grid from :func:`load_grid`
+    :param models: Models in the order of the result
+    :param results: model -> result of :func:`process_model`
+    :rtype: xarray Dataset
+    """
+    times = [ t for m in models for _, _, t, _, _ in results[m] ]
+    times = np.unique(np.concatenate(times)) if times else \
+            np.array([], dtype='datetime64[M]')
+    shape = (len(models), len(grid['bands']), len(grid['months']))
+    values = np.full(shape + (times.size,), np.nan,
+                     dtype=o3plots.get_dtype())
+    ref1980 = np.full(shape, np.nan)
+    for i_model, model in enumerate(models):
+        for i_band, i_months, time_axis, y, ref in results[model]:
+            values[i_model, i_band, i_months,
+                   np.searchsorted(times, time_axis)] = y
+            ref1980[i_model, i_band, i_months] = ref
+    bands = grid['bands']
+    dims = ('model', 'band', 'months')
+    return xr.Dataset(
+        { grid['ptype']: (dims + ('time',), values),
+          'ref1980': (dims, ref1980) },
+        coords={ 'model': models,
+                 'band': [ o3plots.ProcessForTCO3Return.band_label(b)
+                           for b in bands ],
+                 'lat_min': ('band', [ b[0] for b in bands ]),
+                 'lat_max': ('band', [ b[1] for b in bands ]),
+                 'months': [ months_label(m) for m in grid['months'] ],
+                 'time': times.astype('datetime64[ns]') },
+        attrs={ 'begin': grid['begin'], 'end': grid['end'] })
+
+
+def write(ds, plot_type, path, output_format=None):
+    """Write the result as netCDF or Parquet (one row per point)
+
+    :param ds: Result of :func:`run_batch`
+    :param plot_type: The plot type of the series
+    :param path: Output file
+    :param output_format: 'netcdf' or 'parquet', default from the extension
+    """
+    if output_format is None:
+        output_format = ('parquet' if path.endswith(('.parquet', '.pq'))
+                         else 'netcdf')
+    if output_format == 'netcdf':
+        ds.to_netcdf(path)
+        return
+    table = ds.to_dataframe().dropna(subset=[plot_type]).reset_index()
+    try:
+        table.to_parquet(path, index=False)
+    except ImportError as e:
+        raise SystemExit("Parquet needs pyarrow or fastparquet ({}), "
+                         "write netCDF instead".format(e))
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(
+                description='Compute o3api series for a grid of models, '
+                            'latitude bands and month sets')
+    parser.add_argument('grid',
+                        help='Parameter grid, YAML or JSON file')
+    parser.add_argument('--output', required=True,
+                        help='Output file, .nc or .parquet')
+    parser.add_argument('--format', choices=['netcdf', 'parquet'],
+                        default=None,
+                        help='Output format, default from the extension')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of processes, default number of CPUs')
+    parser.add_argument('--data', default=None,
+                        help='Data directory, default $O3AS_DATA_BASEPATH')
+    parser.add_argument('--quiet', action='store_true',
+                        help='Do not report the progress')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_args(argv)
+    if args.data:
+        cfg.O3AS_DATA_BASEPATH = args.data
+    grid = load_grid(args.grid)
+    n_series = len(grid['bands'])*len(grid['months'])
+    time_start = time.time()
+
+    def _progress(done, total, model, error):
+        if args.quiet:
+            return
+        elapsed = time.time() - time_start
+        eta = elapsed/done*(total - done)
+        status = "failed: {}".format(error) if error else \
+                 "{} series".format(n_series)
+        print("[{:>{w}}/{}] {} {} ({:.1f}s, eta {:.0f}s)".format(
+              done, total, model, status, elapsed, eta,
+              w=len(str(total))), file=sys.stderr)
+
+    ds, failed = run_batch(grid, workers=args.workers, progress=_progress)
+    write(ds, grid['ptype'], args.output, args.format)
+    print("{} series of {} models written to {} in {:.1f}s{}".format(
+          ds.sizes['model']*n_series, ds.sizes['model'], args.output,
+          time.time() - time_start,
+          ", failed: {}".format(", ".join(sorted(failed))) if failed else ""))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
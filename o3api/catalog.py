@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Catalog of the available data: models, their netCDF files per plot type,
+# file fingerprints (mtime, size) and coordinate axes (time, latitude,
+# pressure levels).
+# Entries are built on first use (or during the warm-up, see o3api.warmup)
+# and rebuilt when files of the model change. Changed models are also
+# detected by a periodic scan, see o3api.watcher.
+
+import glob
+import logging
+import netCDF4
+import numpy as np
+import o3api.config as cfg
+import o3api.fileaccess as o3fileaccess
+import os
+import threading
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+# configuration for netCDF
+TIME = cfg.netCDF_conf['t_c']
+LAT = cfg.netCDF_conf['lat_c']
+PLEV = cfg.netCDF_conf['plev_c']
+
+
+class FileCoords:
+    """Coordinates of one netCDF file
+
+    :param years: Year of every time point
+    :param months: Month of every time point
+    :param time: Time points as numpy datetime64
+    :param lats: Latitudes
+    :param levels: Pressure levels (hPa), None if the file has no levels
+    """
+    def __init__(self, years, months, time, lats, levels=None):
+        self.years = years
+        self.months = months
+        self.time = time
+        self.lats = lats
+        self.levels = levels
+
+
+class ModelEntry:
+    """Files and coordinate axes of a model for one plot type
+
+    :param model: The model name
+    :param plot_type: The plot type (e.g. tco3_zm, vmro3_zm, ...)
+    :param files: Sorted list of the netCDF files
+    :param fingerprint: Tuple of (file, mtime, size)
+    """
+    def __init__(self, model, plot_type, files, fingerprint):
+        self.model = model
+        self.plot_type = plot_type
+        self.files = files
+        self.fingerprint = fingerprint
+        self._axes = None
+
+    @property
+    def axes(self):
+        """Time and latitude axes of the model, files concatenated in time
+
+        :return: years, months, time (datetime64), latitudes
+        :rtype: tuple of numpy arrays
+        """
+        if self._axes is None:
+            coords = [ read_file_coords(f) for f in self.files ]
+            if coords:
+                self._axes = (np.concatenate([c.years for c in coords]),
+                              np.concatenate([c.months for c in coords]),
+                              np.concatenate([c.time for c in coords]),
+                              coords[0].lats)
+            else:
+                empty = np.array([], dtype=int)
+                self._axes = (empty, empty,
+                              np.array([], dtype='datetime64[ns]'),
+                              np.array([], dtype=float))
+        return self._axes
+
+
+def _to_datetime64(dates):
+    """Convert (cftime) dates to numpy datetime64,
+    days not existing in the standard calendar (e.g. 30 February
+    in the 360-day calendar) are clipped to the 28th
+    """
+    values = []
+    for d in dates:
+        date = "{:04d}-{:02d}-{:02d}T{:02d}:{:02d}"
+        try:
+            value = np.datetime64(date.format(d.year, d.month, d.day,
+                                              d.hour, d.minute))
+        except ValueError:
+            value = np.datetime64(date.format(d.year, d.month, 28,
+                                              d.hour, d.minute))
+        values.append(value)
+    return np.array(values, dtype='datetime64[ns]')
+
+
+def to_hpa(levels, units):
+    """Convert pressure levels to hPa according to the units attribute
+
+    :param levels: Pressure levels
+    :param units: Units of the levels (Pa, hPa, mbar), hPa if unknown
+    :return: levels in hPa
+    :rtype: numpy array
+    """
+    levels = np.asarray(levels, dtype=np.float64)
+    if str(units).strip().lower() == 'pa':
+        levels = levels/100.
+    return levels
+
+
+# cache of coordinates per file: path -> (mtime, size, FileCoords)
+_coords_cache = {}
+_coords_lock = threading.Lock()
+
+def read_file_coords(path):
+    """Read time, latitude and pressure level coordinates of the file (cached)
+
+    :param path: Path to the netCDF file
+    :return: coordinates of the file
+    :rtype: FileCoords
+    """
+    stat = os.stat(path)
+    with _coords_lock:
+        entry = _coords_cache.get(path)
+    if entry is not None and entry[:2] == (stat.st_mtime, stat.st_size):
+        return entry[2]
+
+    with o3fileaccess.file_manager.open(path) as nc:
+        t_var = nc.variables[TIME]
+        dates = netCDF4.num2date(t_var[:], t_var.units,
+                                 getattr(t_var, 'calendar', 'standard'),
+                                 only_use_cftime_datetimes=True)
+        levels = None
+        if PLEV in nc.variables:
+            p_var = nc.variables[PLEV]
+            levels = to_hpa(p_var[:], getattr(p_var, 'units', 'hPa'))
+        coords = FileCoords(np.array([d.year for d in dates]),
+                            np.array([d.month for d in dates]),
+                            _to_datetime64(dates),
+                            np.asarray(nc.variables[LAT][:]),
+                            levels)
+
+    with _coords_lock:
+        _coords_cache[path] = (stat.st_mtime, stat.st_size, coords)
+    return coords
+
+
+def discard_file_coords(paths):
+    """Drop the cached coordinates of the files
+
+    :param paths: Paths to the netCDF files
+    :return: number of dropped files
+    """
+    with _coords_lock:
+        return len([ _coords_cache.pop(p) for p in paths
+                     if p in _coords_cache ])
+
+
+class Catalog:
+    """Catalog of models and their files per plot type
+    """
+    def __init__(self):
+        self._entries = {} # (base_path, model, plot_type) -> ModelEntry
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _fingerprint(files):
+        fingerprint = []
+        for f in files:
+            stat = os.stat(f)
+            fingerprint.append((f, stat.st_mtime, stat.st_size))
+        return tuple(fingerprint)
+
+    def list_models(self):
+        """Return the list of models having netCDF files
+
+        :return: sorted model names
+        :rtype: list
+        """
+        models = []
+        for mdir in os.listdir(cfg.O3AS_DATA_BASEPATH):
+            m_path = os.path.join(cfg.O3AS_DATA_BASEPATH, mdir)
+            if (os.path.isdir(m_path)):
+                netcdf_ok = False
+                for f in os.listdir(m_path):
+                    if ".nc" in f:
+                        netcdf_ok = True
+                models.append(mdir) if netcdf_ok else ''
+        models.sort()
+        return models
+
+    @staticmethod
+    def find_files(model, plot_type):
+        """Return the netCDF files of the model and their fingerprint
+
+        :param model: The model name
+        :param plot_type: The plot type (e.g. tco3_zm, vmro3_zm, ...)
+        :return: sorted files, tuple of (file, mtime, size)
+        """
+        files = sorted(glob.glob(os.path.join(cfg.O3AS_DATA_BASEPATH,
+                                              model, plot_type + "*.nc")))
+        return files, Catalog._fingerprint(files)
+
+    def get_entry(self, model, plot_type):
+        """Return the catalog entry, (re)built if the files have changed
+
+        :param model: The model name
+        :param plot_type: The plot type (e.g. tco3_zm, vmro3_zm, ...)
+        :return: catalog entry for the model
+        :rtype: ModelEntry
+        """
+        # strip possible spaces in front and back, and then quotas
+        model = model.strip().strip('\"')
+        key = (cfg.O3AS_DATA_BASEPATH, model, plot_type)
+        files, fingerprint = self.find_files(model, plot_type)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.fingerprint != fingerprint:
+                if entry is not None:
+                    logger.info("[CATALOG] {} {} changed, rebuilding"
+                                .format(model, plot_type))
+                entry = ModelEntry(model, plot_type, files, fingerprint)
+                self._entries[key] = entry
+        return entry
+
+    def get_datafiles(self, model, plot_type):
+        """Return the list of netCDF files of the model
+
+        :param model: The model name
+        :param plot_type: The plot type (e.g. tco3_zm, vmro3_zm, ...)
+        :rtype: list
+        """
+        return self.get_entry(model, plot_type).files
+
+    def list_entries(self):
+        """Return the entries built for the current data directory
+
+        :return: catalog entries
+        :rtype: list of ModelEntry
+        """
+        with self._lock:
+            return [ entry for key, entry in self._entries.items()
+                     if key[0] == cfg.O3AS_DATA_BASEPATH ]
+
+    def invalidate(self, model, plot_type):
+        """Drop the entry of the model and the coordinates of its files,
+        the entry is rebuilt at next use
+
+        :param model: The model name
+        :param plot_type: The plot type (e.g. tco3_zm, vmro3_zm, ...)
+        :return: the dropped entry or None
+        :rtype: ModelEntry
+        """
+        with self._lock:
+            entry = self._entries.pop((cfg.O3AS_DATA_BASEPATH, model,
+                                       plot_type), None)
+        if entry is not None:
+            discard_file_coords(entry.files)
+        return entry
+
+    def stats(self):
+        """Return the number of catalog entries and cached files
+
+        :rtype: dict
+        """
+        with self._lock:
+            return { 'entries': len(self._entries),
+                     'files': len(_coords_cache) }
+
+
+catalog = Catalog()
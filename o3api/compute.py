@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Execution backend of dask computations (xarray path) and chunk sizing.
+# The backend is configured at first use in every worker process, so with
+# gunicorn --preload no threads or processes are started in the master.
+# Chunks are taken along latitude: in 'auto' mode a chunk is sized to
+# chunk_target_bytes, limited by memory_fraction of the memory available
+# per dask worker, unless fixed by O3API_CHUNK_SIZE or per model by
+# O3API_CHUNK_OVERRIDES. The chosen chunks and compute times are kept
+# per model and reported by /api/get_stats to validate the choice.
+
+import dask
+import logging
+import numpy as np
+import o3api.config as cfg
+import o3api.fileaccess as o3fileaccess
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+# configuration for netCDF
+LAT = cfg.netCDF_conf['lat_c']
+
+SCHEDULERS = ['sync', 'threads', 'processes', 'distributed']
+
+
+def parse_overrides(overrides):
+    """Parse per model chunk sizes, e.g. 'model-a:8,model-b:32'
+
+    :param overrides: Comma separated model:size pairs
+    :return: model -> chunk size
+    :rtype: dict
+    """
+    chunks = {}
+    for item in filter(None, overrides.split(',')):
+        model, _, size = item.rpartition(':')
+        chunks[model.strip()] = int(size)
+    return chunks
+
+
+def available_memory():
+    """Memory available to the process: MemAvailable of the node,
+    limited by the cgroup (container) limit, if any
+
+    :return: bytes
+    :rtype: int
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            meminfo = dict(line.split(':', 1) for line in f)
+        memory = int(meminfo['MemAvailable'].split()[0])*1024
+    except (OSError, KeyError, ValueError):
+        memory = os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+
+    # cgroup v2 and v1
+    for limit_file, usage_file in [
+        ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+        ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+         '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        try:
+            with open(limit_file) as f:
+                limit = f.read().strip()
+            with open(usage_file) as f:
+                usage = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        if limit.isdigit():
+            memory = min(memory, max(int(limit) - usage, 0))
+        break
+    return memory
+
+
+class ComputeBackend:
+    """Dask execution backend and chunk sizing
+
+    :param conf: Configuration, see dask_conf in o3api/config.py
+    """
+    def __init__(self, conf):
+        self.conf = conf
+        self.scheduler = None
+        self.client = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._chunks = {} # (model, plot_type, fingerprint) -> chunk info
+        self._metrics = {} # model -> chunk info and compute times
+
+    def setup(self):
+        """Configure the dask scheduler, once per process
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            scheduler = self.conf['scheduler']
+            if scheduler not in SCHEDULERS:
+                logger.warning("[COMPUTE] Unknown scheduler '{}', using threads"
+                               .format(scheduler))
+                scheduler = 'threads'
+            num_workers = self.conf['num_workers'] or None
+            if scheduler == 'distributed':
+                try:
+                    from dask.distributed import Client, LocalCluster
+                    cluster = LocalCluster(n_workers=num_workers,
+                                           threads_per_worker=1,
+                                           processes=True,
+                                           memory_limit=self.conf['memory_limit'],
+                                           dashboard_address=None)
+                    self.client = Client(cluster, set_as_default=True)
+                except ImportError as e:
+                    logger.warning("[COMPUTE] distributed is not available "
+                                   "({}), using threads".format(e))
+                    scheduler = 'threads'
+            if scheduler != 'distributed':
+                dask.config.set(scheduler=scheduler, num_workers=num_workers)
+            self.scheduler = scheduler
+            self._pid = os.getpid()
+        logger.info("[COMPUTE] dask scheduler: {}, workers: {}".format(
+                    scheduler, self.workers()))
+
+    def workers(self):
+        """Number of dask workers (threads or processes) of this process
+
+        :rtype: int
+        """
+        if self.scheduler == 'sync':
+            return 1
+        return self.conf['num_workers'] or os.cpu_count() or 1
+
+    def target_bytes(self):
+        """Target size of a chunk in 'auto' mode
+
+        :return: bytes
+        :rtype: int
+        """
+        per_worker = (available_memory()*self.conf['memory_fraction']/
+                      self.workers())
+        return int(max(min(self.conf['chunk_target_bytes'], per_worker), 1))
+
+    @staticmethod
+    def _lat_row_bytes(files, variable):
+        """Number of latitudes and the largest size of one latitude row
+        (all other dimensions of one file)
+        """
+        n_lat = 0
+        row_bytes = 0
+        for datafile in files:
+            with o3fileaccess.file_manager.open(datafile) as nc:
+                var = nc.variables[variable]
+                shape = dict(zip(var.dimensions, var.shape))
+                n_lat = shape.get(LAT, 1)
+                row = np.prod([ n for dim, n in shape.items() if dim != LAT ])
+                row_bytes = max(row_bytes, int(row)*var.dtype.itemsize)
+        return n_lat, row_bytes
+
+    def chunk_size(self, entry):
+        """Chunk size along latitude for the model
+
+        :param entry: Catalog entry of the model (o3api.catalog.ModelEntry)
+        :return: chunk size, 0 for one chunk per file
+        :rtype: int
+        """
+        key = (entry.model, entry.plot_type, entry.fingerprint)
+        with self._lock:
+            info = self._chunks.get(key)
+        if info is None:
+            info = self._choose(entry)
+            with self._lock:
+                self._chunks[key] = info
+                metrics = self._metrics.setdefault(entry.model,
+                                                   { 'computes': 0,
+                                                     'compute_s': 0. })
+                metrics.update(info)
+        return info['chunk_lat']
+
+    def _choose(self, entry):
+        """Choose the chunk size: override, fixed or automatic
+        """
+        n_lat, row_bytes = self._lat_row_bytes(entry.files, entry.plot_type)
+        overrides = parse_overrides(self.conf['chunk_overrides'])
+        if entry.model in overrides:
+            source = 'override'
+            chunk_lat = overrides[entry.model]
+        elif str(self.conf['chunk_size']).lower() != 'auto':
+            source = 'fixed'
+            chunk_lat = int(self.conf['chunk_size'])
+        else:
+            source = 'auto'
+            chunk_lat = int(min(max(self.target_bytes() // max(row_bytes, 1),
+                                    1), n_lat))
+        chunk_lat = max(chunk_lat, 0)
+        lat_per_chunk = min(chunk_lat, n_lat) if chunk_lat > 0 else n_lat
+        n_chunks = len(entry.files)*int(np.ceil(n_lat/max(lat_per_chunk, 1)))
+        info = { 'chunk_lat': chunk_lat,
+                 'chunk_source': source,
+                 'chunks': n_chunks,
+                 'chunk_bytes': lat_per_chunk*row_bytes }
+        logger.debug("[COMPUTE] {} {}: {}".format(entry.model, entry.plot_type,
+                                                  info))
+        return info
+
+    @contextmanager
+    def measure(self, model):
+        """Measure the time of a computation for the model
+
+        :param model: The model processed
+        """
+        time_start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - time_start
+            with self._lock:
+                metrics = self._metrics.setdefault(model, { 'computes': 0,
+                                                            'compute_s': 0. })
+                metrics['computes'] += 1
+                metrics['compute_s'] += elapsed
+
+    def stats(self):
+        """Scheduler, chunk choice and compute times per model
+
+        :rtype: dict
+        """
+        with self._lock:
+            models = {}
+            for model, metrics in self._metrics.items():
+                models[model] = dict(metrics)
+                models[model]['compute_s'] = round(metrics['compute_s'], 4)
+                models[model]['compute_mean_s'] = (
+                    round(metrics['compute_s']/metrics['computes'], 4)
+                    if metrics['computes'] else 0.)
+        return { 'scheduler': self.scheduler,
+                 'workers': self.workers() if self.scheduler else 0,
+                 'models': models }
+
+
+backend = ComputeBackend(cfg.dask_conf)
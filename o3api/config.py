@@ -20,6 +20,234 @@ O3API_BASE_DIR = os.path.dirname(os.path.normpath(os.path.dirname(__file__)))
 # But one can change using environment $O3AS_DATA_BASEPATH
 O3AS_DATA_BASEPATH = os.getenv('O3AS_DATA_BASEPATH', "/srv/o3api/data/")
 
+# Record API requests (parameters and timings) for a later replay,
+# see o3api/replay.py. Disabled if $O3API_REQUEST_LOG is not set.
+# The log is rotated after max_bytes, keeping backup_count old files
+O3API_REQUEST_LOG = os.getenv('O3API_REQUEST_LOG', '')
+request_log_conf = {
+    'max_bytes': int(os.getenv('O3API_REQUEST_LOG_MAXBYTES', 10*1024*1024)),
+    'backup_count': int(os.getenv('O3API_REQUEST_LOG_BACKUPS', 5))
+}
+
+# Admission control for /api/plot, see o3api/admission.py
+# Cost is the number of data points (time x latitude) to process for all
+# requested models, multiplied by pdf_factor for PDF plots.
+# identity_budget: budget per user (identity from the OIDC token),
+#                  refilled with identity_refill per second
+# max_inflight_cost: limit for the total cost of requests in processing
+# retry_after_busy: Retry-After (seconds) if the service is overloaded
+admission_conf = {
+    'enabled': os.getenv('O3API_ADMISSION', 'true').lower() in ['true', 'yes', '1'],
+    'identity_budget': float(os.getenv('O3API_IDENTITY_BUDGET', 5.e7)),
+    'identity_refill': float(os.getenv('O3API_IDENTITY_REFILL', 5.e5)),
+    'max_inflight_cost': float(os.getenv('O3API_MAX_INFLIGHT_COST', 2.e7)),
+    'pdf_factor': float(os.getenv('O3API_PDF_COST_FACTOR', 3.)),
+    'retry_after_busy': int(os.getenv('O3API_RETRY_AFTER_BUSY', 5))
+}
+
+# Scheduling of requests inside a worker, see o3api/scheduler.py
+# (makes sense with threaded workers, $O3API_THREADS > 1 in start.sh)
+# fast_slots, bulk_slots: number of requests processed in parallel per lane
+# fast_max_cost: requests up to this cost (see admission_conf) are 'fast'
+# max_wait: seconds after which a waiting bulk request may use a fast slot
+# max_queue_wait: seconds after which a waiting request is rejected (503
+#                 with Retry-After, see admission_conf), 0 waits forever
+scheduler_conf = {
+    'enabled': os.getenv('O3API_SCHEDULER', 'true').lower() in ['true', 'yes', '1'],
+    'fast_slots': int(os.getenv('O3API_FAST_SLOTS', 2)),
+    'bulk_slots': int(os.getenv('O3API_BULK_SLOTS', 1)),
+    'fast_max_cost': float(os.getenv('O3API_FAST_MAX_COST', 1.e5)),
+    'max_wait': float(os.getenv('O3API_MAX_WAIT', 30.)),
+    'max_queue_wait': float(os.getenv('O3API_MAX_QUEUE_WAIT', 120.))
+}
+
+# In-memory cache of processed series per worker (number of entries)
+series_cache_conf = {
+    'max_entries': int(os.getenv('O3API_SERIES_CACHE_SIZE', 512))
+}
+
+# Execution of dask computations (xarray path), see o3api/compute.py
+# scheduler: 'sync', 'threads', 'processes' or 'distributed'
+#            (local cluster, needs the 'distributed' package)
+# num_workers: threads / processes / cluster workers, 0: dask default
+# memory_limit: per worker of the local cluster, e.g. '2GB'
+# parallel: open files in parallel (xarray open_mfdataset)
+# chunk_size: chunks along latitude, 'auto' or a number (<= 0: one
+#             chunk per file); chunk_overrides per model, 'model:size,...'
+# chunk_target_bytes: target size of a chunk in 'auto' mode, limited by
+#                     memory_fraction of the available memory per worker
+dask_conf = {
+    'scheduler': os.getenv('O3API_DASK_SCHEDULER', 'threads'),
+    'num_workers': int(os.getenv('O3API_DASK_WORKERS', 0)),
+    'memory_limit': os.getenv('O3API_DASK_MEMORY_LIMIT', 'auto'),
+    'parallel': os.getenv('O3API_DASK_PARALLEL', 'false').lower() in ['true', 'yes', '1'],
+    'chunk_size': os.getenv('O3API_CHUNK_SIZE', 'auto'),
+    'chunk_overrides': os.getenv('O3API_CHUNK_OVERRIDES', ''),
+    'chunk_target_bytes': int(float(os.getenv('O3API_CHUNK_TARGET_BYTES', 64*1024*1024))),
+    'memory_fraction': float(os.getenv('O3API_CHUNK_MEMORY_FRACTION', 0.1))
+}
+
+# Local copy of data files from a slow (network) mount of
+# O3AS_DATA_BASEPATH, see o3api/filecache.py
+# path: local (SSD) directory, max_bytes: budget for the copies
+# prefetch: copy the other files of a model in the background
+#           with prefetch_workers threads when one file is read
+file_cache_conf = {
+    'enabled': os.getenv('O3API_FILE_CACHE', 'false').lower() in ['true', 'yes', '1'],
+    'path': os.getenv('O3API_FILE_CACHE_PATH', '/var/cache/o3api'),
+    'max_bytes': int(float(os.getenv('O3API_FILE_CACHE_MAXBYTES', 10*1024**3))),
+    'prefetch': os.getenv('O3API_FILE_CACHE_PREFETCH', 'true').lower() in ['true', 'yes', '1'],
+    'prefetch_workers': int(os.getenv('O3API_FILE_CACHE_PREFETCH_WORKERS', 2))
+}
+
+# Access to netCDF files of the netCDF4 readers, see o3api/fileaccess.py
+# max_handles: open file handles kept per worker (LRU), 0: no pool, files
+#              are closed after every read (pooled files can not be
+#              rewritten in place while open, see o3api/fileaccess.py)
+# per_file_locks: serialize access per file, only for netcdf-c/HDF5 builds
+#                 with thread safety, otherwise (default) one lock shared
+#                 with xarray serializes access to all files
+# max_idle: seconds after which an unused handle is closed
+file_access_conf = {
+    'max_handles': int(os.getenv('O3API_MAX_FILE_HANDLES', 0)),
+    'max_idle': float(os.getenv('O3API_FILE_MAX_IDLE', 300.)),
+    'per_file_locks': os.getenv('O3API_PER_FILE_LOCKS', 'false').lower() in ['true', 'yes', '1']
+}
+
+# Reader for tco3_zm data, see o3api/plots.py:
+# mode: 'xarray' (open_mfdataset), 'netcdf4' (direct read of the index
+# ranges), 'stream' (netcdf4, reduced block by block in time) or
+# 'auto' (netcdf4 if the selection has at most max_points, else stream)
+# block_bytes: size of the blocks read by 'stream', bounds the memory
+netcdf_reader_conf = {
+    'mode': os.getenv('O3API_NC_READER', 'auto'),
+    'max_points': int(float(os.getenv('O3API_NC_READER_MAX_POINTS', 5e6))),
+    'block_bytes': int(float(os.getenv('O3API_STREAM_BLOCK_BYTES', 16*1024*1024)))
+}
+
+# Precision of loaded data, caches and results, see o3api/plots.py
+# dtype: 'float64' or 'float32' (half the memory, reductions over
+#        latitude accumulate in float64)
+# decimals: round values in JSON output, default 4 for float32
+precision_conf = {
+    'dtype': os.getenv('O3API_PRECISION', 'float64'),
+    'decimals': (int(os.getenv('O3API_JSON_DECIMALS'))
+                 if os.getenv('O3API_JSON_DECIMALS') else None)
+}
+
+# Cache of model arrays (lat x time) shared by all workers of a node,
+# see o3api/shmcache.py. path should be on tmpfs (e.g. /dev/shm),
+# max_bytes is the budget for all cached arrays together
+shm_cache_conf = {
+    'enabled': os.getenv('O3API_SHM_CACHE', 'false').lower() in ['true', 'yes', '1'],
+    'path': os.getenv('O3API_SHM_CACHE_PATH', '/dev/shm/o3api-cache'),
+    'max_bytes': int(os.getenv('O3API_SHM_CACHE_MAXBYTES', 1024*1024*1024))
+}
+
+# Warm-up at start, see o3api/warmup.py
+# mode: 'off'
+#       'sync' - before serving, e.g. with gunicorn --preload the catalog and
+#                caches are built once and shared by workers copy-on-write
+#       'background' - in a thread of every worker
+# precompute: also precompute series for the standard requests
+#             (begin..end, every latitude band in bands, full year)
+# O3API_WARMUP_BANDS is given as "lat_min:lat_max,lat_min:lat_max,..."
+warmup_conf = {
+    'mode': os.getenv('O3API_WARMUP', 'off').lower(),
+    'precompute': os.getenv('O3API_WARMUP_PRECOMPUTE', 'false').lower() in ['true', 'yes', '1'],
+    'begin': int(os.getenv('O3API_WARMUP_BEGIN', 1959)),
+    'end': int(os.getenv('O3API_WARMUP_END', 2100)),
+    'bands': [ tuple(int(lat) for lat in band.split(':'))
+               for band in os.getenv('O3API_WARMUP_BANDS', '-10:10').split(',')
+               if band ]
+}
+
+# Ozone return analysis (tco3_return), see ProcessForTCO3Return in o3api/plots.py
+# boxcar: window (years, odd) of the boxcar smoothing of the annual means
+tco3_return_conf = {
+    'boxcar': int(os.getenv('O3API_RETURN_BOXCAR', 5))
+}
+
+# Operators of latitude grids, see o3api/latgrid.py
+# weighting: means over latitude with 'cos' (area) or 'none' (equal) weights
+# max_grids: distinct latitude axes kept per worker
+# max_bands: latitude bands kept per grid (least recently used dropped)
+lat_grid_conf = {
+    'weighting': os.getenv('O3API_LAT_WEIGHTING', 'cos').lower(),
+    'max_grids': int(os.getenv('O3API_LAT_GRIDS', 64)),
+    'max_bands': int(os.getenv('O3API_LAT_BANDS', 256))
+}
+
+# Materialized series of standard latitude bands, see o3api/aggregates.py
+# bands: "lat_min:lat_max,..." requests with exactly these latitudes
+#        (any period and months) are served from the stored band means
+# path: directory of the stored band means (per model and data fingerprint)
+aggregates_conf = {
+    'enabled': os.getenv('O3API_AGGREGATES', 'false').lower() in ['true', 'yes', '1'],
+    'path': os.getenv('O3API_AGGREGATES_PATH', '/var/cache/o3api-aggregates'),
+    'bands': [ tuple(float(lat) for lat in band.split(':'))
+               for band in os.getenv('O3API_AGGREGATES_BANDS',
+                                     '-90:-60,-60:-35,-20:20,35:60,60:90,-90:90').split(',')
+               if band ],
+    'max_loaded': int(os.getenv('O3API_AGGREGATES_MAX_LOADED', 256))
+}
+
+# Tiles of the (lat x time) field, see o3api/pyramid.py
+# path: directory of the pyramids (built lazily or by o3api-pyramid)
+# tile_time, tile_lat: points per tile in time and latitude
+# max_loaded: pyramids kept memory mapped per worker
+pyramid_conf = {
+    'path': os.getenv('O3API_PYRAMID_PATH', '/var/cache/o3api-pyramid'),
+    'tile_time': int(os.getenv('O3API_TILE_TIME', 128)),
+    'tile_lat': int(os.getenv('O3API_TILE_LAT', 36)),
+    'max_loaded': int(os.getenv('O3API_PYRAMID_MAX_LOADED', 32))
+}
+
+# Results stored on disk, shared by workers and kept over restarts,
+# see o3api/resultstore.py
+# path: directory of the sqlite index and the result files (local disk)
+# max_bytes: budget for all stored results, least recently used are removed
+result_store_conf = {
+    'enabled': os.getenv('O3API_RESULT_STORE', 'false').lower() in ['true', 'yes', '1'],
+    'path': os.getenv('O3API_RESULT_STORE_PATH', '/var/cache/o3api-results'),
+    'max_bytes': int(os.getenv('O3API_RESULT_STORE_MAXBYTES', 2*1024**3))
+}
+
+# Batches of plot requests, see plot_batch in o3api/api.py
+# max_items: maximum number of parameter sets in one batch
+batch_conf = {
+    'max_items': int(os.getenv('O3API_BATCH_MAX_ITEMS', 100))
+}
+
+# Export of the series of many models, see o3api/export.py
+# path: directory of the temporary export files (default the system one)
+# chunk_bytes: size of the chunks the file is sent in
+export_conf = {
+    'path': os.getenv('O3API_EXPORT_TMP') or None,
+    'chunk_bytes': int(os.getenv('O3API_EXPORT_CHUNK_BYTES', 1024**2))
+}
+
+# Detection of changed data files, see o3api/watcher.py
+# interval: seconds between scans of O3AS_DATA_BASEPATH (mtime, size of
+#           the files), 0 disables the periodic scan (see /api/rescan)
+watcher_conf = {
+    'interval': float(os.getenv('O3API_RESCAN_INTERVAL', 300))
+}
+
+# Administrative calls (/api/rescan)
+# groups: comma separated groups (entitlements) of the OIDC token allowed
+#         to call them, any of them is enough; nobody if empty
+# claim: claim of the token holding the groups
+# rescan_cost: cost of /api/rescan for admission control and scheduling
+#              (see admission_conf, scheduler_conf)
+admin_conf = {
+    'groups': [ group.strip()
+                for group in os.getenv('O3API_ADMIN_GROUPS', '').split(',')
+                if group.strip() ],
+    'claim': os.getenv('O3API_ADMIN_CLAIM', 'eduperson_entitlement'),
+    'rescan_cost': float(os.getenv('O3API_RESCAN_COST', 1.e6))
+}
+
 # list of trusted OIDC providers
 trusted_OP_list = [
 'https://b2access.eudat.eu/oauth2/',
@@ -47,7 +275,8 @@ netCDF_conf = {
     'vmro3' : 'vmro3_zm',
     'tco3_r': 'tco_return',
     't_c'   : 'time',
-    'lat_c' : 'lat'}
+    'lat_c' : 'lat',
+    'plev_c': 'plev'} # pressure levels, in hPa or Pa (units attribute)
 
 # REST API parameters. See also swagger.yml (!)
 api_conf = {
@@ -57,7 +286,18 @@ api_conf = {
     'end'    : 'end',
     'month'  : 'month',
     'lat_min': 'lat_min',
-    'lat_max': 'lat_max'
+    'lat_max': 'lat_max',
+    'level_min': 'level_min', # hPa, vmro3_zm only
+    'level_max': 'level_max',
+    'level_time': 'level_time', # level x time output, vmro3_zm only
+    'bands': 'bands', # latitude bands "lat_min:lat_max", tco3_return only
+    'tres': 'tres', # tiles: time resolution
+    'lres': 'lres', # tiles: latitude resolution
+    'tx': 'tx', # tiles: index in time
+    'ty': 'ty', # tiles: index in latitude
+    'format': 'format', # export: netcdf or parquet
+    'smooth': 'smooth', # smoothing filter, see o3api/smoothing.py
+    'component': 'component' # decompose: trend, seasonal, residual, anomaly
 }
 
 # configuration for plotting
@@ -66,7 +306,19 @@ plot_conf = {
     netCDF_conf['tco3']: {
         'fig_size': [9, 6],
         'xlabel': 'Year',
-        'ylabel': 'tco3_zm (DU)' #Total column Ozone, zonal mean (DU)
+        'ylabel': 'tco3_zm (DU)', #Total column Ozone, zonal mean (DU)
+        'smooth': 'boxcar:3' # default smoothing of the PDF, o3api/smoothing.py
+        },
+    netCDF_conf['vmro3']: {
+        'fig_size': [9, 6],
+        'xlabel': 'Year',
+        'ylabel': 'vmro3_zm (ppmv)', #Ozone volume mixing ratio, zonal mean
+        'level_label': 'Pressure (hPa)'
+        },
+    netCDF_conf['tco3_r']: {
+        'fig_size': [9, 6],
+        'xlabel': 'Latitude band',
+        'ylabel': 'Return year to 1980 (tco3_zm)'
         }
 }
 
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Decomposition of the series of a request (/api/decompose), classical
+# additive decomposition computed for all models at once on a common time
+# axis, (models x time) arrays:
+#   trend     centered moving average over one year (2x12 for monthly
+#             data), NaN where the window is not complete (at the ends
+#             of the series and around missing values)
+#   seasonal  mean of the detrended values per calendar month, centered
+#             to zero: the seasonal cycle (one value per month)
+#   residual  series - trend - seasonal cycle
+#   anomaly   series - seasonal cycle - reference 1980 of the model
+# All components of a request are computed together and cached with a key
+# of the series of the request (see DataSelection._cache_key), the API
+# returns only the requested one.
+
+import logging
+import numpy as np
+import o3api.config as cfg
+import o3api.plots as o3plots
+import o3api.smoothing as o3smoothing
+import pandas as pd
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+COMPONENTS = ['trend', 'seasonal', 'residual', 'anomaly']
+
+
+def decompose(values, times, refs):
+    """Decompose the series (rows) of the array
+
+    :param values: (models, time) array
+    :param times: Time axis (datetime64)
+    :param refs: Reference 1980 of every model
+    :return: trend, seasonal cycle (models, 12: January..December, NaN
+             for months without data), residual, anomaly
+    :rtype: tuple of numpy arrays
+    """
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    n = values.shape[-1]
+    period = o3smoothing.points_per_year(times)
+    trend = o3smoothing.centered(values, period)
+    # no trend where the window is not complete (ends, missing values):
+    # the seasonal cycle would not cancel out
+    half = period//2
+    missing = np.zeros(values.shape[:-1] + (n + 1,), dtype=np.int64)
+    np.cumsum(~valid, axis=-1, out=missing[..., 1:])
+    lo = np.arange(n) - half
+    hi = np.arange(n) + half + 1
+    inside = (lo >= 0) & (hi <= n)
+    incomplete = np.ones(values.shape, dtype=bool)
+    incomplete[..., inside] = (missing[..., hi[inside]] -
+                               missing[..., lo[inside]]) > 0
+    trend[incomplete] = np.nan
+
+    # month of every point: 0 January, ..., 11 December
+    months = np.asarray(times).astype('datetime64[M]').astype(np.int64) % 12
+    in_month = (months[:, np.newaxis] == np.arange(12)).astype(np.float64)
+    detrended = values - trend
+    known = ~np.isnan(detrended)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cycle = ((np.where(known, detrended, 0.) @ in_month)/
+                 (known @ in_month))
+    has_cycle = ~np.isnan(cycle).all(axis=-1, keepdims=True)
+    cycle -= np.nanmean(np.where(has_cycle, cycle, 0.), axis=-1,
+                        keepdims=True)
+    seasonal = cycle[:, months]
+    seasonal[~valid] = np.nan
+    residual = values - trend - seasonal
+    anomaly = values - seasonal - np.asarray(refs, dtype=np.float64)[:,
+                                                                  np.newaxis]
+    return trend, cycle, residual, anomaly
+
+
+def get_components(data, models):
+    """All components of the series of the request
+
+    :param data: Processing object of the request (o3api.plots)
+    :param models: Models of the request
+    :return: component -> DataFrame (time or month x models)
+    :rtype: dict
+    """
+    key = ('decompose',) + tuple(data._cache_key(m, 'raw') for m in models)
+    components = o3plots.get_result(key)
+    if components is None:
+        series = [ data.get_raw_data(m) for m in models ]
+        refs = [ data.get_ref1980(m) for m in models ]
+        times, values, _ = o3smoothing.align(series)
+        trend, cycle, residual, anomaly = decompose(values, times, refs)
+        dtype = o3plots.get_dtype()
+        index = pd.DatetimeIndex(times)
+        components = tuple(
+            pd.DataFrame(array.T.astype(dtype), index=labels,
+                         columns=list(models))
+            for array, labels in [ (trend, index),
+                                   (cycle, pd.Index(np.arange(1, 13))),
+                                   (residual, index),
+                                   (anomaly, index) ])
+        o3plots.put_result(key, components)
+    return dict(zip(COMPONENTS, components))
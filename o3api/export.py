@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Export of the series of many models as one file (/api/export): the
+# parameters of /api/plot give one series per model, all on the same
+# monthly time axis (NaN where a model has no data) with the 1980
+# reference of every model and the request as metadata. The time axis is
+# known from the coordinates of the catalog before any data is read, so
+# the file is written one model at a time: only one series is in memory.
+# netCDF (HDF5) and the Parquet footer need a seekable file, the export is
+# written to a temporary file, sent in chunks and removed.
+#
+# netCDF: <ptype>(model, time) compressed with zlib, ref1980(model)
+# Parquet: one row per point (model, time, <ptype>, ref1980),
+#          one row group per model (needs pyarrow)
+
+import datetime
+import importlib.util
+import json
+import logging
+import netCDF4
+import numpy as np
+import o3api.batch as o3batch
+import o3api.catalog as o3catalog
+import o3api.config as cfg
+import o3api.plots as o3plots
+import os
+import tempfile
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+# configuration for netCDF
+TCO3 = cfg.netCDF_conf['tco3']
+VMRO3 = cfg.netCDF_conf['vmro3']
+
+# configuration for API
+api_c = cfg.api_conf
+
+# format -> file extension, mimetype
+FORMATS = { 'netcdf': ('.nc', 'application/x-netcdf'),
+            'parquet': ('.parquet', 'application/vnd.apache.parquet') }
+
+
+class ExportUnavailable(RuntimeError):
+    """The format is not supported by this installation (HTTP 501)
+    """
+    status = 501
+
+
+def time_axis(plot_type, models, begin, end, months):
+    """Monthly time axis of all models in the period and months,
+    from the coordinates of the catalog (no data is read)
+
+    :return: sorted months, datetime64[M]
+    """
+    times = []
+    for model in models:
+        years, model_months, time_points, _ = \
+            o3catalog.catalog.get_entry(model, plot_type).axes
+        selected = (years >= begin) & (years <= end)
+        if months:
+            selected &= np.isin(model_months, months)
+        times.append(time_points[selected].astype('datetime64[M]'))
+    if not times:
+        return np.array([], dtype='datetime64[M]')
+    return np.unique(np.concatenate(times))
+
+
+def align(series, times):
+    """Values of the series on the time axis, NaN where missing
+
+    :param series: pandas Series indexed by time
+    :param times: Time axis from :func:`time_axis`
+    :rtype: numpy array
+    """
+    values = np.full(times.size, np.nan, dtype=o3plots.get_dtype())
+    if times.size == 0:
+        return values
+    points = series.index.values.astype('datetime64[M]')
+    pos = np.minimum(np.searchsorted(times, points), times.size - 1)
+    found = times[pos] == points
+    values[pos[found]] = series.values[found]
+    return values
+
+
+def iter_series(data, models, times):
+    """Process the models one after the other
+
+    :param data: Processing object of the request (o3api.plots)
+    :param models: Models to process
+    :param times: Time axis from :func:`time_axis`
+    :return: model, aligned values, reference 1980 (generator)
+    """
+    for model in models:
+        yield (model, align(data.get_raw_data(model), times),
+               float(data.get_ref1980(model)))
+
+
+def metadata(plot_type, **kwargs):
+    """Attributes of the export: the request and its origin
+
+    :param plot_type: The plot type of the series
+    :param kwargs: The provided in the API call parameters
+    :rtype: dict
+    """
+    months = kwargs.get(api_c['month']) or []
+    attrs = { 'ptype': plot_type,
+              'begin': int(kwargs[api_c['begin']]),
+              'end': int(kwargs[api_c['end']]),
+              'months': o3batch.months_label(months),
+              'lat_min': float(kwargs[api_c['lat_min']]),
+              'lat_max': float(kwargs[api_c['lat_max']]) }
+    for key in ['level_min', 'level_max']:
+        if kwargs.get(api_c[key]) is not None:
+            attrs[key] = float(kwargs[api_c[key]])
+    attrs['source'] = 'o3api'
+    attrs['created'] = datetime.datetime.utcnow().isoformat() + 'Z'
+    return attrs
+
+
+def write_netcdf(path, plot_type, models, times, series, attrs):
+    """Write the series as netCDF, one model at a time
+
+    :param path: Output file
+    :param plot_type: The plot type of the series
+    :param models: Models in the order of the series
+    :param times: Time axis from :func:`time_axis`
+    :param series: Generator from :func:`iter_series`
+    :param attrs: Global attributes from :func:`metadata`
+    """
+    with netCDF4.Dataset(path, 'w', format='NETCDF4') as nc:
+        nc.setncatts(attrs)
+        nc.createDimension('model', len(models))
+        nc.createDimension('time', times.size)
+        var_time = nc.createVariable('time', 'f8', ('time',))
+        var_time.units = 'days since 1970-01-01 00:00:00'
+        var_time.calendar = 'standard'
+        var_time[:] = times.astype('datetime64[D]').astype(np.float64)
+        var_model = nc.createVariable('model', str, ('model',))
+        values = nc.createVariable(plot_type, o3plots.get_dtype(),
+                                   ('model', 'time'),
+                                   zlib=True, complevel=4, shuffle=True,
+                                   chunksizes=(1, max(times.size, 1)),
+                                   fill_value=np.nan)
+        values.units = cfg.plot_conf[plot_type]['ylabel'].split()[-1] \
+                          .strip('()')
+        ref1980 = nc.createVariable('ref1980', 'f8', ('model',),
+                                    fill_value=np.nan)
+        refs = []
+        for i, (model, model_values, ref) in enumerate(series):
+            var_model[i] = model
+            values[i, :] = model_values
+            ref1980[i] = ref
+            refs.append(ref)
+        if np.isfinite(refs).any():
+            nc.ref1980_mean = float(np.nanmean(refs))
+
+
+def write_parquet(path, plot_type, models, times, series, attrs):
+    """Write the series as Parquet, one row group per model
+
+    Arguments as :func:`write_netcdf`
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    value_type = (pa.float32() if o3plots.get_dtype() == np.float32
+                  else pa.float64())
+    schema = pa.schema([ ('model', pa.string()),
+                         ('time', pa.timestamp('ms')),
+                         (plot_type, value_type),
+                         ('ref1980', pa.float64()) ],
+                       metadata={ 'o3api': json.dumps(attrs) })
+    time_points = times.astype('datetime64[ms]')
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        for model, model_values, ref in series:
+            valid = ~np.isnan(model_values)
+            n_valid = int(valid.sum())
+            writer.write_table(pa.table(
+                { 'model': [model]*n_valid,
+                  'time': time_points[valid],
+                  plot_type: model_values[valid],
+                  'ref1980': np.full(n_valid, ref) }, schema=schema))
+
+
+def check_format(output_format):
+    """Raise an error if the format can not be written
+
+    :param output_format: One of FORMATS
+    """
+    if output_format not in FORMATS:
+        raise o3plots.InvalidRequest("Export formats are {}, got {}".format(
+                                     sorted(FORMATS), output_format))
+    if (output_format == 'parquet' and
+        importlib.util.find_spec('pyarrow') is None):
+        raise ExportUnavailable("Parquet export needs pyarrow, "
+                                "use format=netcdf")
+
+
+def export(plot_type, models, output_format='netcdf', **kwargs):
+    """Write the series of the models to a temporary file
+
+    :param plot_type: The plot type, tco3_zm or vmro3_zm
+    :param models: Models to export
+    :param output_format: One of FORMATS
+    :param kwargs: The provided in the API call parameters
+    :return: path of the temporary file, to be removed by the caller
+    :rtype: string
+    """
+    if plot_type not in [TCO3, VMRO3]:
+        raise o3plots.InvalidRequest("Series are exported for {} and {}, "
+                                     "got {}".format(TCO3, VMRO3, plot_type))
+    check_format(output_format)
+    for model in models:
+        if not o3catalog.catalog.get_entry(model, plot_type).files:
+            raise o3plots.InvalidRequest("No {} data for {}".format(plot_type,
+                                                                  model))
+    times = time_axis(plot_type, models, int(kwargs[api_c['begin']]),
+                      int(kwargs[api_c['end']]),
+                      kwargs.get(api_c['month']) or [])
+    data = o3plots.set_data_processing(plot_type, **kwargs)
+    writer = write_netcdf if output_format == 'netcdf' else write_parquet
+    fd, path = tempfile.mkstemp(suffix=FORMATS[output_format][0],
+                                prefix='o3api-export-',
+                                dir=cfg.export_conf['path'])
+    os.close(fd)
+    try:
+        writer(path, plot_type, models, times,
+               iter_series(data, models, times),
+               metadata(plot_type, **kwargs))
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+def remove_file(path):
+    """Remove the file from :func:`export`, if not removed yet
+
+    :param path: File from :func:`export`
+    """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def stream_file(path, chunk_bytes=None):
+    """Send the file in chunks and remove it. A generator which is never
+    started does not remove the file, see :func:`remove_file`
+
+    :param path: File from :func:`export`
+    :param chunk_bytes: Size of the chunks, default from export_conf
+    :return: chunks of the file (generator)
+    """
+    chunk_bytes = chunk_bytes or cfg.export_conf['chunk_bytes']
+    try:
+        with open(path, 'rb') as f:
+            chunk = f.read(chunk_bytes)
+            while chunk:
+                yield chunk
+                chunk = f.read(chunk_bytes)
+    finally:
+        remove_file(path)
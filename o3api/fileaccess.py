@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Access to netCDF files for the netCDF4 readers (catalog, direct reader).
+# netcdf-c and HDF5 are not thread-safe, also for different files, and
+# netCDF4 releases the GIL, so by default one lock serializes all reads:
+# the lock of the netCDF4 backend of xarray, taken as well by the xarray
+# path (open_mfdataset/dask). With per_file_locks (only for thread-safe
+# netcdf-c/HDF5 builds) every file has its own lock, threads reading
+# the same file take turns. With max_handles > 0
+# open handles are kept in a bounded LRU pool and reused while the file is
+# unchanged (mtime, size), otherwise a handle is closed after every use.
+# Every worker process has its own pool, handles inherited by fork (e.g.
+# opened during a warm-up in the gunicorn master) are dropped in the child.
+# A pooled handle keeps the file locked by HDF5 against writers (also in
+# the same process), so handles idle longer than max_idle are closed; data
+# updates should then replace files (write a new file and rename), which
+# is detected here.
+# The xarray path keeps using the file manager of xarray.
+
+import collections
+import logging
+import netCDF4
+import o3api.config as cfg
+import o3api.filecache as o3filecache
+import os
+import threading
+import time
+from contextlib import contextmanager
+from xarray.backends.netCDF4_ import NETCDF4_PYTHON_LOCK
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+
+class FileAccessManager:
+    """Pool of open netCDF handles, reads serialized by the netCDF lock
+    of xarray or by per-file locks
+
+    :param max_handles: Maximum number of open handles to keep
+    :param per_file_locks: One lock per file (thread-safe netcdf-c/HDF5
+                           only), otherwise the lock of xarray for all files
+    :param max_idle: Close handles not used for this time (s)
+    """
+    def __init__(self, max_handles, per_file_locks=False, max_idle=300.):
+        self.max_handles = max_handles
+        self.per_file_locks = per_file_locks
+        self.max_idle = max_idle
+        self._lock = threading.Lock() # guards the pool and the counters
+        self._global_lock = NETCDF4_PYTHON_LOCK # shared with xarray
+        self._file_locks = {} # path -> lock
+        # path -> ((mtime, size), nc, last use), least recently used first
+        self._handles = collections.OrderedDict()
+        self.opens = 0
+        self.reuses = 0
+        self.evictions = 0
+        self.lock_waits = 0
+        self.lock_wait_s = 0.
+        self._pid = os.getpid()
+
+    def _after_fork(self):
+        """Drop the pool inherited from the parent process without closing
+        the handles, they belong to the parent (e.g. gunicorn --preload)
+        """
+        self._lock = threading.Lock()
+        self._file_locks = {}
+        self._handles = collections.OrderedDict()
+        self._pid = os.getpid()
+
+    def _file_lock(self, path):
+        if not self.per_file_locks:
+            return self._global_lock
+        with self._lock:
+            return self._file_locks.setdefault(path, threading.Lock())
+
+    @staticmethod
+    def _acquire(lock):
+        """Acquire the lock, the locks of a combined lock (xarray) one
+        by one in its order
+
+        :return: whether the lock was held by another thread
+        """
+        waited = False
+        for part in getattr(lock, 'locks', (lock,)):
+            if not part.acquire(blocking=False):
+                part.acquire()
+                waited = True
+        return waited
+
+    def _evict(self, keep):
+        """Close the least recently used handles not in use,
+        until the pool is within max_handles and has no idle handles
+        """
+        victims = []
+        idle_since = time.monotonic() - self.max_idle
+        with self._lock:
+            for path, entry in list(self._handles.items()):
+                if (len(self._handles) <= self.max_handles and
+                    entry[2] > idle_since):
+                    break
+                if path == keep:
+                    continue
+                file_lock = None # with the global lock held by the caller
+                if self.per_file_locks:
+                    file_lock = self._file_locks[path]
+                    if not file_lock.acquire(blocking=False):
+                        continue # in use, keep it
+                victims.append((self._handles.pop(path)[1], file_lock))
+                self.evictions += 1
+        for nc, file_lock in victims:
+            try:
+                nc.close()
+            finally:
+                if file_lock is not None:
+                    file_lock.release()
+
+    def _get_handle(self, path):
+        """Return an open handle of the file, the file lock is held
+        """
+        stat = os.stat(path)
+        fingerprint = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            entry = self._handles.pop(path, None)
+            if entry is not None and entry[0] == fingerprint:
+                self._handles[path] = (fingerprint, entry[1], time.monotonic())
+                self.reuses += 1
+                nc = entry[1]
+                entry = None
+            else:
+                nc = None
+        if entry is not None:
+            logger.debug("[FILEACCESS] {} changed, reopening".format(path))
+            entry[1].close()
+
+        if nc is None:
+            nc = netCDF4.Dataset(o3filecache.local_path(path))
+            with self._lock:
+                self._handles[path] = (fingerprint, nc, time.monotonic())
+                self.opens += 1
+        self._evict(keep=path)
+        return nc
+
+    @contextmanager
+    def open(self, path):
+        """Context manager giving the open netCDF4 dataset of the file,
+        the file is locked for the calling thread meanwhile.
+        Do not close the dataset, it is returned to the pool.
+
+        :param path: Path to the netCDF file
+        :return: netCDF4 dataset
+        """
+        if self._pid != os.getpid(): # forked without the fork hook
+            self._after_fork()
+        file_lock = self._file_lock(path)
+        time_start = time.monotonic()
+        if self._acquire(file_lock):
+            with self._lock:
+                self.lock_waits += 1
+                self.lock_wait_s += time.monotonic() - time_start
+        try:
+            yield self._get_handle(path)
+        finally:
+            try:
+                if self.max_handles <= 0: # no pool, close after use
+                    with self._lock:
+                        entry = self._handles.pop(path, None)
+                    if entry is not None:
+                        entry[1].close()
+            finally:
+                file_lock.release()
+
+    def discard(self, paths):
+        """Close the handles of the files (e.g. removed or replaced),
+        handles in use are closed later, when the file is found changed
+
+        :param paths: Paths to the netCDF files
+        :return: number of closed handles
+        """
+        if not self.per_file_locks:
+            # one lock for all files: wait until no file is read
+            self._acquire(self._global_lock)
+            try:
+                return self._discard(paths)
+            finally:
+                self._global_lock.release()
+        return self._discard(paths)
+
+    def _discard(self, paths):
+        """Close the handles of the files not in use, see :meth:`discard`
+        """
+        victims = []
+        with self._lock:
+            for path in paths:
+                if path not in self._handles:
+                    continue
+                file_lock = None
+                if self.per_file_locks:
+                    file_lock = self._file_locks[path]
+                    if not file_lock.acquire(blocking=False):
+                        continue # in use, keep it
+                victims.append((self._handles.pop(path)[1], file_lock))
+        for nc, file_lock in victims:
+            try:
+                nc.close()
+            finally:
+                if file_lock is not None:
+                    file_lock.release()
+        return len(victims)
+
+    def close_all(self):
+        """Close all handles not in use
+        """
+        max_handles = self.max_handles
+        self.max_handles = 0
+        try:
+            if self.per_file_locks:
+                self._evict(keep=None)
+            else:
+                self._acquire(self._global_lock)
+                try:
+                    self._evict(keep=None)
+                finally:
+                    self._global_lock.release()
+        finally:
+            self.max_handles = max_handles
+
+    def stats(self):
+        """Return counters of the pool
+
+        :rtype: dict
+        """
+        with self._lock:
+            return { 'open_handles': len(self._handles),
+                     'max_handles': self.max_handles,
+                     'opens': self.opens,
+                     'reuses': self.reuses,
+                     'evictions': self.evictions,
+                     'lock_waits': self.lock_waits,
+                     'lock_wait_s': round(self.lock_wait_s, 4) }
+
+
+file_manager = FileAccessManager(cfg.file_access_conf['max_handles'],
+                                 cfg.file_access_conf['per_file_locks'],
+                                 cfg.file_access_conf['max_idle'])
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=file_manager._after_fork)
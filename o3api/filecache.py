@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Local copies of data files served from a slow mount (e.g. sshfs).
+# Random small reads of netCDF over a network mount are slow, so a file
+# is copied at first use (one sequential read) into a local directory and
+# read from there. A copy keeps mtime and size of the original and is
+# valid while they match. When a file is read, the other files of the
+# model directory are copied in the background (read-ahead).
+# The copies are evicted in LRU order (by access time, set on every use)
+# to stay within max_bytes. Worker processes of a node share the directory:
+# copies are written to a temporary file and renamed into place.
+
+import glob
+import hashlib
+import logging
+import o3api.config as cfg
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+# configuration for netCDF
+PLOT_TYPES = [cfg.netCDF_conf['tco3'],
+              cfg.netCDF_conf['vmro3'],
+              cfg.netCDF_conf['tco3_r']]
+
+
+class LocalFileCache:
+    """Cache of data files in a local directory
+
+    :param directory: Local directory for the copies
+    :param max_bytes: Budget for all copies together
+    :param prefetch: Copy the other files of a model in the background
+    :param prefetch_workers: Number of threads copying in the background
+    """
+    def __init__(self, directory, max_bytes, prefetch=True, prefetch_workers=2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.prefetch = prefetch
+        self.prefetch_workers = prefetch_workers
+        self._lock = threading.Lock()
+        self._path_locks = {} # remote path -> lock
+        self._queued = set()
+        self._executor = None
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.evictions = 0
+        self.errors = 0
+        self.bytes_copied = 0
+
+    def cache_path(self, path):
+        """Local path of the copy of the file
+
+        :param path: Path to the original file
+        :rtype: string
+        """
+        name = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory,
+                            name + "-" + os.path.basename(path))
+
+    def _path_lock(self, path):
+        with self._lock:
+            return self._path_locks.setdefault(path, threading.Lock())
+
+    @staticmethod
+    def _valid(stat, local_path):
+        """Whether the copy matches the original (mtime, size)
+        """
+        try:
+            local = os.stat(local_path)
+        except OSError:
+            return False
+        return (local.st_size == stat.st_size and
+                local.st_mtime == stat.st_mtime)
+
+    def _copy(self, path, tmp_path):
+        """Copy the file, data and times (overridden in tests to
+        simulate a slow mount)
+        """
+        shutil.copy2(path, tmp_path)
+
+    def _evict(self, needed):
+        """Remove the least recently used copies to free `needed` bytes
+        """
+        entries = []
+        for local_path in glob.glob(os.path.join(self.directory, "*")):
+            if local_path.endswith(".tmp"):
+                continue
+            try:
+                stat = os.stat(local_path)
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, local_path))
+        used = sum(e[1] for e in entries)
+        for _, size, local_path in sorted(entries):
+            if used + needed <= self.max_bytes:
+                break
+            try:
+                os.remove(local_path)
+            except OSError:
+                continue
+            used -= size
+            with self._lock:
+                self.evictions += 1
+            logger.debug("[FILECACHE] evicted {}".format(local_path))
+        return used + needed <= self.max_bytes
+
+    def _fetch(self, path, stat):
+        """Copy the file into the cache, if it fits
+
+        :return: local path or None
+        """
+        local_path = self.cache_path(path)
+        with self._path_lock(path):
+            if self._valid(stat, local_path):
+                return local_path
+            if stat.st_size > self.max_bytes:
+                return None
+            os.makedirs(self.directory, exist_ok=True)
+            if not self._evict(stat.st_size):
+                return None
+            tmp_path = local_path + ".{}.{}.tmp".format(os.getpid(),
+                                                        threading.get_ident())
+            try:
+                self._copy(path, tmp_path)
+                os.replace(tmp_path, local_path)
+            except OSError as e:
+                logger.warning("[FILECACHE] failed to copy {}: {}".format(path,
+                                                                          e))
+                with self._lock:
+                    self.errors += 1
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                return None
+        with self._lock:
+            self.bytes_copied += stat.st_size
+        self._touch(local_path, stat)
+        return local_path
+
+    @staticmethod
+    def _touch(local_path, stat):
+        """Mark the copy as used (access time), keep the modification time
+        """
+        try:
+            os.utime(local_path, (time.time(), stat.st_mtime))
+        except OSError:
+            pass
+
+    def _prefetch_one(self, path):
+        try:
+            stat = os.stat(path)
+            if (not self._valid(stat, self.cache_path(path)) and
+                self._fetch(path, stat) is not None):
+                with self._lock:
+                    self.prefetched += 1
+        except OSError as e:
+            logger.debug("[FILECACHE] prefetch of {} failed: {}".format(path,
+                                                                        e))
+        finally:
+            with self._lock:
+                self._queued.discard(path)
+
+    def _prefetch_model(self, path):
+        """Queue the copy of the other files of the model
+        (same directory and plot type)
+        """
+        name = os.path.basename(path)
+        prefix = next((p for p in PLOT_TYPES if name.startswith(p)), "")
+        pattern = os.path.join(os.path.dirname(path), prefix + "*.nc")
+        for other in sorted(glob.glob(pattern)):
+            if other == path:
+                continue
+            with self._lock:
+                if other in self._queued:
+                    continue
+                self._queued.add(other)
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                                         max_workers=self.prefetch_workers,
+                                         thread_name_prefix='o3api-prefetch')
+                executor = self._executor
+            try:
+                executor.submit(self._prefetch_one, other)
+            except RuntimeError: # shut down meanwhile
+                with self._lock:
+                    self._queued.discard(other)
+
+    def local_path(self, path):
+        """Path to read the file from: the valid local copy,
+        copied now if needed, or the original if it can not be cached
+
+        :param path: Path to the original file
+        :rtype: string
+        """
+        stat = os.stat(path)
+        local_path = self.cache_path(path)
+        if self._valid(stat, local_path):
+            with self._lock:
+                self.hits += 1
+        else:
+            with self._lock:
+                self.misses += 1
+            local_path = self._fetch(path, stat)
+            if self.prefetch:
+                self._prefetch_model(path)
+            if local_path is None:
+                return path
+        self._touch(local_path, stat)
+        return local_path
+
+    def discard(self, path):
+        """Remove the copy of the file, if the original has changed
+        or does not exist anymore
+
+        :param path: Path to the original file
+        :return: whether a copy was removed
+        """
+        local_path = self.cache_path(path)
+        with self._path_lock(path):
+            try:
+                if self._valid(os.stat(path), local_path):
+                    return False
+            except OSError:
+                pass # removed
+            try:
+                os.remove(local_path)
+            except OSError:
+                return False
+        logger.debug("[FILECACHE] removed the copy of {}".format(path))
+        return True
+
+    def wait_prefetch(self):
+        """Wait for the queued background copies (e.g. in tests)
+        """
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def stats(self):
+        """Return cache statistics of this process
+
+        :rtype: dict
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return { 'hits': self.hits,
+                     'misses': self.misses,
+                     'hit_ratio': (round(self.hits/lookups, 4)
+                                   if lookups else 0.),
+                     'prefetched': self.prefetched,
+                     'queued': len(self._queued),
+                     'evictions': self.evictions,
+                     'errors': self.errors,
+                     'bytes_copied': self.bytes_copied,
+                     'max_bytes': self.max_bytes }
+
+
+file_cache = LocalFileCache(cfg.file_cache_conf['path'],
+                            cfg.file_cache_conf['max_bytes'],
+                            cfg.file_cache_conf['prefetch'],
+                            cfg.file_cache_conf['prefetch_workers'])
+
+
+def local_path(path):
+    """Path to read the data file from, see :meth:`LocalFileCache.local_path`
+
+    :param path: Path to the original file
+    :return: local copy if the cache is enabled, otherwise the path itself
+    """
+    if not cfg.file_cache_conf['enabled']:
+        return path
+    return file_cache.local_path(path)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Operators of latitude grids. Models come on different latitude axes,
+# ordered (-90..90) or (90..-90). For every distinct axis (hashed) the
+# sorted order, the area weights (cos(lat)) and the selection of latitude
+# bands are computed once and shared by all models on the same grid.
+# A band is a contiguous index range of the axis with the weights of its
+# latitudes (zero for points of the range outside the band), so the mean
+# over a band is a dot product of the weights with the values of the
+# range, NaNs skipped.
+# weighting (lat_grid_conf): 'cos' area weights, 'none' equal weights
+# (plain mean over the latitudes). The bands of a grid are kept in an LRU
+# of max_bands entries, lat_min and lat_max come from the requests.
+
+import collections
+import hashlib
+import logging
+import numpy as np
+import o3api.config as cfg
+import threading
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+WEIGHTINGS = ['cos', 'none']
+
+# index: slice of the axis, mask: selected points of the whole axis,
+# weights: weights of the points of the slice
+Band = collections.namedtuple('Band', ['index', 'mask', 'weights'])
+
+
+def area_weights(lats, weighting):
+    """Weights of the latitudes
+
+    :param lats: Latitudes (degrees)
+    :param weighting: 'cos' (area of the latitude) or 'none'
+    :return: weights, >= 0
+    :rtype: numpy array
+    """
+    if weighting not in WEIGHTINGS:
+        raise ValueError("Latitude weightings are {}, got {}".format(
+                         WEIGHTINGS, weighting))
+    lats = np.asarray(lats, dtype=np.float64)
+    if weighting == 'none':
+        return np.ones_like(lats)
+    return np.clip(np.cos(np.deg2rad(lats)), 0., None)
+
+
+def weighted_mean(values, weights):
+    """Weighted mean over the first axis skipping NaNs, accumulated
+    in float64
+
+    :param values: (lat, ...) array
+    :param weights: Weights of the latitudes
+    :return: (...) array of float64, NaN where no data
+    """
+    if values.size == 0: # nothing selected
+        return np.full(values.shape[1:], np.nan)
+    valid = ~np.isnan(values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if valid.all(): # usual case, the same sum of weights everywhere
+            return np.tensordot(weights, values, axes=1)/weights.sum()
+        sums = np.tensordot(weights, np.where(valid, values, 0.), axes=1)
+        return sums/np.tensordot(weights, valid, axes=1)
+
+
+class LatGrid:
+    """Operators of one latitude axis
+
+    :param lats: Latitudes in the order of the data
+    :param weighting: see :func:`area_weights`
+    :param max_bands: Maximum number of bands to keep
+    """
+    def __init__(self, lats, weighting,
+                 max_bands=cfg.lat_grid_conf['max_bands']):
+        self.lats = np.array(lats, dtype=np.float64)
+        self.order = np.argsort(self.lats, kind='stable')
+        self.sorted_lats = self.lats[self.order]
+        self.weights = area_weights(self.lats, weighting)
+        for array in [self.lats, self.order, self.sorted_lats, self.weights]:
+            array.flags.writeable = False # shared by all requests
+        self.max_bands = max_bands
+        self._bands = collections.OrderedDict() # (lat_min, lat_max) -> Band
+        self._lock = threading.Lock()
+
+    def band(self, lat_min, lat_max):
+        """Selection of the latitudes lat_min <= lat <= lat_max
+
+        :param lat_min: Minimum latitude
+        :param lat_max: Maximum latitude
+        :rtype: :class:`Band`
+        """
+        key = (float(lat_min), float(lat_max))
+        with self._lock:
+            band = self._bands.get(key)
+            if band is not None:
+                self._bands.move_to_end(key)
+                return band
+        start = np.searchsorted(self.sorted_lats, lat_min, side='left')
+        stop = np.searchsorted(self.sorted_lats, lat_max, side='right')
+        selected = self.order[start:stop]
+        mask = np.zeros(self.lats.size, dtype=bool)
+        mask[selected] = True
+        index = (slice(selected.min(), selected.max() + 1)
+                 if selected.size else slice(0, 0))
+        weights = np.where(mask[index], self.weights[index], 0.)
+        mask.flags.writeable = False
+        weights.flags.writeable = False
+        with self._lock:
+            band = self._bands.setdefault(key, Band(index, mask, weights))
+            self._bands.move_to_end(key)
+            while len(self._bands) > self.max_bands:
+                self._bands.popitem(last=False)
+        return band
+
+    def band_matrix(self, bands):
+        """Weights of several bands over the whole axis
+
+        :param bands: Bands as (lat_min, lat_max)
+        :return: (band, lat) array, zero outside of a band
+        """
+        return np.array([ np.where(self.band(lat_a, lat_b).mask,
+                                   self.weights, 0.)
+                          for lat_a, lat_b in bands ], dtype=np.float64)
+
+
+class GridCache:
+    """Thread-safe LRU cache of the operators of latitude grids,
+    keyed by the hash of the latitude axis
+
+    :param max_grids: Maximum number of grids to keep
+    :param weighting: see :func:`area_weights`
+    :param max_bands: Maximum number of bands kept per grid
+    """
+    def __init__(self, max_grids, weighting,
+                 max_bands=cfg.lat_grid_conf['max_bands']):
+        area_weights([], weighting) # check the weighting
+        self.max_grids = max_grids
+        self.weighting = weighting
+        self.max_bands = max_bands
+        self._grids = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.builds = 0
+
+    def get(self, lats):
+        """Operators of the latitude axis, computed at first use
+
+        :param lats: Latitudes in the order of the data
+        :rtype: :class:`LatGrid`
+        """
+        lats = np.ascontiguousarray(lats, dtype=np.float64)
+        key = hashlib.sha1(lats.tobytes()).hexdigest()
+        with self._lock:
+            grid = self._grids.get(key)
+            if grid is not None:
+                self._grids.move_to_end(key)
+                self.hits += 1
+                return grid
+        grid = LatGrid(lats, self.weighting, self.max_bands)
+        with self._lock:
+            grid = self._grids.setdefault(key, grid)
+            self._grids.move_to_end(key)
+            self.builds += 1
+            while len(self._grids) > self.max_grids:
+                self._grids.popitem(last=False)
+        logger.debug("[LATGRID] grid of {} latitudes ({} .. {})".format(
+                     lats.size, lats[:1], lats[-1:]))
+        return grid
+
+    def stats(self):
+        """Return the cache statistics
+
+        :rtype: dict
+        """
+        with self._lock:
+            return { 'grids': len(self._grids),
+                     'weighting': self.weighting,
+                     'hits': self.hits,
+                     'builds': self.builds }
+
+
+grids = GridCache(cfg.lat_grid_conf['max_grids'],
+                  cfg.lat_grid_conf['weighting'],
+                  cfg.lat_grid_conf['max_bands'])
+
+
+def get_grid(lats):
+    """Operators of the latitude axis from :data:`grids`
+
+    :param lats: Latitudes in the order of the data
+    :rtype: :class:`LatGrid`
+    """
+    return grids.get(lats)
@@ -0,0 +1,616 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Load generator for o3api.
+# Starts the application locally against synthetic data (authentication
+# disabled), replays a configurable mix of API calls at a given concurrency
+# or rate, and reports latency percentiles, throughput, error rate and
+# worker RSS. Results can be stored as JSON and compared to a baseline.
+#
+# Example:
+# $ o3api-loadtest --workers 4 --concurrency 8 --duration 60 \
+#                  --mix plot_json=6,plot_pdf=1,list_models=2,get_model_info=1 \
+#                  --output run.json --baseline baseline.json
+
+import argparse
+import json
+import logging
+import numpy as np
+import os
+import random
+import shutil
+import socket
+import subprocess  # nosec
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import o3api.config as cfg
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+# configuration for netCDF
+TIME = cfg.netCDF_conf['t_c']
+LAT = cfg.netCDF_conf['lat_c']
+TCO3 = cfg.netCDF_conf['tco3']
+
+# configuration for API
+PTYPE = cfg.api_conf['plot_t']
+MODEL = cfg.api_conf['model']
+BEGIN = cfg.api_conf['begin']
+END = cfg.api_conf['end']
+MONTH = cfg.api_conf['month']
+LAT_MIN = cfg.api_conf['lat_min']
+LAT_MAX = cfg.api_conf['lat_max']
+
+# request kinds known to the load generator
+REQUEST_KINDS = ['plot_json', 'plot_pdf', 'list_models', 'get_model_info']
+DEFAULT_MIX = 'plot_json=6,plot_pdf=1,list_models=2,get_model_info=1'
+PERCENTILES = [50, 95, 99]
+
+
+def make_synthetic_data(base_path, models=4, begin=1960, end=2100,
+                        lat_step=5, files_per_model=2):
+    """Create synthetic tco3_zm netCDF files, one directory per model
+
+    :param base_path: Directory to store the data in
+    :param models: Number of models to create
+    :param begin: First year of the data
+    :param end: Last year of the data
+    :param lat_step: Latitude resolution in degrees
+    :param files_per_model: Number of files the time axis is split into
+    :return: list of created model names
+    :rtype: list
+    """
+    import xarray as xr
+
+    lats = np.arange(-90, 90 + lat_step, lat_step, dtype=float)
+    times = np.arange("{}-01".format(begin), "{}-01".format(end + 1),
+                      dtype='datetime64[M]').astype('datetime64[ns]')
+    rng = np.random.default_rng(42)
+    model_names = []
+    for i in range(models):
+        model = "o3api-synthetic-{:02d}".format(i)
+        m_path = os.path.join(base_path, model)
+        os.makedirs(m_path, exist_ok=True)
+        # seasonal cycle on top of a latitude profile plus some noise
+        season = 20.*np.sin(2.*np.pi*np.arange(times.size)/12.)
+        profile = 300. - 50.*np.cos(np.deg2rad(lats))
+        values = (profile[:, np.newaxis] + season[np.newaxis, :] +
+                  rng.normal(0., 5., (lats.size, times.size)) + i)
+        for ichunk, t_idx in enumerate(np.array_split(np.arange(times.size),
+                                                      files_per_model)):
+            ds = xr.Dataset({TCO3: ((LAT, TIME), values[:, t_idx])},
+                            coords={LAT: lats, TIME: times[t_idx]})
+            ds.to_netcdf(os.path.join(m_path, "{}-synthetic-{}.nc".format(
+                                      TCO3, ichunk)))
+            ds.close()
+        model_names.append(model)
+
+    return model_names
+
+
+def parse_mix(mix):
+    """Parse the request mix, e.g. 'plot_json=6,list_models=1'
+
+    :param mix: Comma separated kind=weight pairs
+    :return: kinds and corresponding normalized weights
+    :rtype: tuple(list, list)
+    """
+    kinds = []
+    weights = []
+    for item in filter(None, mix.split(',')):
+        kind, _, weight = item.partition('=')
+        kind = kind.strip()
+        if kind not in REQUEST_KINDS:
+            raise ValueError("Unknown request kind '{}', choose from {}"
+                             .format(kind, REQUEST_KINDS))
+        kinds.append(kind)
+        weights.append(float(weight) if weight else 1.)
+
+    total = sum(weights)
+    if total <= 0:
+        raise ValueError("Request mix '{}' has no positive weights".format(mix))
+    return kinds, [w/total for w in weights]
+
+
+def build_request(kind, models, rng, max_models=3, begin=1960, end=2100):
+    """Build the request (path, query, headers) for the given kind
+
+    :param kind: One of REQUEST_KINDS
+    :param models: Models available to choose from
+    :param rng: random.Random instance
+    :return: path, list of query parameters, headers
+    :rtype: tuple
+    """
+    headers = {'Accept': 'application/json'}
+    if kind == 'list_models':
+        return '/api/list_models', [], headers
+    if kind == 'get_model_info':
+        return ('/api/get_model_info',
+                [(PTYPE, TCO3), (MODEL, rng.choice(models))], headers)
+
+    n_models = rng.randint(1, min(max_models, len(models)))
+    year_a = rng.randint(begin, end - 1)
+    year_b = rng.randint(year_a + 1, end)
+    lat_a = rng.randrange(-90, 80, 10)
+    lat_b = rng.randrange(lat_a + 10, 91, 10)
+    query = [(PTYPE, TCO3), (BEGIN, year_a), (END, year_b),
+             (LAT_MIN, lat_a), (LAT_MAX, lat_b)]
+    query += [(MODEL, m) for m in rng.sample(models, n_models)]
+    if rng.random() < 0.3:
+        query.append((MONTH, rng.randint(1, 12)))
+    if kind == 'plot_pdf':
+        headers = {'Accept': 'application/pdf'}
+    return '/api/plot', query, headers
+
+
+def send_request(url, path, query, headers, body=None, timeout=600,
+                 time_start=None):
+    """POST a request and measure the latency
+
+    :param url: Base URL of the service, e.g. http://127.0.0.1:5005
+    :param path: API path
+    :param query: list of (key, value) query parameters
+    :param headers: HTTP headers
+    :param body: JSON body (e.g. of /api/plot_batch), empty if None
+    :param time_start: Start of the latency (time.perf_counter), e.g. the
+                       scheduled send time of an open-loop run, now if None
+    :return: HTTP status (0 if no response), latency in seconds, bytes read
+    :rtype: tuple
+    """
+    full_url = url.rstrip('/') + path
+    if query:
+        full_url += '?' + urllib.parse.urlencode(query)
+    data = b'' if body is None else json.dumps(body).encode('utf-8')
+    req = urllib.request.Request(full_url, data=data, headers=headers,
+                                 method='POST')
+    if time_start is None:
+        time_start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:  # nosec
+            body = resp.read()
+            status = resp.status
+    except urllib.error.HTTPError as e:
+        body = e.read()
+        status = e.code
+    except (urllib.error.URLError, OSError) as e:
+        logger.debug("Request to {} failed: {}".format(full_url, e))
+        body = b''
+        status = 0
+    return status, time.perf_counter() - time_start, len(body)
+
+
+def _children_pids(pid):
+    """Return the PIDs of all (recursive) children of the process (Linux)
+    """
+    children = []
+    try:
+        for task in os.listdir("/proc/{}/task".format(pid)):
+            with open("/proc/{}/task/{}/children".format(pid, task)) as f:
+                children += [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+    return children + [c for p in children for c in _children_pids(p)]
+
+
+def get_rss(pid):
+    """Return the resident set size (bytes) of the process (Linux)
+
+    :param pid: Process ID
+    :return: RSS in bytes or None, if not available
+    """
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return None
+
+
+class RSSSampler(threading.Thread):
+    """Background thread sampling RSS of the server and its workers
+
+    :param pid: PID of the server (gunicorn master) process
+    :param interval: Sampling interval in seconds
+    """
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = {}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.sample()
+            self._stop_event.wait(self.interval)
+
+    def sample(self):
+        """Take one sample of all worker processes
+        """
+        for pid in [self.pid] + _children_pids(self.pid):
+            rss = get_rss(pid)
+            if rss is not None:
+                self.peak[pid] = max(rss, self.peak.get(pid, 0))
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.sample()
+        return self.summary()
+
+    def summary(self):
+        """Summarize the peak RSS per process
+
+        :return: peak RSS values in MiB
+        :rtype: dict
+        """
+        workers = [v for k, v in self.peak.items() if k != self.pid]
+        mib = 1024.*1024.
+        return {
+            'master_rss_mib': round(self.peak.get(self.pid, 0)/mib, 1),
+            'workers': len(workers),
+            'worker_rss_max_mib': round(max(workers, default=0)/mib, 1),
+            'worker_rss_total_mib': round(sum(workers)/mib, 1)
+        }
+
+
+def _free_port():
+    """Find a free TCP port on localhost
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(data_path, workers=1, threads=1, port=None, timeout=120,
+                 admission=False, scheduler=False):
+    """Start o3api locally with authentication disabled
+
+    Uses gunicorn (as start.sh does) when available,
+    otherwise the Flask development server. All load comes from one
+    identity (127.0.0.1), so admission control would answer with 429s
+    once its budget is spent: it is off unless asked for.
+
+    :param data_path: Value for O3AS_DATA_BASEPATH
+    :param workers: Number of gunicorn workers
+    :param threads: Number of threads per gunicorn worker
+    :param port: TCP port, a free one is chosen if None
+    :param admission: Keep admission control (O3API_ADMISSION)
+    :param scheduler: Keep the request scheduler (O3API_SCHEDULER)
+    :return: server process and its base URL
+    """
+    port = port or _free_port()
+    env = dict(os.environ,
+               O3AS_DATA_BASEPATH=data_path,
+               O3API_LISTEN_IP='127.0.0.1',
+               O3API_PORT=str(port),
+               O3API_ADMISSION=str(admission).lower(),
+               O3API_SCHEDULER=str(scheduler).lower(),
+               DISABLE_AUTHENTICATION_AND_ASSUME_AUTHENTICATED_USER='yes')
+    if shutil.which('gunicorn'):
+        cmd = ['gunicorn', '--bind', '127.0.0.1:{}'.format(port),
+               '-w', str(workers), '--threads', str(threads),
+               '--timeout', str(timeout), 'o3api:create_app()']
+    else:
+        logger.warning("gunicorn is not found, using Flask server instead")
+        cmd = [sys.executable, '-c',
+               'import o3api; o3api.create_app().run(host="127.0.0.1", '
+               'port={}, threaded=True)'.format(port)]
+
+    proc = subprocess.Popen(cmd, env=env, cwd=cfg.O3API_BASE_DIR)  # nosec
+    url = "http://127.0.0.1:{}".format(port)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("o3api server exited with code {}"
+                               .format(proc.returncode))
+        status, _, _ = send_request(url, '/api/list_models', [], {}, timeout=5)
+        if status == 200:
+            return proc, url
+        time.sleep(0.5)
+
+    proc.terminate()
+    raise RuntimeError("o3api server did not start within {}s".format(timeout))
+
+
+def percentiles(latencies):
+    """Latency percentiles in milliseconds
+
+    :param latencies: list of latencies in seconds
+    :return: p50, p95, p99 (None if no data)
+    :rtype: dict
+    """
+    if len(latencies) == 0:
+        return {"p{}_ms".format(p): None for p in PERCENTILES}
+    values = np.percentile(np.asarray(latencies)*1000., PERCENTILES)
+    return {"p{}_ms".format(p): round(float(v), 2)
+            for p, v in zip(PERCENTILES, values)}
+
+
+def summarize(results, elapsed):
+    """Summarize the collected results
+
+    :param results: list of (kind, status, latency, size) tuples
+    :param elapsed: Wall time of the run in seconds
+    :return: overall and per-kind statistics
+    :rtype: dict
+    """
+    def _stats(items):
+        latencies = [r[2] for r in items]
+        errors = sum(1 for r in items if r[1] != 200)
+        stats = {
+            'requests': len(items),
+            'errors': errors,
+            'error_rate': round(errors/len(items), 4) if items else 0.,
+            'throughput_rps': round(len(items)/elapsed, 3) if elapsed else 0.
+        }
+        stats.update(percentiles(latencies))
+        return stats
+
+    summary = _stats(results)
+    summary['elapsed_s'] = round(elapsed, 3)
+    summary['kinds'] = {kind: _stats([r for r in results if r[0] == kind])
+                        for kind in sorted(set(r[0] for r in results))}
+    return summary
+
+
+def run_load(url, models, mix=DEFAULT_MIX, concurrency=4, rate=None,
+             duration=30., requests=None, seed=0, timeout=600):
+    """Replay the request mix against a running service
+
+    In the closed-loop mode (rate is None) every one of `concurrency`
+    clients issues requests back to back. With the `rate` given, requests
+    are started on a fixed schedule (open loop) with at most `concurrency`
+    requests in flight, the latency is measured from the scheduled time,
+    so that a service falling behind is not hidden by the waiting queue.
+
+    :param url: Base URL of the service
+    :param models: Models to use in requests
+    :param mix: Request mix, see :func:`parse_mix`
+    :param concurrency: Number of concurrent clients
+    :param rate: Target request rate (requests per second) or None
+    :param duration: Maximum duration of the run in seconds
+    :param requests: Maximum number of requests, unlimited if None
+    :return: list of (kind, status, latency, size) and elapsed time
+    """
+    kinds, weights = parse_mix(mix)
+    rng = random.Random(seed)  # nosec
+    lock = threading.Lock()
+    results = []
+    plan = []
+
+    # build the request plan in advance, to be reproducible across runs
+    n_plan = requests if requests else max(int((rate or 50)*duration), 1000)
+    for kind in rng.choices(kinds, weights, k=n_plan):
+        plan.append((kind,) + build_request(kind, models, rng))
+
+    def _execute(item, time_scheduled=None):
+        kind, path, query, headers = item
+        status, latency, size = send_request(url, path, query, headers,
+                                             timeout=timeout,
+                                             time_start=time_scheduled)
+        with lock:
+            results.append((kind, status, latency, size))
+
+    time_start = time.perf_counter()
+    deadline = time_start + duration
+    if rate:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for i, item in enumerate(plan):
+                t_next = time_start + i/rate
+                if t_next >= deadline:
+                    break
+                time.sleep(max(0., t_next - time.perf_counter()))
+                pool.submit(_execute, item, t_next)
+    else:
+        counter = iter(plan)
+
+        def _client():
+            while time.perf_counter() < deadline:
+                with lock:
+                    item = next(counter, None)
+                if item is None:
+                    return
+                _execute(item)
+
+        clients = [threading.Thread(target=_client)
+                   for _ in range(concurrency)]
+        [ c.start() for c in clients ]
+        [ c.join() for c in clients ]
+
+    return results, time.perf_counter() - time_start
+
+
+def compare(current, baseline):
+    """Compare the summary of the current run to a baseline one
+
+    :param current: summary of the current run
+    :param baseline: summary of the baseline run
+    :return: relative change (current/baseline - 1) of the key metrics
+    :rtype: dict
+    """
+    keys = ["p{}_ms".format(p) for p in PERCENTILES]
+    keys += ['throughput_rps', 'error_rate']
+    diff = {}
+    for key in keys:
+        cur = current.get(key)
+        base = baseline.get(key)
+        if cur is None or not base:
+            diff[key] = None
+        else:
+            diff[key] = round(cur/base - 1., 4)
+    return diff
+
+
+def regressed(current, baseline, threshold):
+    """Check the current run for a regression against a baseline one
+
+    :param current: summary of the current run
+    :param baseline: summary of the baseline run
+    :param threshold: tolerated relative change, e.g. 0.1
+    :return: metrics worse than the baseline by more than the threshold
+    :rtype: list
+    """
+    worse = []
+    for key in ["p{}_ms".format(p) for p in PERCENTILES] + ['error_rate']:
+        cur = current.get(key)
+        base = baseline.get(key)
+        if cur is not None and base is not None and \
+           cur > 0 and cur > base*(1. + threshold):
+            worse.append(key)
+    cur = current.get('throughput_rps')
+    base = baseline.get('throughput_rps')
+    if cur is not None and base and cur < base*(1. - threshold):
+        worse.append('throughput_rps')
+    return worse
+
+
+def print_report(summary, diff=None, stream=sys.stdout):
+    """Print human readable report
+    """
+    line = "{:<16} {:>8} {:>7} {:>10} {:>10} {:>10} {:>10}"
+    print(line.format('kind', 'requests', 'errors', 'rps',
+                      'p50 ms', 'p95 ms', 'p99 ms'), file=stream)
+    rows = list(summary['kinds'].items()) + [('total', summary)]
+    for kind, s in rows:
+        print(line.format(kind, s['requests'], s['errors'],
+                          s['throughput_rps'], str(s['p50_ms']),
+                          str(s['p95_ms']), str(s['p99_ms'])), file=stream)
+    if 'rss' in summary:
+        print("RSS: {}".format(summary['rss']), file=stream)
+    if 'server' in summary:
+        print("Server: {}".format(summary['server']), file=stream)
+    if diff:
+        print("Change vs baseline: {}".format(diff), file=stream)
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(
+                description='Load test for o3api: throughput and tail latency')
+    parser.add_argument('--url', default=None,
+                        help='Use an already running service instead of '
+                             'starting one locally')
+    parser.add_argument('--data', default=None,
+                        help='Data directory. Synthetic data is generated in '
+                             'a temporary directory, if not given')
+    parser.add_argument('--models', type=int, default=4,
+                        help='Number of synthetic models to generate')
+    parser.add_argument('--workers', type=int,
+                        default=int(os.getenv('O3API_WORKERS', 1)),
+                        help='Number of gunicorn workers to start')
+    parser.add_argument('--threads', type=int,
+                        default=int(os.getenv('O3API_THREADS', 1)),
+                        help='Number of threads per gunicorn worker')
+    parser.add_argument('--admission', action='store_true',
+                        help='Keep admission control in the started server '
+                             '(all load comes from one identity)')
+    parser.add_argument('--scheduler', action='store_true',
+                        help='Keep the request scheduler in the started '
+                             'server')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='Request mix as kind=weight pairs, kinds: {}'
+                             .format(', '.join(REQUEST_KINDS)))
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Number of concurrent clients')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Target rate (req/s). Closed loop if not set')
+    parser.add_argument('--duration', type=float, default=30.,
+                        help='Duration of the run (s)')
+    parser.add_argument('--requests', type=int, default=None,
+                        help='Maximum number of requests')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the request plan')
+    parser.add_argument('--output', default=None,
+                        help='Store the summary as JSON file')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON summary of a previous run to compare to')
+    parser.add_argument('--max-regression', type=float, default=0.1,
+                        help='Tolerated relative change vs baseline, '
+                             'exit with 1 if exceeded')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_args(argv)
+    tmp_dir = None
+    proc = None
+    sampler = None
+    data_path = args.data
+    try:
+        if data_path is None:
+            tmp_dir = tempfile.mkdtemp(prefix='o3api-loadtest-')
+            data_path = tmp_dir
+            models = make_synthetic_data(data_path, models=args.models)
+        else:
+            models = sorted(m for m in os.listdir(data_path)
+                            if os.path.isdir(os.path.join(data_path, m)))
+
+        if args.url:
+            url = args.url
+        else:
+            proc, url = start_server(os.path.abspath(data_path),
+                                     workers=args.workers,
+                                     threads=args.threads,
+                                     admission=args.admission,
+                                     scheduler=args.scheduler)
+            sampler = RSSSampler(proc.pid)
+            sampler.start()
+
+        results, elapsed = run_load(url, models, mix=args.mix,
+                                    concurrency=args.concurrency,
+                                    rate=args.rate,
+                                    duration=args.duration,
+                                    requests=args.requests,
+                                    seed=args.seed)
+        summary = summarize(results, elapsed)
+        summary['config'] = {k: v for k, v in vars(args).items()
+                             if k not in ['output', 'baseline']}
+        if sampler:
+            summary['rss'] = sampler.stop()
+        if proc is not None:
+            summary['server'] = {'admission': args.admission,
+                                 'scheduler': args.scheduler}
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    diff = None
+    worse = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        diff = compare(summary, baseline)
+        worse = regressed(summary, baseline, args.max_regression)
+        summary['vs_baseline'] = diff
+
+    print_report(summary, diff)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    if worse:
+        print("Regression vs baseline: {}".format(', '.join(worse)),
+              file=sys.stderr)
+    return 1 if worse else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
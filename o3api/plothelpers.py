@@ -9,8 +9,6 @@
 import o3api.config as cfg
 import logging
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.lines import Line2D
 
 # conigure python logger
 logger = logging.getLogger('__name__') #o3api
@@ -28,6 +26,8 @@ END = cfg.api_conf['end']
 MONTH = cfg.api_conf['month']
 LAT_MIN = cfg.api_conf['lat_min']
 LAT_MAX = cfg.api_conf['lat_max']
+LEVEL_MIN = cfg.api_conf['level_min']
+LEVEL_MAX = cfg.api_conf['level_max']
 
 # configuration for plotting
 plot_c = cfg.plot_conf
@@ -95,6 +95,11 @@ def set_plot_title(**kwargs):
     deg_sign= u'\N{DEGREE SIGN}'
     plot_title += (" latitudes: " + str(kwargs[LAT_MIN]) + deg_sign + ".." +
                    str(kwargs[LAT_MAX]) + deg_sign)
+    if (kwargs.get(LEVEL_MIN) is not None or
+        kwargs.get(LEVEL_MAX) is not None):
+        levels = [ '' if kwargs.get(l) is None else str(kwargs[l])
+                   for l in [LEVEL_MIN, LEVEL_MAX] ]
+        plot_title += ", levels: " + "..".join(levels) + " hPa"
 
     return plot_title
 
@@ -109,6 +114,8 @@ def set_filename(**kwargs):
     print("api_conf = ", cfg.api_conf)
     file_name = ''
     for val in cfg.api_conf.values():
+        if kwargs.get(val) is None: # optional parameter not given
+            continue
         if val == MONTH and len(kwargs[val]) == 0:
             par_str = 'full_year'
         else:
@@ -122,6 +129,24 @@ def set_filename(**kwargs):
     return file_name
 
 
+# matplotlib.pyplot, imported at first use
+_pyplot = None
+
+def get_pyplot():
+    """Import matplotlib.pyplot at first use,
+    so that workers serving only JSON do not load the plotting stack
+
+    :return: matplotlib.pyplot module
+    """
+    global _pyplot
+    if _pyplot is None:
+        import matplotlib.style as mplstyle
+        mplstyle.use('fast') # faster?
+        import matplotlib.pyplot as plt
+        _pyplot = plt
+    return _pyplot
+
+
 def set_figure_attr(fig, **kwargs):
     """Configure the figure attributes
 
@@ -129,6 +154,8 @@ def set_figure_attr(fig, **kwargs):
     :param kwargs: The provided  in the API call parameters
     :return: none
     """
+    from matplotlib.lines import Line2D
+    plt = get_pyplot()
     plot_type = kwargs[PTYPE]
     models = clean_models(**kwargs)
 
@@ -140,11 +167,12 @@ def set_figure_attr(fig, **kwargs):
     num_col = num_col if (len(models) % 12 == 0) else num_col + 1
     ax = plt.gca() # get axis instance
     ax_pos = ax.get_position() # get the axes position
-    # add 'year 1980' line label
+    # add 'year 1980' line label (return years have no reference line)
     handles, labels = ax.get_legend_handles_labels()
-    handles.append(Line2D([0], [0], color='k',
-                          linestyle='dashed', 
-                          label='Reference year 1980'))
+    if plot_type != cfg.netCDF_conf['tco3_r']:
+        handles.append(Line2D([0], [0], color='k',
+                              linestyle='dashed', 
+                              label='Reference year 1980'))
     plt.legend(handles=handles,
                loc='upper center', 
                bbox_to_anchor=[0., ax_pos.y0-0.675, 0.99, 0.3],
@@ -155,3 +183,32 @@ def set_figure_attr(fig, **kwargs):
              'Generated with o3as.data.kit.edu',
              fontsize='medium', color='gray',
              ha='right', va='top', alpha=0.5)
+
+
+def plot_level_time(models, fields, **kwargs):
+    """Draw (level x time) fields, one panel per model,
+    pressure decreasing upwards
+
+    :param models: The models drawn
+    :param fields: pandas DataFrames (time as index, levels as columns)
+    :param kwargs: The provided  in the API call parameters
+    :return: Figure instance
+    """
+    plt = get_pyplot()
+    plot_type = kwargs[PTYPE]
+    fig_size = plot_c[plot_type]['fig_size']
+    fig, axes = plt.subplots(len(fields), 1, squeeze=False, sharex=True,
+                             figsize=(fig_size[0],
+                                      fig_size[1]*max(len(fields), 2)/2),
+                             dpi=150, facecolor='w', edgecolor='k')
+    for ax, model, field in zip(axes[:, 0], models, fields):
+        mesh = ax.pcolormesh(field.index, field.columns, field.values.T,
+                             shading='nearest')
+        ax.set_yscale('log')
+        ax.set_ylim(np.amax(field.columns), np.amin(field.columns))
+        ax.set_ylabel(plot_c[plot_type]['level_label'], fontsize='medium')
+        ax.set_title(model, fontsize='medium')
+        fig.colorbar(mesh, ax=ax, label=plot_c[plot_type]['ylabel'])
+    axes[-1, 0].set_xlabel(plot_c[plot_type]['xlabel'], fontsize='large')
+    fig.suptitle(set_plot_title(**kwargs), fontsize='medium', color='gray')
+    return fig
@@ -6,21 +6,27 @@
 #
 # @author: vykozlov
 
-import glob
-import matplotlib.pyplot as plt
+import collections
 import numpy as np
+import o3api.aggregates as o3aggregates
+import o3api.catalog as o3catalog
+import o3api.compute as o3compute
 import o3api.config as cfg
+import o3api.fileaccess as o3fileaccess
+import o3api.filecache as o3filecache
+import o3api.latgrid as o3latgrid
 import o3api.plothelpers as phlp
-import os
+import o3api.resultstore as o3resultstore
+import o3api.shmcache as o3shmcache
+import o3api.smoothing as o3smoothing
 import logging
 import pandas as pd
-from scipy import signal
-from statsmodels.tsa.seasonal import seasonal_decompose # accurate enough
 import xarray as xr
 
-import cProfile
 import io
-import pstats
+import threading
+import warnings
+from contextlib import contextmanager
 from functools import wraps
 
 logger = logging.getLogger('__name__') #o3api
@@ -29,6 +35,7 @@ logger.setLevel(cfg.log_level)
 # configuration for netCDF
 TIME = cfg.netCDF_conf['t_c']
 LAT = cfg.netCDF_conf['lat_c']
+PLEV = cfg.netCDF_conf['plev_c']
 TCO3 = cfg.netCDF_conf['tco3']
 VMRO3 = cfg.netCDF_conf['vmro3']
 TCO3Return = cfg.netCDF_conf['tco3_r']
@@ -42,6 +49,8 @@ def _profile(func):
     """
     @wraps(func)
     def wrapper(*args, **kwargs):
+        import cProfile
+        import pstats
         pr = cProfile.Profile()
         pr.enable()
         retval = func(*args, **kwargs)
@@ -55,6 +64,118 @@ def _profile(func):
 
     return wrapper
 
+class SeriesCache:
+    """Thread-safe LRU cache of processed data (series, reference values)
+
+    :param max_entries: Maximum number of entries to keep
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the cached value or None
+        """
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store the value, evicting the least recently used entries
+        """
+        with self._lock:
+            old = self._data.pop(key, None)
+            self._bytes -= self._nbytes(old)
+            self._data[key] = value
+            self._bytes += self._nbytes(value)
+            while len(self._data) > self.max_entries:
+                self._bytes -= self._nbytes(self._data.popitem(last=False)[1])
+
+    def discard(self, match):
+        """Remove the entries whose key matches
+
+        :param match: Function of the key, True to remove the entry
+        :return: number of removed entries
+        """
+        with self._lock:
+            keys = [ key for key in self._data if match(key) ]
+            for key in keys:
+                self._bytes -= self._nbytes(self._data.pop(key))
+            return len(keys)
+
+    @staticmethod
+    def _nbytes(value):
+        """Size of the cached data (series values and index)
+        """
+        if value is None:
+            return 0
+        if isinstance(value, (pd.Series, pd.DataFrame)):
+            return int(value.values.nbytes + value.index.nbytes)
+        return int(getattr(value, 'nbytes', 8))
+
+    def stats(self):
+        """Return the cache statistics
+
+        :rtype: dict
+        """
+        with self._lock:
+            return { 'entries': len(self._data),
+                     'bytes': self._bytes,
+                     'hits': self.hits,
+                     'misses': self.misses }
+
+
+series_cache = SeriesCache(cfg.series_cache_conf['max_entries'])
+
+def get_result(key):
+    """Return the result from :data:`series_cache` or, if enabled,
+    from :data:`o3api.resultstore.result_store` (then kept in memory too)
+
+    :param key: Result key, see :meth:`DataSelection._cache_key`
+    :return: the result or None
+    """
+    value = series_cache.get(key)
+    if value is None and cfg.result_store_conf['enabled']:
+        value = o3resultstore.result_store.get(key)
+        if value is not None:
+            series_cache.put(key, value)
+    return value
+
+def put_result(key, value):
+    """Keep the result in :data:`series_cache` and, if enabled,
+    in :data:`o3api.resultstore.result_store`
+
+    :param key: Result key, see :meth:`DataSelection._cache_key`
+    :param value: The result
+    """
+    series_cache.put(key, value)
+    if cfg.result_store_conf['enabled']:
+        o3resultstore.result_store.put(key, value)
+
+def get_dtype():
+    """Floating point type of loaded data, caches and results,
+    see precision_conf in o3api/config.py
+
+    :rtype: numpy dtype
+    """
+    return np.dtype(cfg.precision_conf['dtype'])
+
+
+class InvalidRequest(ValueError):
+    """The requested processing is not possible (HTTP 400)
+    """
+    status = 400
+
+
 def set_data_processing(plot_type, **kwargs):
     """Function to inizialize proper class for data processing
 
@@ -88,11 +209,8 @@ class Dataset:
 
         :param model: The model to process
         """
-        # strip possible spaces in front and back, and then quotas
-        model = model.strip().strip('\"')
-        self._datafiles = glob.glob(os.path.join(cfg.O3AS_DATA_BASEPATH, 
-                                                 model, 
-                                                 self._data_pattern))
+        self._datafiles = o3catalog.catalog.get_datafiles(model,
+                                                          self.plot_type)
 
     def get_dataset(self, model):
         """Load data from the datafile list
@@ -104,24 +222,30 @@ class Dataset:
         # Check: http://xarray.pydata.org/en/stable/dask.html#chunking-and-performance
         # chunks={'latitude': 8} - very machine dependent!
         # laptop (RAM 8GB) : 8, lsdf-gpu (128GB) : 64
+        # => chosen per model from the shape and available memory,
+        #    see o3api/compute.py (O3API_CHUNK_SIZE, O3API_CHUNK_OVERRIDES)
         # engine='h5netcdf' : need h5netcdf files? yes, but didn't see improve
         # parallel=True : in theory should use dask.delayed 
         #                 to open and preprocess in parallel. Default is False
         self.__set_datafiles(model)
-        chunk_size = int(os.getenv('O3API_CHUNK_SIZE', -1))
+        o3compute.backend.setup()
+        entry = o3catalog.catalog.get_entry(model, self.plot_type)
+        chunk_size = o3compute.backend.chunk_size(entry)
+        # local copies, if the data is on a slow mount
+        datafiles = [ o3filecache.local_path(f) for f in self._datafiles ]
 
         if chunk_size > 0:
-            ds = xr.open_mfdataset(self._datafiles, 
+            ds = xr.open_mfdataset(datafiles, 
                                    chunks={LAT: chunk_size },
                                    concat_dim=TIME,
                                    data_vars='minimal', coords='minimal',
-                                   parallel=False)
+                                   parallel=cfg.dask_conf['parallel'])
         else:
-            ds = xr.open_mfdataset(self._datafiles,
+            ds = xr.open_mfdataset(datafiles,
                                    concat_dim=TIME,
                                    data_vars='minimal',
                                    coords='minimal',
-                                   parallel=False)
+                                   parallel=cfg.dask_conf['parallel'])
         return ds
 
     
@@ -133,6 +257,11 @@ class DataSelection(Dataset):
     :param month: Month(s) to select, if not a whole year
     :param lat_min: Minimum latitude to define the range (-90..90)
     :param lat_max: Maximum latitude to define the range (-90..90)
+    :param level_min: Minimum pressure level (hPa), optional
+    :param level_max: Maximum pressure level (hPa), optional
+    :param shared_fields: Fields already read for other selections,
+                          (plot type, model) -> arrays of :meth:`get_field`,
+                          filled at first use, optional (/api/plot_batch)
     """
 
     def __init__ (self, plot_type, **kwargs):
@@ -144,28 +273,434 @@ class DataSelection(Dataset):
         self.month = kwargs[api_c['month']]
         self.lat_min = kwargs[api_c['lat_min']]
         self.lat_max = kwargs[api_c['lat_max']]
+        self.level_min = kwargs.get(api_c['level_min'])
+        self.level_max = kwargs.get(api_c['level_max'])
+        self.shared_fields = kwargs.get('shared_fields')
 
-    def __check_latitude_order(self, ds):
-        """Function to check the latitude order, 
-        returns them correctly ordered
+    def lat_band(self, lats):
+        """Selected latitudes of the axis with their weights, shared by
+        all models on the same grid, see :mod:`o3api.latgrid`.
+        Latitudes may be ordered (-90..90) or (90..-90).
 
-        :param ds: xarray dataset to check
-        :return: lat_0, lat_last
+        :param lats: Latitudes in the order of the data
+        :return: index range, mask and weights of the selection
+        :rtype: o3api.latgrid.Band
         """
-        # check in what order latitude is used, e.g. (-90..90) or (90..-90)
-        lat_0 = np.amin(ds.coords[LAT].values[0]) # min latitude
-        lat_last = np.amax(ds.coords[LAT].values[-1]) # max latitude
+        return o3latgrid.get_grid(lats).band(self.lat_min, self.lat_max)
+
+    def _cache_key(self, model, kind):
+        """Key for :data:`series_cache` and the result store,
+        includes the data fingerprint
 
-        if lat_0 < lat_last:
-            lat_a = self.lat_min
-            lat_b = self.lat_max
+        :param model: The model to process
+        :param kind: What is cached (e.g. 'raw', 'ref1980')
+        :rtype: tuple
+        """
+        entry = o3catalog.catalog.get_entry(model, self.plot_type)
+        # the reference does not depend on the requested period
+        period = (1980, 1980) if kind == 'ref1980' else (self.begin, self.end)
+        return (self.plot_type, entry.model, kind) + period + (
+                tuple(sorted(self.month)),
+                self.lat_min, self.lat_max, self.level_min, self.level_max,
+                get_dtype().name, o3latgrid.grids.weighting,
+                entry.fingerprint)
+        
+    def __load_field(self, model):
+        """Load the whole (lat, time) array of the model with its axes
+
+        :param model: The model to process
+        :return: arrays and metadata for :data:`o3api.shmcache.shm_cache`
+        """
+        ds = super().get_dataset(model)
+        if type(ds.indexes[TIME]) is pd.core.indexes.datetimes.DatetimeIndex:
+            time_axis = ds.indexes[TIME].values
         else:
-            lat_a = self.lat_max
-            lat_b = self.lat_min
+            time_axis = ds.indexes[TIME].to_datetimeindex().values
+        arrays = {
+            'values': ds[self.plot_type].transpose(LAT, TIME).values.astype(
+                          get_dtype(), copy=False),
+            'lats': ds.coords[LAT].values,
+            'time': time_axis.astype('datetime64[ns]'),
+            'years': ds[TIME].dt.year.values,
+            'months': ds[TIME].dt.month.values
+        }
+        ds.close()
+        return arrays, { 'model': model, 'plot_type': self.plot_type }
 
-        return lat_a, lat_b
+    def read_field(self, model):
+        """Read the whole (lat, time) array of the model with netCDF4,
+        files concatenated in time
+
+        :param model: The model to process
+        :return: dict of arrays: values (lat, time), lats, time, years, months
+        """
+        entry = o3catalog.catalog.get_entry(model, self.plot_type)
+        years, months, time_axis, lats = entry.axes
+        values = [ np.empty((lats.size, 0), dtype=get_dtype()) ]
+        for datafile in entry.files:
+            with o3fileaccess.file_manager.open(datafile) as nc:
+                var = nc.variables[self.plot_type]
+                dims = var.dimensions
+                if sorted(dims) != sorted([LAT, TIME]):
+                    raise InvalidRequest("{} has {}, not ({}, {})".format(
+                                         self.plot_type, dims, LAT, TIME))
+                data = np.ma.filled(var[:].astype(get_dtype()), np.nan)
+            values.append(data if dims[0] == LAT else data.T)
+        return { 'values': np.concatenate(values, axis=1),
+                 'lats': lats,
+                 'time': time_axis,
+                 'years': years,
+                 'months': months }
+
+    def use_field(self):
+        """Whether selections are taken from the whole field of the model
+        (:meth:`get_field`): fields shared by requests of a batch
+        or by workers (shared-memory cache)
+
+        :rtype: bool
+        """
+        return (self.shared_fields is not None or
+                cfg.shm_cache_conf['enabled'])
+
+    @contextmanager
+    def get_field(self, model):
+        """Context manager giving the whole (lat, time) array of the model,
+        read once for the requests of a batch (:attr:`shared_fields`) or
+        shared between workers via :data:`o3api.shmcache.shm_cache`
+
+        :param model: The model to process
+        :return: dict of arrays: values (lat, time), lats, time, years, months
+        """
+        if self.shared_fields is not None:
+            key = (self.plot_type, model)
+            if key not in self.shared_fields:
+                self.shared_fields[key] = self.read_field(model)
+            yield self.shared_fields[key]
+            return
+
+        entry = o3catalog.catalog.get_entry(model, self.plot_type)
+        key = (self.plot_type, entry.model, get_dtype().name,
+               entry.fingerprint)
+        field = o3shmcache.shm_cache.get(key)
+        if field is None:
+            field = o3shmcache.shm_cache.put(key, *self.__load_field(model))
+        try:
+            yield field[0]
+        finally:
+            o3shmcache.shm_cache.release(key)
+
+    def select_field(self, field, begin, end):
+        """Select the time period, months and latitudes from the field,
+        same selection as :meth:`get_dataslice`
+
+        :param field: Arrays from :meth:`get_field`
+        :param begin: Year to start from
+        :param end: Year to finish
+        :return: selected values (lat, time) and time axis, latitudes
+                 of the range of :meth:`lat_band`
+        """
+        t_sel = (field['years'] >= begin) & (field['years'] <= end)
+        if len(self.month) > 0:
+            t_sel &= np.isin(field['months'], self.month)
+        band = self.lat_band(field['lats'])
+        values = field['values'][band.index][:, t_sel]
+        return values, field['time'][t_sel]
+
+    def get_stored_band(self, model, begin, end, band=None):
+        """Mean over latitude of the selection from the stored means of
+        standard bands, see :mod:`o3api.aggregates`
+
+        :param model: The model to process
+        :param begin: Year to start from
+        :param end: Year to finish
+        :param band: (lat_min, lat_max), default the one of the request
+        :return: means and time axis, None if the band is not stored
+        """
+        if not cfg.aggregates_conf['enabled']:
+            return None
+        lat_min, lat_max = band or (self.lat_min, self.lat_max)
+        entry = o3catalog.catalog.get_entry(model, self.plot_type)
+        stored = o3aggregates.store.get_band(entry, lat_min, lat_max,
+                                             get_dtype())
+        if stored is None:
+            return None
+        means, time_axis = stored
+        years = time_axis.astype('datetime64[Y]').astype(int) + 1970
+        t_sel = (years >= begin) & (years <= end)
+        if len(self.month) > 0:
+            months = time_axis.astype('datetime64[M]').astype(int) % 12 + 1
+            t_sel &= np.isin(months, self.month)
+        return means[t_sel], time_axis[t_sel]
+
+    def __select_indices(self, coords, begin, end):
+        """Time and latitude selection of one file, as in :meth:`get_dataslice`
+
+        :param coords: Coordinates of the file (o3api.catalog.FileCoords)
+        :return: time mask, latitude band (see :meth:`lat_band`)
+        """
+        t_sel = (coords.years >= begin) & (coords.years <= end)
+        if len(self.month) > 0:
+            t_sel &= np.isin(coords.months, self.month)
+        return t_sel, self.lat_band(coords.lats)
+
+    def level_mask(self, levels):
+        """Selection of pressure levels, all levels if no range is given
+
+        :param levels: Pressure levels (hPa), in any order
+        :return: level mask
+        """
+        lev_sel = np.ones(np.shape(levels), dtype=bool)
+        if self.level_min is not None:
+            lev_sel &= levels >= self.level_min
+        if self.level_max is not None:
+            lev_sel &= levels <= self.level_max
+        return lev_sel
+
+    def __hyperslab(self, dims, coords, t_range, lat_range):
+        """Index of the variable to read: time and latitude ranges and
+        the range of the selected pressure levels (levels are monotonic,
+        so the selected ones are contiguous)
+
+        :param dims: Dimensions of the variable
+        :param coords: Coordinates of the file (o3api.catalog.FileCoords)
+        :param t_range: Time index range
+        :param lat_range: Latitude index range
+        :return: index tuple
+        """
+        lev_range = slice(None)
+        if coords.levels is not None and PLEV in dims:
+            lev_idx = np.flatnonzero(self.level_mask(coords.levels))
+            lev_range = slice(lev_idx[0], lev_idx[-1] + 1) if lev_idx.size \
+                        else slice(0, 0)
+        return tuple(t_range if dim == TIME else
+                     lat_range if dim == LAT else
+                     lev_range if dim == PLEV else slice(None)
+                     for dim in dims)
+
+    def get_lats(self, model):
+        """Selected latitudes of the model, in the order of the files
+
+        :param model: The model to process
+        :return: latitudes
+        :rtype: numpy array
+        """
+        for datafile in o3catalog.catalog.get_datafiles(model, self.plot_type):
+            lats = o3catalog.read_file_coords(datafile).lats
+            return lats[self.lat_band(lats).index]
+        return np.array([], dtype=np.float64)
+
+    def get_lat_weights(self, model):
+        """Weights of the selected latitudes of the model (:meth:`get_lats`)
+
+        :param model: The model to process
+        :return: weights
+        :rtype: numpy array
+        """
+        for datafile in o3catalog.catalog.get_datafiles(model, self.plot_type):
+            return self.lat_band(o3catalog.read_file_coords(datafile).lats
+                                 ).weights
+        return np.array([], dtype=np.float64)
+
+    def get_levels(self, model):
+        """Selected pressure levels of the model, as stored in the files
+
+        :param model: The model to process
+        :return: levels (hPa), empty if the data has no levels
+        :rtype: numpy array
+        """
+        for datafile in o3catalog.catalog.get_datafiles(model, self.plot_type):
+            levels = o3catalog.read_file_coords(datafile).levels
+            if levels is not None:
+                return levels[self.level_mask(levels)]
+        return np.array([], dtype=np.float64)
+
+    def select_reader(self, model, begin, end):
+        """Select how to read the data according to netcdf_reader_conf:
+        in 'auto' mode :meth:`read_slice` for small selections,
+        otherwise :meth:`stream_lat_mean`
+
+        :param model: The model to process
+        :param begin: Year to start from
+        :param end: Year to finish
+        :return: 'netcdf4', 'stream' or 'xarray'
+        """
+        mode = cfg.netcdf_reader_conf['mode']
+        if mode != 'auto':
+            return mode
+        points = 0
+        for datafile in o3catalog.catalog.get_datafiles(model, self.plot_type):
+            coords = o3catalog.read_file_coords(datafile)
+            t_sel, band = self.__select_indices(coords, begin, end)
+            n_lev = 1
+            if coords.levels is not None:
+                n_lev = int(self.level_mask(coords.levels).sum())
+            points += int(t_sel.sum())*int(band.mask.sum())*n_lev
+        if points <= cfg.netcdf_reader_conf['max_points']:
+            return 'netcdf4'
+        return 'stream'
+
+    def read_slice(self, model, begin, end):
+        """Read the selection with netCDF4 directly, bypassing xarray and dask.
+        Only the index ranges of time, latitude and pressure levels needed
+        are read from every file, files are concatenated in time.
+
+        :param model: The model to process
+        :param begin: Year to start from
+        :param end: Year to finish
+        :return: selected values (lat, time), or (lat, time, level)
+                 for data with levels, and time axis,
+                 same as :meth:`select_field`; latitudes of the range
+                 of :meth:`lat_band`, see :meth:`get_lat_weights`
+        """
+        dtype = get_dtype()
+        values = []
+        times = []
+        for datafile in o3catalog.catalog.get_datafiles(model, self.plot_type):
+            coords = o3catalog.read_file_coords(datafile)
+            t_sel, band = self.__select_indices(coords, begin, end)
+            t_idx = np.flatnonzero(t_sel)
+            if t_idx.size == 0:
+                continue
+            t_range = slice(t_idx[0], t_idx[-1] + 1)
+            lat_range = band.index
+            with o3fileaccess.file_manager.open(datafile) as nc:
+                var = nc.variables[self.plot_type]
+                index = self.__hyperslab(var.dimensions, coords,
+                                         t_range, lat_range)
+                data = np.ma.filled(var[index].astype(dtype), np.nan)
+                data = np.moveaxis(data, [var.dimensions.index(LAT),
+                                          var.dimensions.index(TIME)], [0, 1])
+            # months are filtered inside the range
+            values.append(data[:, t_sel[t_range]])
+            times.append(coords.time[t_idx])
+
+        if not values:
+            return (np.empty((0, 0), dtype=dtype),
+                    np.array([], dtype='datetime64[ns]'))
+        return np.concatenate(values, axis=1), np.concatenate(times)
+
+    def iter_lat_means(self, model, begin, end, block_bytes=None,
+                       reduce=None):
+        """Walk the selection in blocks of time points and reduce every
+        block over latitude, only one block is in memory at a time
+
+        :param model: The model to process
+        :param begin: Year to start from
+        :param end: Year to finish
+        :param block_bytes: Size of a block read, default from
+                            netcdf_reader_conf['block_bytes']
+        :param reduce: Reduction of a (lat, time) block, returning the time
+                       first, default :meth:`lat_mean` with the weights
+                       of the latitudes
+        :return: generator of (time axis, means) per block, means over
+                 latitude have the time as the first dimension
+        """
+        if block_bytes is None:
+            block_bytes = cfg.netcdf_reader_conf['block_bytes']
+        dtype = get_dtype()
+        for datafile in o3catalog.catalog.get_datafiles(model, self.plot_type):
+            coords = o3catalog.read_file_coords(datafile)
+            t_sel, band = self.__select_indices(coords, begin, end)
+            t_idx = np.flatnonzero(t_sel)
+            if t_idx.size == 0:
+                continue
+            lat_range = band.index
+            reduce_block = reduce or (lambda data: self.lat_mean(data,
+                                                                 band.weights))
+            with o3fileaccess.file_manager.open(datafile) as nc:
+                var = nc.variables[self.plot_type]
+                dims = var.dimensions
+                shape = dict(zip(dims, var.shape))
+            if coords.levels is not None and PLEV in shape:
+                shape[PLEV] = int(self.level_mask(coords.levels).sum())
+            # time points per block: a time point has all selected
+            # latitudes and levels, and all other dimensions
+            point_bytes = dtype.itemsize*max(band.weights.size, 1)*max(int(np.prod(
+                [ n for dim, n in shape.items() if dim not in [TIME, LAT] ])),
+                1)
+            block_t = max(int(block_bytes // point_bytes), 1)
+            for start in range(t_idx[0], t_idx[-1] + 1, block_t):
+                stop = min(start + block_t, t_idx[-1] + 1)
+                block_sel = t_sel[start:stop]
+                if not block_sel.any():
+                    continue
+                index = self.__hyperslab(dims, coords, slice(start, stop),
+                                         lat_range)
+                with o3fileaccess.file_manager.open(datafile) as nc:
+                    data = nc.variables[self.plot_type][index]
+                data = np.ma.filled(data.astype(dtype, copy=False), np.nan)
+                data = np.moveaxis(data, [dims.index(LAT), dims.index(TIME)],
+                                   [0, 1])
+                if not block_sel.all():
+                    data = data[:, block_sel]
+                yield coords.time[start:stop][block_sel], reduce_block(data)
+
+    def stream_lat_mean(self, model, begin, end, block_bytes=None,
+                        reduce=None):
+        """Mean over latitude of the selection, read block by block
+        (see :meth:`iter_lat_means`), peak memory is bounded by the
+        block size and the (small) result
+
+        :param model: The model to process
+        :param begin: Year to start from
+        :param end: Year to finish
+        :param block_bytes: Size of a block read
+        :param reduce: Reduction of a block, see :meth:`iter_lat_means`
+        :return: means over latitude (time first) and time axis
+        """
+        means = []
+        times = []
+        for time_block, mean_block in self.iter_lat_means(model, begin, end,
+                                                          block_bytes,
+                                                          reduce):
+            times.append(time_block)
+            means.append(mean_block)
+        if not means:
+            return (np.array([], dtype=get_dtype()),
+                    np.array([], dtype='datetime64[ns]'))
+        return np.concatenate(means), np.concatenate(times)
+
+    @staticmethod
+    def lat_mean(values, weights=None):
+        """Mean over latitudes skipping NaNs (as xarray does), a dot product
+        with the weights of the latitudes (see :meth:`lat_band`),
+        accumulated in float64, returned in the type of the values
+
+        :param values: (lat, time) array
+        :param weights: Weights of the latitudes, None for equal weights
+        :return: mean for every time point, NaN where no data
+        """
+        if weights is not None:
+            return o3latgrid.weighted_mean(values, weights).astype(
+                       values.dtype, copy=False)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            return np.nanmean(values, axis=0, dtype=np.float64).astype(
+                       values.dtype, copy=False)
+
+    def xr_lat_mean(self, da):
+        """Weighted mean over the latitudes of the selection of
+        :meth:`get_dataslice`, NaNs skipped, in float64
+
+        :param da: xarray DataArray or Dataset
+        :return: mean over latitude
+        """
+        weights = self.lat_band(da.coords[LAT].values).weights
+        return da.astype(np.float64).weighted(
+                   xr.DataArray(weights, dims=[LAT])).mean(dim=LAT)
+
+    def __select_levels(self, ds):
+        """Select the requested pressure levels, if the data has levels
+
+        :param ds: xarray dataset
+        :return: xarray dataset with the selected levels
+        """
+        if PLEV not in ds.coords:
+            return ds
+        levels = o3catalog.to_hpa(ds.coords[PLEV].values,
+                                  ds.coords[PLEV].attrs.get('units', 'hPa'))
+        return ds.isel({PLEV: np.flatnonzero(self.level_mask(levels))})
 
-        
     def get_dataslice(self, model):
         """Function to select the slice of data according 
         to the time and latitude requested
@@ -177,8 +712,8 @@ class DataSelection(Dataset):
         ds = super().get_dataset(model)
         logger.info("Dataset is loaded from storage location: {}".format(ds))
         
-        # check in what order latitude is used, return them correspondently
-        lat_a, lat_b = self.__check_latitude_order(ds)
+        # latitudes may be ordered (-90..90) or (90..-90)
+        lat_range = self.lat_band(ds.coords[LAT].values).index
 
         # select data according to the period and latitude
         # BUG(?) ccmi-umukca-ucam complains about 31-12-year, but 30-12-year works
@@ -188,10 +723,9 @@ class DataSelection(Dataset):
             ds = ds.sel(time=ds.time.dt.month.isin(self.month))
 
         ds_slice = ds.sel(time=slice("{}-01".format(self.begin), 
-                                     "{}-12".format(self.end)),
-                          lat=slice(lat_a,
-                                    lat_b))  # latitude
-        return ds_slice
+                                     "{}-12".format(self.end))).isel(
+                          lat=lat_range)  # latitude
+        return self.__select_levels(ds_slice)
         
     def get_1980slice(self, model):
         """Function to select the slice for 1980 (reference year) 
@@ -201,13 +735,13 @@ class DataSelection(Dataset):
         :rtype: xarray
         """
         ds = super().get_dataset(model)
-        # check in what order latitude is used, return them correspondently
-        lat_a, lat_b = self.__check_latitude_order(ds)
+        # latitudes may be ordered (-90..90) or (90..-90)
+        lat_range = self.lat_band(ds.coords[LAT].values).index
         if len(self.month) > 0:
             ds = ds.sel(time=ds.time.dt.month.isin(self.month))        
-        ds_1980 = ds.sel(time=slice("1980-01", "1980-12"), 
-                         lat=slice(lat_a, lat_b))  # latitude
-        return ds_1980
+        ds_1980 = ds.sel(time=slice("1980-01", "1980-12")).isel(
+                      lat=lat_range)  # latitude
+        return self.__select_levels(ds_1980)
 
 
 class ProcessForTCO3(DataSelection):
@@ -232,7 +766,8 @@ class ProcessForTCO3(DataSelection):
         else:
             time_axis = ds.indexes[TIME].to_datetimeindex()
 
-        curve = pd.Series(np.nan_to_num(ds[TCO3]),
+        curve = pd.Series(np.asarray(ds[TCO3]).astype(get_dtype(),
+                                                      copy=False),
                           index=pd.DatetimeIndex(time_axis),
                           name=model)
         return curve
@@ -244,44 +779,69 @@ class ProcessForTCO3(DataSelection):
         :return: raw data points in preparation for plotting
         :rtype: pandas series (pd.Series)        
         """
+        key = self._cache_key(model, 'raw')
+        data = get_result(key)
+        if data is not None:
+            return data
+
+        stored = super().get_stored_band(model, self.begin, self.end)
+        if stored is not None:
+            means, time_axis = stored
+            data = pd.Series(means,
+                             index=pd.DatetimeIndex(time_axis),
+                             name=model)
+            put_result(key, data)
+            return data
+
+        if super().use_field():
+            with super().get_field(model) as field:
+                values, time_axis = super().select_field(field, self.begin,
+                                                         self.end)
+                weights = self.lat_band(field['lats']).weights
+                data = pd.Series(self.lat_mean(values, weights),
+                                 index=pd.DatetimeIndex(time_axis),
+                                 name=model)
+            put_result(key, data)
+            return data
+
+        reader = super().select_reader(model, self.begin, self.end)
+        if reader in ['netcdf4', 'stream']:
+            if reader == 'netcdf4':
+                values, time_axis = super().read_slice(model, self.begin,
+                                                       self.end)
+                means = self.lat_mean(values, self.get_lat_weights(model))
+            else:
+                means, time_axis = super().stream_lat_mean(model, self.begin,
+                                                           self.end)
+            data = pd.Series(means,
+                             index=pd.DatetimeIndex(time_axis),
+                             name=model)
+            put_result(key, data)
+            return data
+
         # data selection according to time and latitude
         ds_slice = super().get_dataslice(model)
-        ds_tco3 = ds_slice[[TCO3]].mean(dim=[LAT])
+        ds_tco3 = self.xr_lat_mean(ds_slice[[TCO3]].astype(get_dtype()))
         logger.debug("ds_tco3: {}".format(ds_tco3))
 
-        data = self.__to_pd_series(ds_tco3, model)
+        with o3compute.backend.measure(model):
+            data = self.__to_pd_series(ds_tco3, model)
+        ds_slice.close() # data is loaded, release the files
+        put_result(key, data)
 
         return data
         
     def get_plot_data(self, model):
-        """Plot tco3_zm data applying a smoothing function (boxcar)
+        """Plot tco3_zm data applying a smoothing function (boxcar),
+        see plot_conf and :mod:`o3api.smoothing`
+
         :param model: The model to process for tco3_zm
         :return: ready for plotting data
         :rtype: pandas series (pd.Series)
         """
-        
         curve = self.get_raw_data(model)
-        time_axis = curve.index
-        curve_values = curve.values
-        boxcar_win = 3
-        boxcar = np.ones(boxcar_win)
-        boxcar_values = signal.convolve(curve_values, 
-                                        boxcar, 
-                                        mode='same')/np.sum(boxcar)
-        logger.debug("time_axis.shape = {}, boxcar_values.shape = {}"
-                     .format(time_axis.shape, boxcar_values.shape))
-        boxcar_values[0] = curve_values[0]
-        boxcar_values[-1] = curve_values[-1]
-        #boxcar_values[1] = curve_values[1]
-        #boxcar_values[-2] = curve_values[-2]
-        logger.debug(F"boxcar_values[:5]  : {boxcar_values[:5]}")
-        logger.debug(F"vs curve_values[:5]: {curve_values[:5]}")
-        logger.debug(F"boxcar_values[-5:]  : {boxcar_values[-5:]}")
-        logger.debug(F"vs curve_values[-5:]: {curve_values[-5:]}")
-        boxcar_smooth = pd.Series(boxcar_values,
-                                  index=time_axis,
-                                  name=model)
-        return boxcar_smooth
+        return o3smoothing.smooth_series([curve],
+                                         cfg.plot_conf[TCO3]['smooth'])[0]
 
     def get_ref1980(self, model):
         """Process the model to get tco3_zm reference for 1980
@@ -290,56 +850,399 @@ class ProcessForTCO3(DataSelection):
         :return: xarray dataset for 1980
         :rtype: xarray        
         """
+        key = self._cache_key(model, 'ref1980')
+        ref1980 = get_result(key)
+        if ref1980 is not None:
+            return ref1980
+
+        stored = super().get_stored_band(model, 1980, 1980)
+        if stored is not None:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                ref1980 = np.nanmean(stored[0], dtype=np.float64)
+            put_result(key, ref1980)
+            return ref1980
+
+        if super().use_field():
+            with super().get_field(model) as field:
+                values, _ = super().select_field(field, 1980, 1980)
+                weights = self.lat_band(field['lats']).weights
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', category=RuntimeWarning)
+                    ref1980 = np.nanmean(self.lat_mean(values, weights),
+                                         dtype=np.float64)
+            put_result(key, ref1980)
+            return ref1980
+
+        reader = super().select_reader(model, 1980, 1980)
+        if reader in ['netcdf4', 'stream']:
+            if reader == 'netcdf4':
+                values, _ = super().read_slice(model, 1980, 1980)
+                means = self.lat_mean(values, self.get_lat_weights(model))
+            else:
+                means, _ = super().stream_lat_mean(model, 1980, 1980)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                ref1980 = np.nanmean(means, dtype=np.float64)
+            put_result(key, ref1980)
+            return ref1980
+
         # data selection according to 1980 and latitude
         ds_slice = super().get_1980slice(model)
-        ds_tco3_1980 = ds_slice[[TCO3]].mean(dim=[LAT])
+        ds_tco3_1980 = self.xr_lat_mean(ds_slice[[TCO3]].astype(get_dtype()))
         #logger.debug("ds_tco3_1980: {}".format(ds_tco3_1980.to_dataframe()))
-        ref1980 = ds_tco3_1980.to_dataframe().mean().values[0]
+        with o3compute.backend.measure(model):
+            ref1980 = ds_tco3_1980.to_dataframe().mean().values[0]
+        ds_slice.close() # data is loaded, release the files
+        put_result(key, ref1980)
 
         return ref1980
 
 
 class ProcessForVMRO3(DataSelection):
-    """Subclass of :class:`DataSelection` to calculate vmro3_zm
+    """Subclass of :class:`DataSelection` to calculate vmro3_zm.
+    Latitudes and pressure levels are selected before reading,
+    only the needed hyperslab of every file is read.
     """
     def __init__(self, **kwargs):
         super().__init__(VMRO3, **kwargs)
 
+    def get_level_means(self, model, begin, end):
+        """Means over latitude for every time point and selected level
+
+        :param model: The model to process for vmro3_zm
+        :param begin: Year to start from
+        :param end: Year to finish
+        :return: means (time, level), time axis, levels (hPa)
+        """
+        levels = super().get_levels(model)
+        reader = super().select_reader(model, begin, end)
+        if reader == 'netcdf4':
+            values, time_axis = super().read_slice(model, begin, end)
+            means = self.lat_mean(values, self.get_lat_weights(model))
+        elif reader == 'stream':
+            means, time_axis = super().stream_lat_mean(model, begin, end)
+        else:
+            ds_slice = (super().get_1980slice(model) if (begin, end) ==
+                        (1980, 1980) else super().get_dataslice(model))
+            ds_vmro3 = self.xr_lat_mean(ds_slice[VMRO3].astype(
+                           get_dtype())).astype(get_dtype())
+            with o3compute.backend.measure(model):
+                if PLEV in ds_vmro3.dims:
+                    ds_vmro3 = ds_vmro3.transpose(TIME, PLEV)
+                means = ds_vmro3.values
+                time_axis = ds_vmro3.indexes[TIME]
+                if not isinstance(time_axis, pd.DatetimeIndex):
+                    time_axis = time_axis.to_datetimeindex()
+                time_axis = time_axis.values
+            ds_slice.close() # data is loaded, release the files
+        if means.size == 0:
+            means = np.empty((time_axis.size, levels.size),
+                             dtype=get_dtype())
+        return means.reshape(time_axis.size, -1), time_axis, levels
+
+    def get_level_time(self, model):
+        """Process the model to get the (level x time) field,
+        mean over the selected latitudes
+
+        :param model: The model to process for vmro3_zm
+        :return: time as index, levels (hPa) as columns
+        :rtype: pandas DataFrame
+        """
+        key = self._cache_key(model, 'level_time')
+        data = get_result(key)
+        if data is not None:
+            return data
+
+        means, time_axis, levels = self.get_level_means(model, self.begin,
+                                                        self.end)
+        data = pd.DataFrame(means, index=pd.DatetimeIndex(time_axis),
+                            columns=pd.Index(levels, name=PLEV))
+        put_result(key, data)
+        return data
+
+    def get_raw_data(self, model):
+        """Process the model to get vmro3_zm raw data,
+        mean over the selected latitudes and pressure levels
+
+        :param model: The model to process for vmro3_zm
+        :return: raw data points in preparation for plotting
+        :rtype: pandas series (pd.Series)
+        """
+        key = self._cache_key(model, 'raw')
+        data = get_result(key)
+        if data is not None:
+            return data
+
+        means, time_axis, _ = self.get_level_means(model, self.begin,
+                                                   self.end)
+        data = pd.Series(self.lat_mean(means.T), # over levels
+                         index=pd.DatetimeIndex(time_axis),
+                         name=model)
+        put_result(key, data)
+        return data
+
     def get_plot_data(self, model):
         """Process the model to get vmro3_zm data for plotting
 
         :param model: The model to process for vmro3_zm
-        :return: xarray dataset for plotting
-        :rtype: xarray        
+        :return: ready for plotting data
+        :rtype: pandas series (pd.Series)
         """
-        # data selection according to time and latitude
-        ds_slice = super().get_dataslice(model)
-        # currently placeholder. another calculation might be needed
-        # 20-10-07 vkoz
-        ds_vmro3 = ds_slice[[VMRO3]]
-        logger.debug("ds_vmro3: {}".format(ds_vmro3))
+        return self.get_raw_data(model)
 
-        return ds_vmro3.mean(dim=[LAT])
+    def get_ref1980(self, model):
+        """Process the model to get vmro3_zm reference for 1980
+
+        :param model: The model to process for vmro3_zm
+        :return: mean over 1980, the selected latitudes and levels
+        :rtype: float
+        """
+        key = self._cache_key(model, 'ref1980')
+        ref1980 = get_result(key)
+        if ref1980 is not None:
+            return ref1980
+
+        means, _, _ = self.get_level_means(model, 1980, 1980)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            ref1980 = np.nanmean(means, dtype=np.float64)
+        put_result(key, ref1980)
+        return ref1980
         
 
 class ProcessForTCO3Return(DataSelection):
-    """Subclass of :class:`DataSelection` to calculate tco3_return
+    """Subclass of :class:`DataSelection` to calculate tco3_return:
+    the year when tco3_zm, averaged per year over the selected months and
+    smoothed, returns to its 1980 value after the minimum.
+    All requested models and latitude bands are processed at once
+    as a (models, bands, years) array.
+
+    :param model: Model(s) requested, processed together
+    :param bands: Latitude bands "lat_min:lat_max",
+                  default the band lat_min..lat_max
     """
     def __init__(self, **kwargs):
-        super().__init__(TCO3Return, **kwargs)
+        # the return is derived from tco3_zm data
+        super().__init__(TCO3, **kwargs)
+        self.models = phlp.clean_models(**kwargs) if api_c['model'] in \
+                      kwargs else []
+        self.bands = self.parse_bands(kwargs.get(api_c['bands']),
+                                      self.lat_min, self.lat_max)
+        self.boxcar = cfg.tco3_return_conf['boxcar']
+        # read the latitudes of all bands at once
+        self.lat_min = min(band[0] for band in self.bands)
+        self.lat_max = max(band[1] for band in self.bands)
+
+    @staticmethod
+    def parse_bands(bands, lat_min, lat_max):
+        """Parse the latitude bands
+
+        :param bands: "lat_min:lat_max" strings, may be empty
+        :param lat_min: Minimum latitude of the default band
+        :param lat_max: Maximum latitude of the default band
+        :return: bands as (lat_min, lat_max)
+        :rtype: list
+        """
+        bands = list(filter(None, bands or []))
+        if len(bands) == 0:
+            return [ (min(lat_min, lat_max), max(lat_min, lat_max)) ]
+        parsed = []
+        for band in bands:
+            try:
+                lat_a, lat_b = [ float(lat) for lat in band.split(':') ]
+            except ValueError:
+                raise InvalidRequest("Latitude bands are given as "
+                                     "lat_min:lat_max, got '{}'".format(band))
+            parsed.append((min(lat_a, lat_b), max(lat_a, lat_b)))
+        return parsed
+
+    @staticmethod
+    def band_label(band):
+        """Label of the band, e.g. '-90..-60'
+
+        :rtype: string
+        """
+        return "{:g}..{:g}".format(*band)
+
+    @staticmethod
+    def annual_means(values, time_axis, years):
+        """Means per year skipping NaNs
+
+        :param values: (time, ...) array
+        :param time_axis: Time points (datetime64)
+        :param years: Years of the result, consecutive
+        :return: (year, ...) array, NaN for years without data
+        """
+        t_years = time_axis.astype('datetime64[Y]').astype(int) + 1970
+        keep = (t_years >= years[0]) & (t_years <= years[-1])
+        index = t_years[keep] - years[0]
+        values = values[keep]
+        valid = ~np.isnan(values)
+        sums = np.zeros((years.size,) + values.shape[1:])
+        counts = np.zeros((years.size,) + values.shape[1:])
+        np.add.at(sums, index, np.where(valid, values, 0.))
+        np.add.at(counts, index, valid)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums/counts
+
+    @staticmethod
+    def return_years(smooth, years, ref_year=1980):
+        """First year after the minimum (after the reference year) when
+        the smoothed values reach the reference value again
+
+        :param smooth: Smoothed annual means, years along the last axis
+        :param years: Years of the values
+        :param ref_year: The reference year
+        :return: return years (NaN if there is no return in the period or
+                 no dip below the reference value), reference values
+        """
+        ref_idx = np.flatnonzero(years == ref_year)
+        if ref_idx.size == 0:
+            nans = np.full(smooth.shape[:-1], np.nan)
+            return nans, nans
+        ref = smooth[..., ref_idx[0]]
+        after = years >= ref_year
+        # minimum after the reference year, all-NaN rows give index 0
+        masked = np.where(np.isnan(smooth) | ~after, np.inf, smooth)
+        min_idx = np.argmin(masked, axis=-1)
+        # no return without a dip: the minimum is then the reference year
+        dipped = np.take_along_axis(masked, min_idx[..., np.newaxis],
+                                    axis=-1) < ref[..., np.newaxis]
+        crossing = ((smooth >= ref[..., np.newaxis]) & dipped &
+                    (np.arange(years.size) > min_idx[..., np.newaxis]))
+        first = np.argmax(crossing, axis=-1)
+        return (np.where(crossing.any(axis=-1), years[first], np.nan)
+                .astype(np.float64), ref)
+
+    def get_band_means(self, model):
+        """Means of the model over every band, read as for tco3_zm
+        (:meth:`ProcessForTCO3.get_raw_data`): stored means of standard
+        bands, the whole field, the netCDF readers or xarray
+
+        :param model: The model to process
+        :return: (time, band) array, time axis
+        """
+        stored = [ self.get_stored_band(model, self.begin, self.end, band)
+                   for band in self.bands ]
+        if all(band is not None for band in stored):
+            return (np.stack([ means for means, _ in stored ], axis=-1),
+                    stored[0][1])
+
+        if super().use_field():
+            with super().get_field(model) as field:
+                values, time_axis = super().select_field(field, self.begin,
+                                                         self.end)
+                lats = field['lats'][self.lat_band(field['lats']).index]
+                return (o3aggregates.band_means(values, lats, self.bands),
+                        time_axis)
+
+        reader = super().select_reader(model, self.begin, self.end)
+        if reader in ['netcdf4', 'stream']:
+            lats = super().get_lats(model)
+            reduce = lambda values: o3aggregates.band_means(values, lats,
+                                                            self.bands)
+            if reader == 'netcdf4':
+                values, time_axis = super().read_slice(model, self.begin,
+                                                       self.end)
+                return reduce(values), time_axis
+            means, time_axis = super().stream_lat_mean(model, self.begin,
+                                                       self.end,
+                                                       reduce=reduce)
+            return means.reshape(time_axis.size, len(self.bands)), time_axis
+
+        # data selection according to time and latitude
+        ds_slice = super().get_dataslice(model)
+        if (type(ds_slice.indexes[TIME]) is
+            pd.core.indexes.datetimes.DatetimeIndex):
+            time_axis = ds_slice.indexes[TIME].values
+        else:
+            time_axis = ds_slice.indexes[TIME].to_datetimeindex().values
+        with o3compute.backend.measure(model):
+            values = ds_slice[TCO3].transpose(LAT, TIME).astype(
+                         get_dtype()).values
+        means = o3aggregates.band_means(values,
+                                        ds_slice.coords[LAT].values,
+                                        self.bands)
+        ds_slice.close() # data is loaded, release the files
+        return means, time_axis.astype('datetime64[ns]')
+
+    def get_band_annual(self, model, years):
+        """Annual means of the model for every band (cached)
+
+        :param model: The model to process
+        :param years: Years of the result
+        :return: (band, year) array
+        """
+        key = self._cache_key(model, 'band_annual') + (tuple(self.bands),)
+        data = get_result(key)
+        if data is not None:
+            return data
+
+        means, time_axis = self.get_band_means(model)
+        data = self.annual_means(means, time_axis, years).T.astype(
+                   get_dtype(), copy=False)
+        put_result(key, data)
+        return data
+
+    def get_return_table(self, models):
+        """Return years of all models and bands, computed together
+
+        :param models: The models to process
+        :return: return years (NaN if no return), models as index,
+                 band labels as columns; reference values 1980
+        :rtype: tuple of pandas DataFrame
+        """
+        entries = [ o3catalog.catalog.get_entry(m, self.plot_type)
+                    for m in models ]
+        key = (TCO3Return, tuple((e.model, e.fingerprint) for e in entries),
+               tuple(self.bands), tuple(sorted(self.month)),
+               self.begin, self.end, self.boxcar, get_dtype().name)
+        table = get_result(key)
+        if table is not None:
+            return table
+
+        years = np.arange(self.begin, self.end + 1)
+        # (models, bands, years)
+        annual = np.stack([ self.get_band_annual(e.model, years)
+                            for e in entries ]).astype(np.float64)
+        smooth = o3smoothing.boxcar(annual, self.boxcar, edges='truncate')
+        return_years, ref = self.return_years(smooth, years)
+        columns = [ self.band_label(band) for band in self.bands ]
+        table = (pd.DataFrame(return_years, index=models, columns=columns),
+                 pd.DataFrame(ref, index=models, columns=columns))
+        put_result(key, table)
+        return table
+
+    def __table_models(self, model):
+        return self.models if model in self.models else [model]
+
+    def get_raw_data(self, model):
+        """Return years of the model for every band,
+        computed together with the other requested models
+
+        :param model: The model to process for tco3_return
+        :return: return year per band (NaN if no return)
+        :rtype: pandas series (pd.Series)
+        """
+        table, _ = self.get_return_table(self.__table_models(model))
+        return table.loc[model].rename(model)
 
     def get_plot_data(self, model):
         """Process the model to get tco3_return data for plotting
 
         :param model: The model to process for tco3_return
-        :return: xarray dataset for plotting
-        :rtype: xarray        
+        :return: return year per band
+        :rtype: pandas series (pd.Series)
         """
-        # data selection according to time and latitude
-        ds_slice = super().get_dataslice(model)
-        # currently placeholder. another calculation might be needed
-        # 20-10-07 vkoz
-        ds_tco3_return = ds_slice[[TCO3Return]]
-        logger.debug("ds_tco3_return: {}".format(ds_tco3_return))
+        return self.get_raw_data(model)
+
+    def get_ref1980(self, model):
+        """Reference values (smoothed tco3_zm in 1980) of the model
 
-        return ds_tco3_return.mean(dim=[LAT])
+        :param model: The model to process for tco3_return
+        :return: reference value per band
+        :rtype: pandas series (pd.Series)
+        """
+        _, ref = self.get_return_table(self.__table_models(model))
+        return ref.loc[model].rename(model)
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Multi-resolution pyramid of the (lat x time) field of a model, served
+# as fixed-size tiles (Hovmoeller view). Every level is the field averaged
+# in time (monthly, annual, decadal) and latitude (native, 5, 10 degrees)
+# over all points of a bin, NaN skipped. Levels are stored as float32 .npy
+# files in a directory per model and data fingerprint and memory mapped,
+# so a tile reads only its pages. A pyramid is built at the first request
+# for the model or offline:
+#
+# $ o3api-pyramid [--model MODEL ...] [--ptype tco3_zm]
+
+import argparse
+import collections
+import hashlib
+import logging
+import numpy as np
+import o3api.catalog as o3catalog
+import o3api.config as cfg
+import o3api.fileaccess as o3fileaccess
+import os
+import shutil
+import sys
+import threading
+import time
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+# configuration for netCDF
+TIME = cfg.netCDF_conf['t_c']
+LAT = cfg.netCDF_conf['lat_c']
+TCO3 = cfg.netCDF_conf['tco3']
+
+# resolutions of the pyramid levels
+TIME_RES = ['monthly', 'annual', 'decadal']
+LAT_RES = ['native', '5', '10']
+
+
+class TileError(ValueError):
+    """The requested tile does not exist (HTTP 400)
+    """
+    status = 400
+
+
+def _bin_sums(sums, counts, bins, axis):
+    """Sums of consecutive runs of equal bins along the axis
+
+    :param sums: Sums of values (NaN as 0)
+    :param counts: Numbers of values (not NaN)
+    :param bins: Bin of every point along the axis, sorted
+    :param axis: The axis to reduce
+    :return: bin values, sums, counts
+    """
+    starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+    return (bins[starts], np.add.reduceat(sums, starts, axis=axis),
+            np.add.reduceat(counts, starts, axis=axis))
+
+
+def time_bins(time_axis, tres):
+    """Start of the period (month, year, decade) of every time point
+
+    :param time_axis: Time points (datetime64), sorted
+    :param tres: Time resolution, one of TIME_RES
+    :return: datetime64[M]
+    """
+    months = time_axis.astype('datetime64[M]')
+    if tres == 'monthly':
+        return months
+    years = time_axis.astype('datetime64[Y]').astype(int) + 1970
+    if tres == 'decadal':
+        years = years//10*10
+    return (years - 1970).astype('datetime64[Y]').astype('datetime64[M]')
+
+
+def lat_bins(lats, lres):
+    """Center of the latitude bin of every latitude
+
+    :param lats: Latitudes, sorted ascending
+    :param lres: Latitude resolution, one of LAT_RES
+    :return: bin centers
+    """
+    if lres == 'native':
+        return lats
+    step = float(lres)
+    return (np.floor((np.clip(lats, -90., 90. - 1e-9) + 90.)/step) + 0.5)*step \
+           - 90.
+
+
+class TilePyramid:
+    """Pyramids of (lat x time) fields, built lazily and memory mapped
+
+    :param directory: Directory of the pyramids
+    :param tile_time: Points per tile in time
+    :param tile_lat: Points per tile in latitude
+    :param max_loaded: Pyramids kept mapped in this process
+    """
+    def __init__(self, directory, tile_time, tile_lat, max_loaded=32):
+        self.directory = directory
+        self.tile_time = tile_time
+        self.tile_lat = tile_lat
+        self.max_loaded = max_loaded
+        self._lock = threading.Lock()
+        self._build_locks = {} # pyramid path -> lock
+        self._loaded = collections.OrderedDict() # path -> level arrays
+        self.builds = 0
+        self.build_s = 0.
+        self.hits = 0
+        self.tiles = 0
+
+    def _path(self, entry):
+        """Directory of the pyramid of the catalog entry
+        """
+        name = hashlib.sha1(repr(entry.fingerprint).encode('utf-8')) \
+                      .hexdigest()
+        return os.path.join(self.directory, entry.plot_type, entry.model,
+                            name)
+
+    @staticmethod
+    def read_field(entry):
+        """Read the whole (lat, time) field of the model,
+        latitudes ascending, files concatenated in time
+
+        :param entry: Catalog entry (o3api.catalog.ModelEntry)
+        :return: values (lat, time), latitudes, time axis
+        """
+        values = []
+        times = []
+        lats = None
+        for datafile in entry.files:
+            coords = o3catalog.read_file_coords(datafile)
+            with o3fileaccess.file_manager.open(datafile) as nc:
+                var = nc.variables[entry.plot_type]
+                if sorted(var.dimensions) != sorted([LAT, TIME]):
+                    raise TileError("Tiles need ({}, {}) data, {} has {}"
+                                    .format(LAT, TIME, entry.plot_type,
+                                            var.dimensions))
+                data = np.ma.filled(var[:].astype(np.float64), np.nan)
+                if var.dimensions[0] != LAT:
+                    data = data.T
+            order = np.argsort(coords.lats)
+            values.append(data[order])
+            times.append(coords.time)
+            lats = coords.lats[order]
+        if lats is None:
+            raise TileError("No {} data for {}".format(entry.plot_type,
+                                                      entry.model))
+        time_axis = np.concatenate(times)
+        order = np.argsort(time_axis, kind='stable')
+        return (np.concatenate(values, axis=1)[:, order], lats,
+                time_axis[order])
+
+    def build(self, entry):
+        """Build the pyramid of the catalog entry (if needed)
+
+        :param entry: Catalog entry (o3api.catalog.ModelEntry)
+        :return: directory of the pyramid
+        """
+        path = self._path(entry)
+        with self._lock:
+            build_lock = self._build_locks.setdefault(path, threading.Lock())
+        with build_lock:
+            if os.path.isdir(path):
+                return path
+            time_start = time.time()
+            values, lats, time_axis = self.read_field(entry)
+            tmp_path = path + ".{}.{}.tmp".format(os.getpid(),
+                                                  threading.get_ident())
+            os.makedirs(tmp_path)
+            valid = ~np.isnan(values)
+            values = np.where(valid, values, 0.)
+            valid = valid.astype(np.int32)
+            try:
+                for lres in LAT_RES:
+                    lat_axis, lat_sums, lat_counts = _bin_sums(
+                        values, valid, lat_bins(lats, lres), axis=0)
+                    for tres in TIME_RES:
+                        t_axis, sums, counts = _bin_sums(
+                            lat_sums, lat_counts, time_bins(time_axis, tres),
+                            axis=1)
+                        # mean of all points of the bin, NaN skipped
+                        with np.errstate(invalid='ignore', divide='ignore'):
+                            level = sums/counts
+                        name = os.path.join(tmp_path,
+                                            "{}_{}".format(tres, lres))
+                        np.save(name + ".values.npy",
+                                level.astype(np.float32))
+                        np.save(name + ".lat.npy", lat_axis)
+                        np.save(name + ".time.npy", t_axis)
+                os.rename(tmp_path, path)
+            except OSError:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                if not os.path.isdir(path): # not built by another process
+                    raise
+            # pyramids of older data of the model
+            model_dir = os.path.dirname(path)
+            for other in os.listdir(model_dir):
+                if (os.path.join(model_dir, other) != path and
+                    not other.endswith(".tmp")):
+                    shutil.rmtree(os.path.join(model_dir, other),
+                                  ignore_errors=True)
+            elapsed = time.time() - time_start
+            with self._lock:
+                self.builds += 1
+                self.build_s += elapsed
+            logger.info("[PYRAMID] built {} {} in {:.2f}s".format(
+                        entry.model, entry.plot_type, elapsed))
+        return path
+
+    def discard(self, entry):
+        """Drop the pyramids of the model other than the one of the
+        catalog entry (older data), it is built at next request
+
+        :param entry: Current catalog entry (o3api.catalog.ModelEntry)
+        :return: number of dropped pyramids
+        """
+        path = self._path(entry)
+        model_dir = os.path.dirname(path)
+        with self._lock:
+            for other in [ p for p in self._loaded
+                           if os.path.dirname(p) == model_dir and p != path ]:
+                del self._loaded[other]
+        removed = 0
+        if os.path.isdir(model_dir):
+            for other in os.listdir(model_dir):
+                if (os.path.join(model_dir, other) != path and
+                    not other.endswith(".tmp")):
+                    shutil.rmtree(os.path.join(model_dir, other),
+                                  ignore_errors=True)
+                    removed += 1
+        return removed
+
+    def _level(self, entry, tres, lres):
+        """Memory mapped arrays of the pyramid level
+        """
+        path = self._path(entry)
+        with self._lock:
+            levels = self._loaded.get(path)
+            if levels is not None:
+                self._loaded.move_to_end(path)
+                self.hits += 1
+        if levels is None:
+            self.build(entry)
+            levels = {}
+            for t in TIME_RES:
+                for l in LAT_RES:
+                    name = os.path.join(path, "{}_{}".format(t, l))
+                    levels[(t, l)] = (np.load(name + ".values.npy",
+                                              mmap_mode='r'),
+                                      np.load(name + ".lat.npy"),
+                                      np.load(name + ".time.npy"))
+            with self._lock:
+                self._loaded[path] = levels
+                while len(self._loaded) > self.max_loaded:
+                    self._loaded.popitem(last=False)
+        return levels[(tres, lres)]
+
+    def is_built(self, model, plot_type):
+        """Check if the pyramid of the current data of the model exists,
+        i.e. a tile is served without reading the data
+
+        :param model: The model
+        :param plot_type: The plot type
+        :rtype: bool
+        """
+        path = self._path(o3catalog.catalog.get_entry(model, plot_type))
+        with self._lock:
+            if path in self._loaded:
+                return True
+        return os.path.isdir(path)
+
+    def get_tile(self, model, plot_type, tres, lres, tx, ty):
+        """Return a tile of the pyramid
+
+        :param model: The model
+        :param plot_type: The plot type, (lat, time) data
+        :param tres: Time resolution, one of TIME_RES
+        :param lres: Latitude resolution, one of LAT_RES
+        :param tx: Tile index in time
+        :param ty: Tile index in latitude
+        :return: tile values (lat, time), its axes and the number of tiles
+        :rtype: dict
+        """
+        if tres not in TIME_RES or str(lres) not in LAT_RES:
+            raise TileError("Resolutions are {} x {}, got {} x {}".format(
+                            TIME_RES, LAT_RES, tres, lres))
+        entry = o3catalog.catalog.get_entry(model, plot_type)
+        values, lat_axis, t_axis = self._level(entry, tres, str(lres))
+        n_tx = max(int(np.ceil(t_axis.size/self.tile_time)), 1)
+        n_ty = max(int(np.ceil(lat_axis.size/self.tile_lat)), 1)
+        if not (0 <= tx < n_tx and 0 <= ty < n_ty):
+            raise TileError("Tile ({}, {}) is out of range ({}, {})".format(
+                            tx, ty, n_tx, n_ty))
+        t_range = slice(tx*self.tile_time, (tx + 1)*self.tile_time)
+        lat_range = slice(ty*self.tile_lat, (ty + 1)*self.tile_lat)
+        with self._lock:
+            self.tiles += 1
+        return { 'values': np.array(values[lat_range, t_range]),
+                 'lat': lat_axis[lat_range],
+                 'time': t_axis[t_range],
+                 'n_tx': n_tx,
+                 'n_ty': n_ty }
+
+    def stats(self):
+        """Return build and tile counters of this process
+
+        :rtype: dict
+        """
+        with self._lock:
+            return { 'builds': self.builds,
+                     'build_s': round(self.build_s, 4),
+                     'loaded': len(self._loaded),
+                     'hits': self.hits,
+                     'tiles': self.tiles }
+
+
+pyramid = TilePyramid(cfg.pyramid_conf['path'],
+                      cfg.pyramid_conf['tile_time'],
+                      cfg.pyramid_conf['tile_lat'],
+                      cfg.pyramid_conf['max_loaded'])
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(
+                description='Build the tile pyramids of o3api models')
+    parser.add_argument('--model', nargs='*', default=None,
+                        help='Models to build, default all')
+    parser.add_argument('--ptype', default=TCO3,
+                        help='Plot type, (lat, time) data')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_args(argv)
+    models = args.model or o3catalog.catalog.list_models()
+    failed = []
+    for model in models:
+        entry = o3catalog.catalog.get_entry(model, args.ptype)
+        if not entry.files:
+            continue
+        try:
+            path = pyramid.build(entry)
+            print("{}: {}".format(model, path))
+        except (OSError, TileError) as e:
+            logger.warning("[PYRAMID] {} failed: {}".format(model, e))
+            failed.append(model)
+    if failed:
+        print("failed: {}".format(", ".join(failed)), file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Replay of recorded requests for performance regression testing.
+# Requests are recorded by o3api.api if $O3API_REQUEST_LOG is set.
+#
+# Example:
+# $ o3api-replay run requests.log* --url http://127.0.0.1:5005 \
+#                --speed 4 --output build_a.json
+# $ o3api-replay diff build_a.json build_b.json
+
+import argparse
+import glob
+import json
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import o3api.config as cfg
+import o3api.loadtest as o3load
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+
+def load_log(paths):
+    """Read recorded requests from (possibly rotated) log files
+
+    :param paths: list of log files or glob patterns
+    :return: records sorted by the time of the original request
+    :rtype: list
+    """
+    records = []
+    for pattern in paths:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        logger.warning("Skip malformed record in {}: {}"
+                                       .format(path, line[:80]))
+    records.sort(key=lambda r: r['ts'])
+    return records
+
+
+def request_kind(record):
+    """Classify the recorded request, same kinds as in :mod:`o3api.loadtest`
+
+    :param record: Recorded request
+    :return: plot_json, plot_pdf or the endpoint name
+    :rtype: string
+    """
+    if record['endpoint'] == 'plot':
+        pdf = record.get('accept', '') == 'application/pdf'
+        return 'plot_pdf' if pdf else 'plot_json'
+    return record['endpoint']
+
+
+def to_request(record):
+    """Convert the recorded request to path, query and headers
+
+    :param record: Recorded request
+    :return: path, list of query parameters, headers
+    :rtype: tuple
+    """
+    query = []
+    for key, value in record['params'].items():
+        if key == 'body': # sent as JSON, see replay()
+            continue
+        if isinstance(value, bool): # as parsed by the API
+            query.append((key, str(value).lower()))
+        elif isinstance(value, list): # model, month, bands: csv arrays
+            if value: # empty: the default
+                query.append((key, ",".join(str(v) for v in value)))
+        else:
+            query.append((key, value))
+    headers = {'Accept': record.get('accept') or 'application/json'}
+    if 'body' in record['params']:
+        headers['Content-Type'] = 'application/json'
+    return '/api/' + record['endpoint'], query, headers
+
+
+def replay(url, records, speed=1., concurrency=8, timeout=600):
+    """Re-issue recorded requests against a running service
+
+    :param url: Base URL of the service
+    :param records: Recorded requests, see :func:`load_log`
+    :param speed: Pace relative to the original one (2 = twice faster),
+                  0 to send requests as fast as `concurrency` allows
+    :param concurrency: Maximum number of requests in flight
+    :return: list of (kind, status, latency, size), elapsed time
+    """
+    lock = threading.Lock()
+    results = []
+    if not records:
+        return results, 0.
+
+    def _execute(record, time_scheduled=None):
+        status, latency, size = o3load.send_request(
+                                    url, *to_request(record),
+                                    body=record['params'].get('body'),
+                                    timeout=timeout,
+                                    time_start=time_scheduled)
+        with lock:
+            results.append((request_kind(record), status, latency, size))
+
+    ts_first = records[0]['ts']
+    time_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for record in records:
+            t_next = None # as fast as possible: from the send time
+            if speed > 0: # latency from the scheduled time
+                t_next = time_start + (record['ts'] - ts_first)/speed
+                time.sleep(max(0., t_next - time.perf_counter()))
+            pool.submit(_execute, record, t_next)
+
+    return results, time.perf_counter() - time_start
+
+
+def diff(summary_a, summary_b):
+    """Compare latency distributions of two replays (e.g. two builds)
+
+    :param summary_a: Summary of the reference replay
+    :param summary_b: Summary of the replay to compare
+    :return: relative change (b/a - 1) overall and per request kind
+    :rtype: dict
+    """
+    result = {'total': o3load.compare(summary_b, summary_a), 'kinds': {}}
+    for kind, stats_a in summary_a['kinds'].items():
+        stats_b = summary_b['kinds'].get(kind)
+        if stats_b:
+            result['kinds'][kind] = o3load.compare(stats_b, stats_a)
+    return result
+
+
+def print_diff(summary_a, summary_b, stream=sys.stdout):
+    """Print the side-by-side comparison of two replays
+    """
+    line = "{:<16} {:>6} {:>12} {:>12} {:>9}"
+    print(line.format('kind', 'pct', 'A ms', 'B ms', 'change'), file=stream)
+    kinds = list(summary_a['kinds'].items()) + [('total', summary_a)]
+    for kind, stats_a in kinds:
+        stats_b = summary_b if kind == 'total' else summary_b['kinds'].get(kind)
+        if stats_b is None:
+            continue
+        for p in o3load.PERCENTILES:
+            key = "p{}_ms".format(p)
+            a, b = stats_a.get(key), stats_b.get(key)
+            change = "{:+.1%}".format(b/a - 1.) if a and b is not None else '-'
+            print(line.format(kind, key[:-3], str(a), str(b), change),
+                  file=stream)
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(
+                description='Replay recorded o3api requests')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='Replay a request log')
+    run_parser.add_argument('log', nargs='+',
+                            help='Request log file(s), e.g. requests.log*')
+    run_parser.add_argument('--url', default='http://127.0.0.1:5005',
+                            help='Base URL of the service')
+    run_parser.add_argument('--speed', type=float, default=1.,
+                            help='Pace relative to the original one, '
+                                 '0 = as fast as possible')
+    run_parser.add_argument('--concurrency', type=int, default=8,
+                            help='Maximum number of requests in flight')
+    run_parser.add_argument('--limit', type=int, default=None,
+                            help='Replay only the first N requests')
+    run_parser.add_argument('--output', default=None,
+                            help='Store the summary as JSON file')
+
+    diff_parser = subparsers.add_parser('diff',
+                            help='Compare summaries of two replays')
+    diff_parser.add_argument('summary_a', help='Reference summary (JSON)')
+    diff_parser.add_argument('summary_b', help='Summary to compare (JSON)')
+    diff_parser.add_argument('--max-regression', type=float, default=0.1,
+                             help='Tolerated relative change of B vs A, '
+                                  'exit with 1 if exceeded')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_args(argv)
+    if args.command == 'diff':
+        with open(args.summary_a) as f:
+            summary_a = json.load(f)
+        with open(args.summary_b) as f:
+            summary_b = json.load(f)
+        print_diff(summary_a, summary_b)
+        worse = o3load.regressed(summary_b, summary_a, args.max_regression)
+        if worse:
+            print("Regression of B vs A: {}".format(', '.join(worse)),
+                  file=sys.stderr)
+        return 1 if worse else 0
+
+    records = load_log(args.log)[:args.limit]
+    logger.info("Replaying {} requests against {}".format(len(records),
+                                                          args.url))
+    results, elapsed = replay(args.url, records, speed=args.speed,
+                              concurrency=args.concurrency)
+    summary = o3load.summarize(results, elapsed)
+    summary['config'] = {k: v for k, v in vars(args).items()
+                         if k != 'output'}
+    o3load.print_report(summary)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Results of the processing (series per model, reference values, level x
+# time fields, return tables) stored on disk, shared by the worker
+# processes and replicas of a node and kept over restarts. The key of a
+# result includes model, plot type, period, months, latitudes and the data
+# fingerprint (see DataSelection._cache_key in o3api/plots.py), so changed
+# data is never served from the store. Every result is a .npz file (numpy
+# arrays only, no pickle), an sqlite index keeps size and last use; files
+# are written to a temporary file and renamed into place, least recently
+# used results are removed to stay within max_bytes.
+
+import hashlib
+import logging
+import numpy as np
+import o3api.config as cfg
+import os
+import pandas as pd
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+INDEX_FILE = 'index.sqlite'
+
+
+def _labels(index):
+    """Values of the index, labels (object dtype) as strings
+    """
+    values = index.values
+    return values.astype(str) if values.dtype == object else values
+
+
+def _encode(value, prefix=''):
+    """Arrays of the result for np.savez
+
+    :param value: float, numpy array, pandas Series or DataFrame,
+                  or a tuple of them
+    :return: dict of arrays
+    """
+    if isinstance(value, tuple):
+        arrays = { prefix + 'kind': np.array('tuple'),
+                   prefix + 'n': np.array(len(value)) }
+        for i, item in enumerate(value):
+            arrays.update(_encode(item, "{}{}.".format(prefix, i)))
+    elif isinstance(value, pd.Series):
+        arrays = { prefix + 'kind': np.array('series'),
+                   prefix + 'values': value.values,
+                   prefix + 'index': _labels(value.index) }
+        if value.name is not None:
+            arrays[prefix + 'name'] = np.array(value.name)
+    elif isinstance(value, pd.DataFrame):
+        arrays = { prefix + 'kind': np.array('frame'),
+                   prefix + 'values': value.values,
+                   prefix + 'index': _labels(value.index),
+                   prefix + 'columns': _labels(value.columns) }
+        if value.columns.name is not None:
+            arrays[prefix + 'columns_name'] = np.array(value.columns.name)
+    else:
+        arrays = { prefix + 'kind': np.array('array'),
+                   prefix + 'values': np.asarray(value) }
+    return arrays
+
+
+def _decode(stored, prefix=''):
+    """Result from the arrays written by :func:`_encode`
+    """
+    kind = str(stored[prefix + 'kind'])
+    if kind == 'tuple':
+        return tuple(_decode(stored, "{}{}.".format(prefix, i))
+                     for i in range(int(stored[prefix + 'n'])))
+    values = stored[prefix + 'values']
+    if kind == 'series':
+        name = (str(stored[prefix + 'name'])
+                if prefix + 'name' in stored else None)
+        return pd.Series(values, index=pd.Index(stored[prefix + 'index']),
+                         name=name)
+    if kind == 'frame':
+        columns_name = (str(stored[prefix + 'columns_name'])
+                        if prefix + 'columns_name' in stored else None)
+        return pd.DataFrame(values, index=pd.Index(stored[prefix + 'index']),
+                            columns=pd.Index(stored[prefix + 'columns'],
+                                             name=columns_name))
+    return values[()] if values.ndim == 0 else values
+
+
+class ResultStore:
+    """Disk-backed LRU store of processing results
+
+    :param directory: Directory of the index and the result files
+    :param max_bytes: Budget for all result files together
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._local = threading.local() # sqlite connection per thread
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.errors = 0
+
+    @staticmethod
+    def key_name(key):
+        """File name stem for the key
+
+        :param key: Any repr-able key
+        :rtype: string
+        """
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + ".npz")
+
+    def _db(self):
+        """sqlite connection of this thread (and process)
+        """
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            os.makedirs(self.directory, exist_ok=True)
+            db = sqlite3.connect(os.path.join(self.directory, INDEX_FILE),
+                                 timeout=30., isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS results ("
+                       "name TEXT PRIMARY KEY, key TEXT, "
+                       "nbytes INTEGER, last_used REAL)")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _count(self, counter, n=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + n)
+
+    def _remove(self, db, names):
+        """Remove the results from the index and their files
+        """
+        for name in names:
+            db.execute("DELETE FROM results WHERE name = ?", (name,))
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+
+    def get(self, key):
+        """Return the stored result or None
+
+        :param key: Result key
+        """
+        name = self.key_name(key)
+        try:
+            db = self._db()
+            if db.execute("SELECT 1 FROM results WHERE name = ?",
+                          (name,)).fetchone() is None:
+                self._count('misses')
+                return None
+            with np.load(self._path(name), allow_pickle=False) as stored:
+                value = _decode(stored)
+            db.execute("UPDATE results SET last_used = ? WHERE name = ?",
+                       (time.time(), name))
+        except (OSError, ValueError, KeyError, sqlite3.Error) as e:
+            logger.debug("[RESULTSTORE] {} not available: {}".format(name, e))
+            self._count('misses')
+            return None
+        self._count('hits')
+        return value
+
+    def put(self, key, value):
+        """Store the result, removing the least recently used ones
+        to stay within max_bytes
+
+        :param key: Result key
+        :param value: float, numpy array, pandas Series or DataFrame,
+                      or a tuple of them
+        """
+        name = self.key_name(key)
+        path = self._path(name)
+        tmp_path = path + ".{}.{}.tmp".format(os.getpid(),
+                                              threading.get_ident())
+        try:
+            db = self._db()
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **_encode(value))
+            nbytes = os.path.getsize(tmp_path)
+            if nbytes > self.max_bytes:
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, path)
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("INSERT OR REPLACE INTO results "
+                           "VALUES (?, ?, ?, ?)",
+                           (name, repr(key), nbytes, time.time()))
+                used = db.execute("SELECT SUM(nbytes) FROM results") \
+                         .fetchone()[0]
+                victims = []
+                for victim, size in db.execute(
+                        "SELECT name, nbytes FROM results WHERE name != ? "
+                        "ORDER BY last_used", (name,)):
+                    if used <= self.max_bytes:
+                        break
+                    victims.append(victim)
+                    used -= size
+                self._remove(db, victims)
+                db.execute("COMMIT")
+            except sqlite3.Error:
+                db.execute("ROLLBACK")
+                raise
+        except (OSError, ValueError, sqlite3.Error) as e:
+            logger.warning("[RESULTSTORE] failed to store {}: {}".format(name,
+                                                                         e))
+            self._count('errors')
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._count('writes')
+        self._count('evictions', len(victims))
+
+    def discard(self, fingerprint):
+        """Remove the results computed from the data with the fingerprint
+
+        :param fingerprint: Data fingerprint, see o3api.catalog.ModelEntry
+        :return: number of removed results
+        """
+        try:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                names = [ row[0] for row in db.execute(
+                              "SELECT name FROM results "
+                              "WHERE instr(key, ?) > 0",
+                              (repr(fingerprint),)) ]
+                self._remove(db, names)
+                db.execute("COMMIT")
+            except sqlite3.Error:
+                db.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            logger.warning("[RESULTSTORE] failed to discard: {}".format(e))
+            self._count('errors')
+            return 0
+        return len(names)
+
+    def stats(self):
+        """Return store statistics of this process and the node
+
+        :rtype: dict
+        """
+        try:
+            entries, used = self._db().execute(
+                "SELECT COUNT(*), SUM(nbytes) FROM results").fetchone()
+        except sqlite3.Error:
+            entries, used = 0, 0
+        with self._lock:
+            lookups = self.hits + self.misses
+            return { 'entries': entries,
+                     'bytes': used or 0,
+                     'max_bytes': self.max_bytes,
+                     'hits': self.hits,
+                     'misses': self.misses,
+                     'hit_ratio': (round(self.hits/lookups, 4)
+                                   if lookups else 0.),
+                     'writes': self.writes,
+                     'evictions': self.evictions,
+                     'errors': self.errors }
+
+
+result_store = ResultStore(cfg.result_store_conf['path'],
+                           cfg.result_store_conf['max_bytes'])
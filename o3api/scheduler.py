@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Cost-aware scheduling of requests inside a worker process.
+# Requests are classified by their estimated cost (see o3api.admission)
+# and executed on separate lanes, each with its own number of slots:
+# 'fast' for small JSON and metadata calls, 'bulk' for large requests.
+# Inside a lane identities are served in turns (least recently served
+# first), and a bulk request waiting longer than max_wait may take
+# a free fast slot, so it does not starve. A request waiting longer than
+# max_queue_wait is rejected (503 with Retry-After, see o3api.admission).
+# Only useful with threaded workers (gunicorn --threads).
+
+import collections
+import logging
+import numpy as np
+import o3api.admission as o3admission
+import o3api.config as cfg
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+FAST = 'fast'
+BULK = 'bulk'
+LANES = [FAST, BULK]
+
+# number of recent wait times kept per lane for statistics
+WAIT_HISTORY = 1000
+
+
+class _Ticket:
+    """Request waiting for a slot
+    """
+    def __init__(self, lane, identity):
+        self.lane = lane
+        self.identity = identity
+        self.enqueued = time.monotonic()
+        self.slot_lane = None
+
+
+class Scheduler:
+    """Schedule requests on the fast and bulk lanes
+
+    :param fast_slots: Number of requests running in parallel, fast lane
+    :param bulk_slots: Number of requests running in parallel, bulk lane
+    :param fast_max_cost: Requests up to this cost go to the fast lane
+    :param max_wait: After this time (s) a bulk request may use a fast slot
+    :param max_queue_wait: After this time (s) a waiting request is
+                           rejected, 0 to wait without limit
+    :param retry_after: Retry-After (s) of a rejected request
+    """
+    def __init__(self, fast_slots, bulk_slots, fast_max_cost, max_wait,
+                 max_queue_wait=0., retry_after=5):
+        self.slots = { FAST: fast_slots, BULK: bulk_slots }
+        self.fast_max_cost = fast_max_cost
+        self.max_wait = max_wait
+        self.max_queue_wait = max_queue_wait
+        self.retry_after = retry_after
+        self._cond = threading.Condition()
+        # lane -> identity -> waiting tickets
+        self._queues = { lane: collections.OrderedDict() for lane in LANES }
+        self._running = { lane: 0 for lane in LANES }
+        self._last_served = {} # (lane, identity) -> time
+        self._served = { lane: 0 for lane in LANES }
+        self._promoted = 0
+        self._timeouts = 0
+        self._waits = { lane: collections.deque(maxlen=WAIT_HISTORY)
+                        for lane in LANES }
+
+    def classify(self, cost):
+        """Select the lane for the request of the given cost
+
+        :param cost: Estimated cost of the request
+        :return: lane name
+        """
+        return FAST if cost <= self.fast_max_cost else BULK
+
+    def _head(self, lane):
+        """Return the ticket to run next in the lane: the oldest ticket
+        of the least recently served identity
+        """
+        queue = self._queues[lane]
+        if not queue:
+            return None
+        identity = min(queue,
+                       key=lambda i: (self._last_served.get((lane, i), 0.),
+                                      queue[i][0].enqueued))
+        return queue[identity][0]
+
+    def _dequeue(self, ticket):
+        """Remove the ticket from its queue, forget when identities
+        without waiting tickets were served if it does not change the turns
+        """
+        queue = self._queues[ticket.lane]
+        queue[ticket.identity].remove(ticket)
+        if queue[ticket.identity]:
+            return
+        del queue[ticket.identity]
+        # identities served before all waiting ones would still come first
+        # (as never served ones), entries are kept only while needed
+        oldest = min((self._last_served.get((ticket.lane, i), 0.)
+                      for i in queue), default=float('inf'))
+        for key in [ key for key, served in self._last_served.items()
+                     if key[0] == ticket.lane and key[1] not in queue and
+                        served < oldest ]:
+            del self._last_served[key]
+
+    def _free(self, lane):
+        return self._running[lane] < self.slots[lane]
+
+    def _grant(self, ticket):
+        """Return the lane whose slot the ticket may use, None to wait
+        """
+        if ticket is not self._head(ticket.lane):
+            return None
+        if self._free(ticket.lane):
+            return ticket.lane
+        # starvation protection: a long waiting bulk request
+        # takes a free fast slot, if no fast request is waiting
+        if (ticket.lane == BULK and self._free(FAST) and
+            not self._queues[FAST] and
+            time.monotonic() - ticket.enqueued > self.max_wait):
+            return FAST
+        return None
+
+    def acquire(self, ticket):
+        """Block until the ticket gets a slot
+
+        :raises o3api.admission.Overloaded: waited longer than max_queue_wait
+        """
+        with self._cond:
+            queue = self._queues[ticket.lane]
+            queue.setdefault(ticket.identity, collections.deque()).append(ticket)
+            while True:
+                slot_lane = self._grant(ticket)
+                if slot_lane is not None:
+                    break
+                waited = time.monotonic() - ticket.enqueued
+                if self.max_queue_wait > 0 and waited >= self.max_queue_wait:
+                    self._dequeue(ticket)
+                    self._timeouts += 1
+                    self._cond.notify_all() # the next ticket may be granted
+                    raise o3admission.Overloaded(
+                        "Service is busy: waited {:.1f}s for a {} slot"
+                        .format(waited, ticket.lane), self.retry_after)
+                # wake up periodically to re-check starvation
+                timeout = min(self.max_wait, 1.)
+                if self.max_queue_wait > 0:
+                    timeout = min(timeout, self.max_queue_wait - waited)
+                self._cond.wait(timeout=timeout)
+
+            ticket.slot_lane = slot_lane
+            self._running[slot_lane] += 1
+            now = time.monotonic()
+            self._last_served[(ticket.lane, ticket.identity)] = now
+            self._dequeue(ticket)
+            self._served[ticket.lane] += 1
+            self._promoted += int(slot_lane != ticket.lane)
+            self._waits[ticket.lane].append(now - ticket.enqueued)
+            self._cond.notify_all()
+
+    def release(self, ticket):
+        """Free the slot taken by the ticket
+        """
+        with self._cond:
+            self._running[ticket.slot_lane] -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def run(self, cost, identity):
+        """Context manager to execute a request of the given cost
+
+        :param cost: Estimated cost of the request
+        :param identity: Who sends the request
+        """
+        ticket = _Ticket(self.classify(cost), identity)
+        self.acquire(ticket)
+        wait = time.monotonic() - ticket.enqueued
+        logger.debug("[SCHEDULER] {} lane, waited {:.3f}s".format(ticket.lane,
+                                                                  wait))
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self):
+        """Queue depth and wait time statistics per lane
+
+        :rtype: dict
+        """
+        with self._cond:
+            stats = { 'promoted': self._promoted,
+                      'timeouts': self._timeouts,
+                      'identities': len(self._last_served) }
+            for lane in LANES:
+                waits = np.asarray(self._waits[lane])
+                stats[lane] = {
+                    'slots': self.slots[lane],
+                    'running': self._running[lane],
+                    'queued': sum(len(q) for q in self._queues[lane].values()),
+                    'served': self._served[lane],
+                    'wait_mean_s': (round(float(waits.mean()), 4)
+                                    if waits.size else 0.),
+                    'wait_p95_s': (round(float(np.percentile(waits, 95)), 4)
+                                   if waits.size else 0.),
+                    'wait_max_s': (round(float(waits.max()), 4)
+                                   if waits.size else 0.)
+                }
+        return stats
+
+
+scheduler = Scheduler(cfg.scheduler_conf['fast_slots'],
+                      cfg.scheduler_conf['bulk_slots'],
+                      cfg.scheduler_conf['fast_max_cost'],
+                      cfg.scheduler_conf['max_wait'],
+                      cfg.scheduler_conf['max_queue_wait'],
+                      cfg.admission_conf['retry_after_busy'])
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Cache of model arrays shared by all worker processes of a node.
+# Arrays are stored as .npy files in a tmpfs directory (default /dev/shm)
+# and memory mapped read-only, so the kernel keeps one copy of the pages
+# for all workers. A shared index (JSON, guarded by flock) keeps size,
+# last use and references (per PID) of every entry. An entry is referenced
+# while a request uses it (between get/put and release). Entries not
+# referenced by any live process are evicted in LRU order to stay within
+# max_bytes. An evicted file which is still mapped by a process stays valid
+# there until the mapping is dropped (POSIX unlink semantics).
+
+import fcntl
+import hashlib
+import json
+import logging
+import numpy as np
+import o3api.config as cfg
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+INDEX_FILE = 'index.json'
+LOCK_FILE = 'index.lock'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedArrayCache:
+    """Node-wide cache of numpy arrays in memory mapped files
+
+    :param directory: Directory for the cache, preferably on tmpfs
+    :param max_bytes: Budget for all cached arrays together
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._local = {} # key -> (arrays, meta), mapped in this process
+        self._local_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key_name(key):
+        """File name stem for the key
+
+        :param key: Any repr-able key, e.g. (plot_type, model, fingerprint)
+        :rtype: string
+        """
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    @contextmanager
+    def _index(self):
+        """Lock the shared index and yield it, the index is written back
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                path = os.path.join(self.directory, INDEX_FILE)
+                try:
+                    with open(path) as f:
+                        index = json.load(f)
+                except (OSError, ValueError):
+                    index = {}
+                yield index
+                tmp_path = path + ".{}".format(os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump(index, f)
+                os.replace(tmp_path, path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _paths(self, name, fields):
+        return { field: os.path.join(self.directory,
+                                     "{}.{}.npy".format(name, field))
+                 for field in fields }
+
+    def _remove_files(self, entry):
+        for path in entry['files'].values():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _evict(self, index, needed):
+        """Evict unreferenced entries (LRU first) to free `needed` bytes
+        """
+        for entry in index.values():
+            entry['refs'] = { pid: n for pid, n in entry['refs'].items()
+                              if n > 0 and _pid_alive(int(pid)) }
+        used = sum(e['nbytes'] for e in index.values())
+        for name, entry in sorted(index.items(),
+                                  key=lambda item: item[1]['last_used']):
+            if used + needed <= self.max_bytes:
+                break
+            if entry['refs']:
+                continue
+            self._remove_files(entry)
+            del index[name]
+            used -= entry['nbytes']
+            self.evictions += 1
+            logger.debug("[SHMCACHE] evicted {}".format(name))
+        return used + needed <= self.max_bytes
+
+    def _map(self, entry):
+        arrays = { field: np.load(path, mmap_mode='r')
+                   for field, path in entry['files'].items() }
+        return arrays, entry['meta']
+
+    def _prune_local(self, index):
+        """Drop local mappings of entries evicted by other processes
+        """
+        with self._local_lock:
+            for name in [n for n in self._local if n not in index]:
+                del self._local[name]
+
+    def get(self, key):
+        """Return the cached arrays and metadata, or None.
+        The entry is referenced until :meth:`release` is called.
+
+        :param key: Cache key
+        :return: dict of read-only arrays, metadata dict
+        """
+        name = self.key_name(key)
+        pid = str(os.getpid())
+        with self._index() as index:
+            self._prune_local(index)
+            entry = index.get(name)
+            if entry is None:
+                self.misses += 1
+                return None
+            with self._local_lock:
+                local = self._local.get(name)
+            if local is None:
+                try:
+                    local = self._map(entry)
+                except (OSError, ValueError) as e:
+                    logger.warning("[SHMCACHE] broken entry {}: {}"
+                                   .format(name, e))
+                    self._remove_files(entry)
+                    del index[name]
+                    self.misses += 1
+                    return None
+                with self._local_lock:
+                    self._local[name] = local
+            entry['last_used'] = time.time()
+            entry['refs'][pid] = entry['refs'].get(pid, 0) + 1
+        self.hits += 1
+        return local
+
+    def put(self, key, arrays, meta):
+        """Store the arrays (if they fit into the budget) and map them.
+        The entry is referenced until :meth:`release` is called.
+
+        :param key: Cache key
+        :param arrays: dict of numpy arrays
+        :param meta: JSON serializable metadata
+        :return: dict of mapped read-only arrays (or the given arrays if
+                 they could not be cached), metadata
+        """
+        name = self.key_name(key)
+        nbytes = sum(a.nbytes for a in arrays.values())
+        if nbytes > self.max_bytes:
+            return arrays, meta
+
+        paths = self._paths(name, arrays.keys())
+        pid = str(os.getpid())
+        with self._index() as index:
+            self._prune_local(index)
+            if name not in index:
+                if not self._evict(index, nbytes):
+                    logger.debug("[SHMCACHE] no space for {}".format(name))
+                    return arrays, meta
+                for field, array in arrays.items():
+                    tmp_path = paths[field] + ".{}.tmp".format(pid)
+                    with open(tmp_path, 'wb') as f:
+                        np.save(f, np.ascontiguousarray(array))
+                    os.replace(tmp_path, paths[field])
+                index[name] = { 'files': paths, 'nbytes': nbytes,
+                                'meta': meta, 'last_used': time.time(),
+                                'refs': {} }
+            entry = index[name]
+            local = self._map(entry)
+            entry['refs'][pid] = entry['refs'].get(pid, 0) + 1
+        with self._local_lock:
+            self._local[name] = local
+        return local
+
+    def release(self, key):
+        """Drop the reference taken by :meth:`get` or :meth:`put`,
+        the entry may be evicted afterwards
+
+        :param key: Cache key
+        """
+        name = self.key_name(key)
+        pid = str(os.getpid())
+        with self._index() as index:
+            entry = index.get(name)
+            if entry is not None and entry['refs'].get(pid, 0) > 0:
+                entry['refs'][pid] -= 1
+
+    def discard(self, model, plot_type):
+        """Remove the entries of the model, also referenced ones:
+        the mapped files stay valid for the processes using them
+
+        :param model: The model name
+        :param plot_type: The plot type (e.g. tco3_zm, vmro3_zm, ...)
+        :return: number of removed entries
+        """
+        removed = 0
+        with self._index() as index:
+            for name, entry in list(index.items()):
+                if (entry['meta'].get('model') == model and
+                    entry['meta'].get('plot_type') == plot_type):
+                    self._remove_files(entry)
+                    del index[name]
+                    removed += 1
+            self._prune_local(index)
+        return removed
+
+    def clear(self):
+        """Remove all unreferenced entries
+        """
+        with self._index() as index:
+            self._evict(index, self.max_bytes + 1)
+
+    def stats(self):
+        """Return cache statistics for this process and the node
+
+        :rtype: dict
+        """
+        with self._index() as index:
+            used = sum(e['nbytes'] for e in index.values())
+            entries = len(index)
+        return { 'entries': entries,
+                 'bytes': used,
+                 'max_bytes': self.max_bytes,
+                 'mapped': len(self._local),
+                 'hits': self.hits,
+                 'misses': self.misses,
+                 'evictions': self.evictions }
+
+
+shm_cache = SharedArrayCache(cfg.shm_cache_conf['path'],
+                             cfg.shm_cache_conf['max_bytes'])
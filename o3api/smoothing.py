@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Smoothing of series: the series of all models of a request are put on a
+# common monthly time axis as a (models x time) array and filtered in one
+# vectorized pass. Moving averages are computed from cumulative sums of
+# the values and of the number of valid points, so NaNs are skipped and
+# the cost does not depend on the window (short windows without NaNs are
+# summed directly from shifted slices). Windows are centered; at the
+# first and last points of a model they shrink symmetrically (the end
+# points are kept as they are), so the curve is not shifted at the edges.
+#
+# Filters, given as "name" or "name:parameter" (smooth in /api/plot):
+#   none         no smoothing
+#   boxcar:N     N points with equal weights (default 3), for even N
+#                the window is half a point early (as pandas rolling)
+#   centered:N   centered moving average (default 12), for even N the
+#                2xN average: N+1 points, half weight at both ends
+#   exp:ALPHA    exponential moving average (default 0.3), 0 < ALPHA <= 1
+#   annual       centered moving average over the points of one year
+
+import logging
+import numpy as np
+import o3api.config as cfg
+import pandas as pd
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+# windows up to this size are summed directly, longer ones from
+# cumulative sums
+DIRECT_MAX = 8
+
+# filter -> default parameter
+FILTERS = { 'none': None,
+            'boxcar': 3,
+            'centered': 12,
+            'exp': 0.3,
+            'annual': None }
+
+
+class SmoothingError(ValueError):
+    """The smoothing filter is not valid (HTTP 400)
+    """
+    status = 400
+
+
+def parse(spec):
+    """Filter and its parameter from "name" or "name:parameter"
+
+    :param spec: The filter, e.g. "boxcar:5", None for no smoothing
+    :return: name, parameter
+    :rtype: tuple
+    """
+    name, _, param = (spec or 'none').strip().lower().partition(':')
+    if name not in FILTERS:
+        raise SmoothingError("Smoothing filters are {}, got {}".format(
+                             sorted(FILTERS), spec))
+    if not param:
+        return name, FILTERS[name]
+    if FILTERS[name] is None:
+        raise SmoothingError("{} takes no parameter, got {}".format(name,
+                                                                    spec))
+    try:
+        value = float(param) if name == 'exp' else int(param)
+    except ValueError:
+        raise SmoothingError("Invalid parameter of {}: {}".format(name, param))
+    if (name == 'exp' and not 0. < value <= 1.) or (name != 'exp' and
+                                                     value < 1):
+        raise SmoothingError("Parameter of {} out of range: {}".format(name,
+                                                                       value))
+    return name, value
+
+
+def _windows(valid, left, right, edges):
+    """Bounds [lo, hi) of the window at every point
+
+    :param valid: (rows, time) mask of the values
+    :param left: Points before the point in a full window
+    :param right: Points after the point in a full window
+    :param edges: 'shrink': symmetric window shrunk at the first and last
+                  valid point of every row; 'truncate': window cut at the
+                  ends of the array
+    :return: lo, hi as (rows, time) arrays, or (time,) arrays if they
+             are the same for all rows
+    """
+    n = valid.shape[-1]
+    points = np.arange(n)
+    if edges == 'truncate' or n == 0:
+        return (np.clip(points - left, 0, n),
+                np.clip(points + right + 1, 0, n))
+    first = np.argmax(valid, axis=-1)[..., np.newaxis]
+    last = n - 1 - np.argmax(valid[..., ::-1], axis=-1)[..., np.newaxis]
+    if (first == first[0]).all() and (last == last[0]).all():
+        first, last = first[0], last[0] # e.g. same period of all models
+    radius = np.clip(np.minimum(points - first, last - points), 0, None)
+    lo = points - np.minimum(radius, left)
+    hi = points + np.where(radius >= left, right,
+                           np.minimum(radius, right)) + 1
+    return lo, hi
+
+
+def _take(array, index):
+    """Values at the index along the last axis, the same for all rows
+    if the index is 1-D
+    """
+    if index.ndim == 1:
+        return array[..., index]
+    return np.take_along_axis(array, index, -1)
+
+
+def _regular(lo, hi):
+    """Range [a, b) of the points with full windows, the same for all
+    rows and shifted by one point from one to the next
+
+    :return: a, b; None if the windows differ per row or are irregular
+    """
+    if lo.ndim > 1 or lo.size == 0:
+        return None
+    size = hi - lo
+    full = np.flatnonzero(size == size.max())
+    a, b = full[0], full[-1] + 1
+    if (full.size != b - a or
+        not np.array_equal(lo[a:b], np.arange(lo[a], lo[a] + b - a))):
+        return None
+    return a, b
+
+
+def _window_diff(cumulative, lo, hi):
+    """Differences of the cumulative sums over the windows [lo, hi);
+    full windows are taken as slices, only the windows at the edges are
+    gathered point by point
+    """
+    regular = _regular(lo, hi)
+    if regular is None:
+        return _take(cumulative, hi) - _take(cumulative, lo)
+    a, b = regular
+    result = np.empty(cumulative.shape[:-1] + lo.shape)
+    result[..., a:b] = (cumulative[..., hi[a]:hi[a] + b - a] -
+                        cumulative[..., lo[a]:lo[a] + b - a])
+    edges = np.r_[0:a, b:lo.size]
+    result[..., edges] = (_take(cumulative, hi[edges]) -
+                          _take(cumulative, lo[edges]))
+    return result
+
+
+def _direct_sums(values, lo, hi):
+    """Sums over short windows [lo, hi) as sums of shifted slices
+
+    :return: sums; None if the windows are long or irregular
+    """
+    regular = _regular(lo, hi)
+    if regular is None or hi[regular[0]] - lo[regular[0]] > DIRECT_MAX:
+        return None
+    a, b = regular
+    result = np.empty(values.shape[:-1] + lo.shape)
+    inner = result[..., a:b]
+    inner[...] = values[..., lo[a]:lo[a] + b - a]
+    for shift in range(1, hi[a] - lo[a]):
+        inner += values[..., lo[a] + shift:lo[a] + shift + b - a]
+    for point in np.r_[0:a, b:lo.size]:
+        result[..., point] = values[..., lo[point]:hi[point]].sum(axis=-1)
+    return result
+
+
+def _sums(values, valid, lo, hi):
+    """Sums and numbers of the valid values in the windows [lo, hi)
+    """
+    shape = values.shape[:-1] + (values.shape[-1] + 1,)
+    if valid.all(): # usual case, the numbers are the window sizes
+        sums = _direct_sums(values, lo, hi)
+        if sums is None:
+            cumulative = np.zeros(shape)
+            np.cumsum(values, axis=-1, out=cumulative[..., 1:])
+            sums = _window_diff(cumulative, lo, hi)
+        return sums, (hi - lo).astype(float)
+    sums = np.zeros(shape)
+    np.cumsum(np.where(valid, values, 0.), axis=-1, out=sums[..., 1:])
+    counts = np.zeros(shape, dtype=np.int32)
+    np.cumsum(valid, axis=-1, out=counts[..., 1:])
+    return _window_diff(sums, lo, hi), _window_diff(counts, lo, hi)
+
+
+def boxcar(values, window, edges='shrink'):
+    """Moving average with equal weights along the last axis, NaN skipped
+
+    :param values: array, time along the last axis
+    :param window: Number of points
+    :param edges: 'shrink' or 'truncate', see :func:`_windows`
+    :return: smoothed array, NaN where the window has no data
+    """
+    values = np.asarray(values)
+    window = max(int(window), 1)
+    valid = ~np.isnan(values)
+    lo, hi = _windows(np.atleast_2d(valid), window//2, (window - 1)//2, edges)
+    sums, counts = _sums(np.atleast_2d(values), np.atleast_2d(valid), lo, hi)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums/counts).reshape(values.shape)
+
+
+def centered(values, window, edges='shrink'):
+    """Centered moving average along the last axis, NaN skipped;
+    for an even window the 2xN average (half weight at both ends)
+
+    :param values: array, time along the last axis
+    :param window: Number of points
+    :param edges: 'shrink' or 'truncate', see :func:`_windows`
+    :return: smoothed array, NaN where the window has no data
+    """
+    window = max(int(window), 1)
+    if window % 2:
+        return boxcar(values, window, edges)
+    values = np.asarray(values)
+    half = window//2
+    valid = np.atleast_2d(~np.isnan(values))
+    data = np.atleast_2d(values)
+    lo, hi = _windows(valid, half, half, edges)
+    full = (hi - lo) == window + 1
+    # full windows: N-1 inner points, the two end points with half weight
+    sums, counts = _sums(data, valid, lo + full, hi - full)
+    n = data.shape[-1]
+    for end in [lo, hi - 1]:
+        point = np.clip(end, 0, n - 1)
+        weight = 0.5*(full & _take(valid, point))
+        sums = sums + weight*np.nan_to_num(_take(data, point))
+        counts = counts + weight
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums/counts).reshape(values.shape)
+
+
+def exponential(values, alpha):
+    """Exponential moving average along the last axis, NaN skipped
+
+    :param values: array, time along the last axis
+    :param alpha: Weight of the new point, 0 < alpha <= 1
+    :return: smoothed array, NaN where the values are NaN
+    """
+    values = np.asarray(values)
+    data = np.atleast_2d(values)
+    smooth = pd.DataFrame(data.T).ewm(alpha=alpha, adjust=False,
+                                      ignore_na=True).mean().values.T
+    return np.where(np.isnan(data), np.nan, smooth).reshape(values.shape)
+
+
+def points_per_year(times):
+    """Number of points in a year of the time axis, the most points in
+    a calendar year (the first and the last year may be partial)
+
+    :param times: Time axis (datetime64)
+    :rtype: int
+    """
+    years = np.asarray(times).astype('datetime64[Y]')
+    if years.size == 0:
+        return 1
+    _, counts = np.unique(years, return_counts=True)
+    return int(counts.max())
+
+
+def smooth(values, spec, times=None):
+    """Apply the filter to the series (rows) of the array
+
+    :param values: (models, time) array
+    :param spec: The filter, see :func:`parse`
+    :param times: Time axis, needed for 'annual'
+    :return: smoothed array, NaN where the values are NaN
+    """
+    name, param = parse(spec)
+    values = np.asarray(values, dtype=np.float64)
+    if name == 'none':
+        return values
+    if name == 'exp':
+        return exponential(values, param)
+    missing = np.isnan(values)
+    if name == 'annual':
+        result = centered(values, points_per_year(times))
+    else:
+        result = (boxcar if name == 'boxcar' else centered)(values, param)
+    return np.where(missing, np.nan, result) if missing.any() else result
+
+
+def align(series):
+    """Put the series of several models on a common time axis
+
+    :param series: list of pandas Series indexed by time
+    :return: time axis, (models, time) array (NaN where a model has no
+             data), positions of the points of every series on the axis
+             (None if all series have the same time axis)
+    """
+    times = series[0].index.values
+    if all(np.array_equal(s.index.values, times) for s in series[1:]):
+        # same time axis of all models (usual case), no alignment
+        return times, np.vstack([ s.values for s in series ]), None
+    months = [ s.index.values.astype('datetime64[M]') for s in series ]
+    times = np.unique(np.concatenate(months))
+    values = np.full((len(series), times.size), np.nan)
+    positions = [ np.searchsorted(times, m) for m in months ]
+    for row, (s, pos) in enumerate(zip(series, positions)):
+        values[row, pos] = s.values
+    return times.astype('datetime64[ns]'), values, positions
+
+
+def smooth_series(series, spec):
+    """Smooth the series of several models together
+
+    :param series: list of pandas Series indexed by time
+    :param spec: The filter, see :func:`parse`
+    :return: smoothed series, same index and name as the given ones
+    :rtype: list of pd.Series
+    """
+    if parse(spec)[0] == 'none' or not series:
+        return list(series)
+    times, values, positions = align(series)
+    smoothed = smooth(values, spec, times)
+    rows = (list(smoothed) if positions is None else
+            [ smoothed[row, pos] for row, pos in enumerate(positions) ])
+    return [ pd.Series(values.astype(s.dtype, copy=False), index=s.index,
+                       name=s.name)
+             for s, values in zip(series, rows) ]
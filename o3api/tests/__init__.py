@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Helpers shared by the tests: synthetic model data
+"""
+import numpy as np
+import os
+import shutil
+import tempfile
+import xarray as xr
+from o3api import config as cfg
+from o3api import fileaccess as o3fileaccess
+from o3api import plots as o3plots
+
+# configuration for netCDF
+TIME = 'time'
+LAT  = 'lat'
+TCO3 = 'tco3_zm'
+
+
+def monthly(start, stop, day=0):
+    """Monthly time axis
+
+    :param start: First month, e.g. "1975-01"
+    :param stop: Month after the last one
+    :param day: Day of the month of the time points, counted from 0
+    :return: time axis (datetime64[ns])
+    """
+    months = np.arange(start, stop, dtype='datetime64[M]')
+    return (months.astype('datetime64[D]') + day).astype('datetime64[ns]')
+
+
+class SyntheticData:
+    """Models written to a temporary O3AS_DATA_BASEPATH. The data
+    directory, the series cache and the aggregates flag are replaced
+    until :meth:`restore`
+
+    :param aggregates: Use the stored band means (o3api.aggregates),
+                       off to compare with means computed from the files
+    :param cache_entries: Size of the (new, empty) series cache
+    """
+    def __init__(self, aggregates=False,
+                 cache_entries=cfg.series_cache_conf['max_entries']):
+        self.data_dir = tempfile.mkdtemp()
+        self._saved = (cfg.O3AS_DATA_BASEPATH, o3plots.series_cache,
+                       cfg.aggregates_conf['enabled'])
+        cfg.O3AS_DATA_BASEPATH = self.data_dir
+        cfg.aggregates_conf['enabled'] = aggregates
+        o3plots.series_cache = o3plots.SeriesCache(cache_entries)
+
+    def write(self, model, values, lats, times, files=1, dims=(LAT, TIME),
+              plot_type=TCO3):
+        """Write (lat, time) values of the model, split in time into files
+
+        :param model: Model name
+        :param values: (lat, time) array
+        :param lats: Latitudes of the values
+        :param times: Time axis
+        :param files: Number of files, named <plot_type>-<i>.nc if > 1
+        :param dims: Order of the dimensions in the files
+        :param plot_type: Name of the variable
+        """
+        o3fileaccess.file_manager.close_all() # files may be rewritten
+        model_dir = os.path.join(self.data_dir, model)
+        os.makedirs(model_dir, exist_ok=True)
+        for i, t_idx in enumerate(np.array_split(np.arange(len(times)),
+                                                 files)):
+            ds = xr.Dataset({plot_type: ((LAT, TIME), values[:, t_idx])},
+                            coords={LAT: lats, TIME: times[t_idx]})
+            name = (plot_type + ".nc" if files == 1 else
+                    "{}-{}.nc".format(plot_type, i))
+            ds.transpose(*dims).to_netcdf(os.path.join(model_dir, name))
+
+    def normal(self, model, lats, times, rng, sigma=10., **kwargs):
+        """Write values drawn around 300 DU, see :meth:`write`
+
+        :param rng: numpy random generator
+        :param sigma: Standard deviation of the values
+        :return: (lat, time) values
+        """
+        values = rng.normal(300., sigma, (len(lats), len(times)))
+        self.write(model, values, lats, times, **kwargs)
+        return values
+
+    def restore(self):
+        """Put back the configuration and remove the data
+        """
+        (cfg.O3AS_DATA_BASEPATH, o3plots.series_cache,
+         cfg.aggregates_conf['enabled']) = self._saved
+        o3fileaccess.file_manager.close_all()
+        shutil.rmtree(self.data_dir)
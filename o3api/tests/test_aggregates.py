@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Tests for the stored means of standard latitude bands
+"""
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+from o3api import aggregates as o3aggregates
+from o3api import config as cfg
+from o3api import plots as o3plots
+from o3api import pyramid as o3pyramid
+from o3api.tests import SyntheticData, monthly
+
+# configuration for netCDF
+TCO3 = 'tco3_zm'
+
+# configuration for API
+BEGIN = 'begin'
+END   = 'end'
+MONTH = 'month'
+LAT_MIN = 'lat_min'
+LAT_MAX = 'lat_max'
+
+
+class TestAggregateStore(unittest.TestCase):
+
+    def setUp(self):
+        self.data = SyntheticData()
+        self.store_dir = tempfile.mkdtemp()
+        self.store = o3aggregates.store
+        o3aggregates.store = o3aggregates.AggregateStore(
+                                 self.store_dir, [(-90, -60), (-20, 20)])
+
+        self.model = 'o3api-aggregates'
+        self.lats = np.arange(-88.75, 90., 2.5)
+        self.times = monthly("1970-01", "2001-01")
+        self.values = np.random.default_rng(2).normal(
+                          300., 20., (self.lats.size, self.times.size))
+        self.values[2, 100:130] = np.nan
+        self._write(self.values)
+
+    def _write(self, values):
+        self.data.write(self.model, values, self.lats, self.times, files=3)
+
+    def tearDown(self):
+        o3aggregates.store = self.store
+        self.data.restore()
+        shutil.rmtree(self.store_dir)
+
+    def _process(self, enabled, **kwargs):
+        cfg.aggregates_conf['enabled'] = enabled
+        o3plots.series_cache = o3plots.SeriesCache(
+                                   cfg.series_cache_conf['max_entries'])
+        data = o3plots.ProcessForTCO3(**kwargs)
+        return data.get_raw_data(self.model), data.get_ref1980(self.model)
+
+    def test_same_as_computed(self):
+        """
+        Test that stored bands give the computed results, for month sets
+        """
+        for (lat_min, lat_max), month in [((-90, -60), []),
+                                          ((-90, -60), [10]),
+                                          ((-20, 20), [12, 1, 2])]:
+            kwargs = { BEGIN: 1975, END: 1995, MONTH: month,
+                       LAT_MIN: lat_min, LAT_MAX: lat_max }
+            expected, exp_ref = self._process(False, **kwargs)
+            series, ref = self._process(True, **kwargs)
+            np.testing.assert_allclose(series.values, expected.values,
+                                       rtol=1e-12)
+            np.testing.assert_array_equal(series.index, expected.index)
+            self.assertAlmostEqual(ref, exp_ref, places=10)
+        stats = o3aggregates.store.stats()
+        self.assertEqual(stats['builds'], 1)
+        self.assertEqual(stats['hits'], 6)
+
+    def test_other_band(self):
+        """
+        Test that other bands are not served from the store
+        """
+        kwargs = { BEGIN: 1975, END: 1995, MONTH: [],
+                   LAT_MIN: -60, LAT_MAX: -35 }
+        self._process(True, **kwargs)
+        self.assertEqual(o3aggregates.store.stats()['hits'], 0)
+        self.assertEqual(os.listdir(self.store_dir), [])
+
+    def test_refresh(self):
+        """
+        Test that changed data is stored again, the old band means removed
+        """
+        kwargs = { BEGIN: 1975, END: 1995, MONTH: [],
+                   LAT_MIN: -20, LAT_MAX: 20 }
+        series, _ = self._process(True, **kwargs)
+        time.sleep(0.01)
+        self._write(self.values + 10.)
+        changed, _ = self._process(True, **kwargs)
+        np.testing.assert_allclose(changed.values, series.values + 10.)
+        self.assertEqual(o3aggregates.store.stats()['builds'], 2)
+        self.assertEqual(len(os.listdir(os.path.join(self.store_dir, TCO3,
+                                                     self.model))), 1)
+
+    def test_not_writable(self):
+        """
+        Test that a store which can not be written is disabled at once,
+        without reading the field of the model
+        """
+        blocker = os.path.join(self.store_dir, 'file')
+        open(blocker, 'w').close()
+        o3aggregates.store = o3aggregates.AggregateStore(
+                                 os.path.join(blocker, 'store'), [(-20, 20)])
+        kwargs = { BEGIN: 1975, END: 1995, MONTH: [],
+                   LAT_MIN: -20, LAT_MAX: 20 }
+        expected, _ = self._process(False, **kwargs)
+        with mock.patch.object(o3pyramid.TilePyramid, 'read_field') as read:
+            for _ in range(3):
+                series, _ = self._process(True, **kwargs)
+                np.testing.assert_allclose(series.values, expected.values,
+                                           rtol=1e-12)
+            read.assert_not_called()
+        stats = o3aggregates.store.stats()
+        self.assertIsNotNone(stats['disabled'])
+        self.assertEqual((stats['builds'], stats['errors']), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,12 +8,21 @@
 Created on Tue December 8 13:47:51 2020
 @author: vykozlov
 """
+import io
 import numpy as np
 import os
 import pytest
+import shutil
+import tempfile
 import unittest
+from unittest import mock
+import xarray as xr
 from o3api import api as o3api
 from o3api import config as cfg
+from o3api import plots as o3plots
+from o3api import pyramid as o3pyramid
+from o3api import replay
+from o3api.tests import SyntheticData, monthly
 
 import flask
 import connexion
@@ -99,5 +108,409 @@ class TestAPIMethods(unittest.TestCase):
         print(F"[API] plot.content_type: {plot.content_type}")
         self.assertEqual(200, plot.status_code)
 
+    def test_api_plot_pdf(self):
+        end_year = np.datetime64('today', 'Y').astype(int) + 1970
+        request_q = (PTYPE + "=" + TCO3 + "&" + MODEL + "=o3api-test&" +
+                     BEGIN + "=" + str(end_year - 2) + "&" +
+                     END + "=" + str(end_year))
+        headers = {'Content-Type': 'application/json',
+                   'Accept': 'application/pdf'}
+        plot = self.client.post('/api/plot',
+                                headers=headers,
+                                query_string=request_q)
+        print(F"[API] plot.content_type: {plot.content_type}")
+        self.assertEqual(200, plot.status_code)
+        self.assertEqual('application/pdf', plot.content_type)
+        self.assertTrue(plot.data.startswith(b'%PDF'))
+
+    def test_api_plot_smooth(self):
+        end_year = np.datetime64('today', 'Y').astype(int) + 1970
+        request_q = (PTYPE + "=" + TCO3 + "&" + MODEL + "=o3api-test&" +
+                     BEGIN + "=" + str(end_year - 2) + "&" +
+                     END + "=" + str(end_year))
+        raw = self.client.post('/api/plot', headers=self.headers,
+                               query_string=request_q)
+        plot = self.client.post('/api/plot', headers=self.headers,
+                                query_string=request_q + "&smooth=boxcar:5")
+        self.assertEqual(200, plot.status_code)
+        self.assertEqual(plot.json[1]['x'], raw.json[1]['x'])
+        y = np.array(raw.json[1]['y'], dtype=float)
+        np.testing.assert_allclose(plot.json[1]['y'][2:-2],
+                                   np.convolve(y, np.ones(5)/5.,
+                                               mode='valid'), rtol=1e-5)
+        for query in [request_q + "&smooth=gauss",
+                      request_q.replace(TCO3, 'tco_return') +
+                      "&smooth=boxcar"]:
+            plot = self.client.post('/api/plot', headers=self.headers,
+                                    query_string=query)
+            self.assertEqual(400, plot.status_code)
+
+    def test_api_plot_level_time(self):
+        data_dir = tempfile.mkdtemp()
+        model = 'o3api-test-vmro3'
+        os.makedirs(os.path.join(data_dir, model))
+        times = np.arange("1979-01", "1982-01",
+                          dtype='datetime64[M]').astype('datetime64[ns]')
+        levels = [1000., 100., 10., 1.]
+        ds = xr.Dataset({VMRO3: ((TIME, 'plev', LAT),
+                                 np.ones((times.size, len(levels), 19)))},
+                        coords={TIME: times, 'plev': levels,
+                                LAT: np.arange(-90., 91., 10.)})
+        ds.to_netcdf(os.path.join(data_dir, model, VMRO3 + ".nc"))
+        cfg.O3AS_DATA_BASEPATH = data_dir
+        try:
+            request_q = (PTYPE + "=" + VMRO3 + "&" + MODEL + "=" + model +
+                         "&" + BEGIN + "=1979&" + END + "=1981&" +
+                         "level_min=5&level_max=500")
+            plot = self.client.post('/api/plot', headers=self.headers,
+                                    query_string=request_q)
+            self.assertEqual(200, plot.status_code)
+            self.assertEqual(len(plot.json[1]['y']), times.size)
+            plot = self.client.post('/api/plot', headers=self.headers,
+                                    query_string=request_q +
+                                    "&level_time=true")
+            self.assertEqual(200, plot.status_code)
+            self.assertEqual(plot.json[1]['levels'], [100., 10.])
+            self.assertEqual(np.shape(plot.json[1]['z']), (2, times.size))
+            headers = {'Content-Type': 'application/json',
+                       'Accept': 'application/pdf'}
+            plot = self.client.post('/api/plot', headers=headers,
+                                    query_string=request_q +
+                                    "&level_time=true")
+            self.assertEqual(200, plot.status_code)
+            self.assertTrue(plot.data.startswith(b'%PDF'))
+            # only for vmro3_zm
+            request_q = (PTYPE + "=" + TCO3 + "&" + MODEL + "=" + model +
+                         "&level_time=true")
+            plot = self.client.post('/api/plot', headers=self.headers,
+                                    query_string=request_q)
+            self.assertEqual(400, plot.status_code)
+        finally:
+            cfg.O3AS_DATA_BASEPATH = "tmp/data"
+            shutil.rmtree(data_dir)
+
+    def test_api_plot_return(self):
+        data_dir = tempfile.mkdtemp()
+        model = 'o3api-test-return'
+        os.makedirs(os.path.join(data_dir, model))
+        times = np.arange("1975-01", "2000-01",
+                          dtype='datetime64[M]').astype('datetime64[ns]')
+        # constant: no depletion, no return year
+        ds = xr.Dataset({TCO3: ((LAT, TIME), np.ones((19, times.size)))},
+                        coords={TIME: times, LAT: np.arange(-90., 91., 10.)})
+        ds.to_netcdf(os.path.join(data_dir, model, TCO3 + ".nc"))
+        cfg.O3AS_DATA_BASEPATH = data_dir
+        try:
+            request_q = ("ptype=tco_return&" + MODEL + "=" + model +
+                         "&" + BEGIN + "=1975&" + END + "=1999&" +
+                         "bands=-90:-60,-20:20")
+            plot = self.client.post('/api/plot', headers=self.headers,
+                                    query_string=request_q)
+            print(F"[API] plot.data: {plot.data}")
+            self.assertEqual(200, plot.status_code)
+            self.assertEqual(plot.json[1]['x'], ['-90..-60', '-20..20'])
+            self.assertEqual(len(plot.json[1]['y']), 2)
+            headers = {'Content-Type': 'application/json',
+                       'Accept': 'application/pdf'}
+            plot = self.client.post('/api/plot', headers=headers,
+                                    query_string=request_q)
+            self.assertEqual(200, plot.status_code)
+            self.assertTrue(plot.data.startswith(b'%PDF'))
+        finally:
+            cfg.O3AS_DATA_BASEPATH = "tmp/data"
+            shutil.rmtree(data_dir)
+
+    def test_api_plot_batch(self):
+        # single requests computed from the files, not from stored bands
+        data = SyntheticData(cache_entries=16)
+        models = ['o3api-test-batch-a', 'o3api-test-batch-b']
+        times = monthly("1975-01", "2000-01")
+        lats = np.arange(-85., 90., 10.)
+        rng = np.random.default_rng(7)
+        for model in models:
+            data.normal(model, lats, times, rng)
+        body = [ { PTYPE: TCO3, MODEL: models, BEGIN: 1975, END: 1999,
+                   LAT_MIN: -90, LAT_MAX: -60, MONTH: [10] },
+                 { PTYPE: TCO3, MODEL: models[0], BEGIN: 1980, END: 1990,
+                   LAT_MIN: -20, LAT_MAX: 20, MONTH: "12,1,2" },
+                 { PTYPE: 'tco_return', MODEL: models, BEGIN: 1975,
+                   END: 1999, 'bands': ["-90:-60", "-20:20"] },
+                 { PTYPE: TCO3, BEGIN: 1980 },
+                 { PTYPE: 'unknown', MODEL: models },
+                 { PTYPE: TCO3, MODEL: models, 'level_time': "false" },
+                 { PTYPE: TCO3, MODEL: models, 'level_time': "no" } ]
+        try:
+            with mock.patch.object(o3plots.DataSelection, 'read_field',
+                                   autospec=True,
+                                   side_effect=o3plots.DataSelection.read_field
+                                   ) as read_field:
+                batch = self.client.post('/api/plot_batch',
+                                         headers=self.headers,
+                                         data=json.dumps(body))
+            print(F"[API] batch.data: {batch.data[:500]}")
+            self.assertEqual(200, batch.status_code)
+            self.assertEqual([ r['status'] for r in batch.json ],
+                             [200, 200, 200, 400, 400, 200, 400])
+            # every model is read once for all requests
+            self.assertEqual(read_field.call_count, len(models))
+
+            # same results as single requests
+            for item, result in zip(body[:3], batch.json):
+                o3plots.series_cache = o3plots.SeriesCache(16)
+                query = dict(item)
+                for key in [MODEL, MONTH, 'bands']:
+                    if isinstance(query.get(key), list):
+                        query[key] = ",".join(str(v) for v in query[key])
+                plot = self.client.post('/api/plot', headers=self.headers,
+                                        query_string=query)
+                self.assertEqual(200, plot.status_code)
+                for single, batched in zip(plot.json[1:],
+                                           result['result'][1:]):
+                    self.assertEqual(single['x'], batched['x'])
+                    np.testing.assert_allclose(
+                        np.array(single['y'], dtype=float),
+                        np.array(batched['y'], dtype=float), rtol=1e-6)
+
+            headers = {'Content-Type': 'application/json',
+                       'Accept': 'application/octet-stream'}
+            batch = self.client.post('/api/plot_batch', headers=headers,
+                                     data=json.dumps(body))
+            self.assertEqual(200, batch.status_code)
+            with np.load(io.BytesIO(batch.data)) as arrays:
+                self.assertEqual(list(arrays['status']),
+                                 [200, 200, 200, 400, 400, 200, 400])
+                self.assertEqual(str(arrays['0/1/model']), models[1])
+                self.assertEqual(arrays['0/1/x'].dtype,
+                                 np.dtype('datetime64[ns]'))
+                self.assertEqual(arrays['0/1/y'].size, 25)
+                self.assertIn('3/error', arrays.files)
+
+            cfg.batch_conf['max_items'] = 2
+            batch = self.client.post('/api/plot_batch',
+                                     headers=self.headers,
+                                     data=json.dumps(body))
+            self.assertEqual(400, batch.status_code)
+        finally:
+            cfg.batch_conf['max_items'] = 100
+            data.restore()
+
+    def test_api_export(self):
+        end_year = np.datetime64('today', 'Y').astype(int) + 1970
+        request_q = (PTYPE + "=" + TCO3 + "&" + MODEL + "=o3api-test&" +
+                     BEGIN + "=" + str(end_year - 2) + "&" +
+                     END + "=" + str(end_year) + "&" + MONTH + "=3,4")
+        headers = {'Content-Type': 'application/json',
+                   'Accept': 'application/x-netcdf'}
+        export = self.client.post('/api/export', headers=headers,
+                                  query_string=request_q)
+        self.assertEqual(200, export.status_code)
+        self.assertIn('.nc', export.headers['Content-Disposition'])
+        self.assertEqual(int(export.headers['Content-Length']),
+                         len(export.data))
+        export_file = tempfile.NamedTemporaryFile(suffix=".nc")
+        with export_file:
+            export_file.write(export.data)
+            export_file.flush()
+            with xr.open_dataset(export_file.name) as ds:
+                ds.load()
+        plot = self.client.post('/api/plot', headers=self.headers,
+                                query_string=request_q)
+        self.assertEqual(200, plot.status_code)
+        np.testing.assert_allclose(
+            ds[TCO3].sel(model='o3api-test').dropna('time').values,
+            np.array(plot.json[1]['y'], dtype=float), rtol=1e-4)
+        self.assertEqual(ds.attrs['months'], '3,4')
+
+        export = self.client.post('/api/export', headers=self.headers,
+                                  query_string=request_q.replace(
+                                      TCO3, TCO3Return))
+        self.assertEqual(400, export.status_code)
+
+        # the file is removed also if the response is not read
+        export_dir = tempfile.mkdtemp()
+        cfg.export_conf['path'] = export_dir
+        try:
+            kwargs = { PTYPE: TCO3, MODEL: ['o3api-test'],
+                       BEGIN: end_year - 2, END: end_year, MONTH: [3, 4],
+                       LAT_MIN: -10, LAT_MAX: 10 }
+            with flask.Flask(__name__).test_request_context(headers=headers):
+                export = o3api.export(**kwargs)
+            self.assertEqual(200, export.status_code)
+            self.assertEqual(len(os.listdir(export_dir)), 1)
+            export.close()
+            self.assertEqual(os.listdir(export_dir), [])
+        finally:
+            cfg.export_conf['path'] = None
+            shutil.rmtree(export_dir)
+
+    def test_api_decompose(self):
+        end_year = np.datetime64('today', 'Y').astype(int) + 1970
+        request_q = (PTYPE + "=" + TCO3 + "&" + MODEL + "=o3api-test&" +
+                     BEGIN + "=" + str(end_year - 2) + "&" +
+                     END + "=" + str(end_year))
+        raw = self.client.post('/api/plot', headers=self.headers,
+                               query_string=request_q)
+        trend = self.client.post('/api/decompose', headers=self.headers,
+                                 query_string=request_q)
+        self.assertEqual(200, trend.status_code)
+        self.assertEqual(trend.json[0]['component'], 'trend')
+        y = np.array(raw.json[1]['y'], dtype=float)
+        expected = np.convolve(y, np.r_[0.5, np.ones(11), 0.5]/12.,
+                               mode='valid')
+        self.assertEqual(trend.json[1]['x'], raw.json[1]['x'][6:-6])
+        np.testing.assert_allclose(trend.json[1]['y'], expected, rtol=1e-5)
+        seasonal = self.client.post('/api/decompose', headers=self.headers,
+                                    query_string=request_q +
+                                    "&component=seasonal")
+        self.assertEqual(200, seasonal.status_code)
+        self.assertEqual(seasonal.json[1]['x'], list(range(1, 13)))
+        self.assertAlmostEqual(sum(seasonal.json[1]['y']), 0., places=3)
+        for query in [request_q + "&component=noise",
+                      request_q.replace(TCO3, TCO3Return)]:
+            decompose = self.client.post('/api/decompose',
+                                         headers=self.headers,
+                                         query_string=query)
+            self.assertEqual(400, decompose.status_code)
+
+    def test_api_get_tile(self):
+        pyramid_dir = tempfile.mkdtemp()
+        pyramid = o3pyramid.pyramid
+        o3pyramid.pyramid = o3pyramid.TilePyramid(pyramid_dir, tile_time=4,
+                                                  tile_lat=8)
+        try:
+            request_q = (PTYPE + "=" + TCO3 + "&" + MODEL + "=o3api-test&" +
+                         "tres=monthly&lres=10&tx=1&ty=0")
+            # the lazy build is charged (admission control, scheduling)
+            kwargs = { PTYPE: TCO3, MODEL: 'o3api-test', 'tres': 'monthly',
+                       'lres': '10', 'tx': 1, 'ty': 0 }
+            with flask.Flask(__name__).test_request_context():
+                self.assertGreater(o3api._get_request_cost(**kwargs), 0)
+            tile = self.client.post('/api/get_tile', headers=self.headers,
+                                    query_string=request_q)
+            print(F"[API] tile.data: {tile.data}")
+            self.assertEqual(200, tile.status_code)
+            self.assertEqual(tile.json['n_tx'], 6) # 24 months
+            self.assertEqual(np.shape(tile.json['z']), (8, 4))
+            with flask.Flask(__name__).test_request_context():
+                self.assertEqual(o3api._get_request_cost(**kwargs), 0)
+            tile = self.client.post('/api/get_tile', headers=self.headers,
+                                    query_string=request_q.replace("tx=1",
+                                                                   "tx=6"))
+            self.assertEqual(400, tile.status_code)
+        finally:
+            o3pyramid.pyramid = pyramid
+            shutil.rmtree(pyramid_dir)
+
+    def test_api_rescan(self):
+        rescan = self.client.post('/api/rescan', headers=self.headers)
+        self.assertEqual(403, rescan.status_code) # no admin groups
+        cfg.admin_conf['groups'] = ['o3api-admins']
+        try:
+            rescan = self.client.post('/api/rescan', headers=self.headers)
+            self.assertIn(rescan.status_code, [401, 403]) # no groups known
+            with mock.patch.dict(os.environ, {
+                     'DISABLE_AUTHENTICATION_AND_ASSUME_VALID_GROUPS': 'yes'}):
+                rescan = self.client.post('/api/rescan', headers=self.headers)
+        finally:
+            cfg.admin_conf['groups'] = []
+        print(F"[API] rescan.data: {rescan.data}")
+        self.assertEqual(200, rescan.status_code)
+        for key in ['scanned', 'added', 'changed', 'removed', 'refreshed']:
+            self.assertIn(key, rescan.json)
+        stats = self.client.post('/api/get_stats', headers=self.headers)
+        self.assertGreaterEqual(stats.json['watcher']['scans'], 1)
+
+    def test_api_probes(self):
+        import o3api as o3app
+        client = o3app.app.app.test_client()
+        health = client.get('/healthz')
+        self.assertEqual(200, health.status_code)
+        ready = client.get('/readyz')
+        print(F"[API] ready.data: {ready.data}")
+        self.assertEqual(200, ready.status_code)
+
+    def test_api_request_log(self):
+        log_dir = tempfile.mkdtemp()
+        cfg.O3API_REQUEST_LOG = os.path.join(log_dir, "requests.log")
+        try:
+            request_q = PTYPE + "=" + TCO3 + "&" + MODEL + "=o3api-test"
+            self.client.post('/api/get_model_info',
+                             headers=self.headers,
+                             query_string=request_q)
+            o3api.request_log_handler.flush()
+            with open(cfg.O3API_REQUEST_LOG) as f:
+                record = json.loads(f.readlines()[-1])
+            print(F"[API] recorded: {record}")
+            self.assertEqual(record['endpoint'], 'get_model_info')
+            self.assertEqual(record['params'][MODEL], ['o3api-test'])
+            body = [ { PTYPE: TCO3, MODEL: ['o3api-test'] } ]
+            self.client.post('/api/plot_batch', headers=self.headers,
+                             data=json.dumps(body))
+            o3api.request_log_handler.flush()
+            with open(cfg.O3API_REQUEST_LOG) as f:
+                record = json.loads(f.readlines()[-1])
+            self.assertEqual(record['endpoint'], 'plot_batch')
+            self.assertEqual(record['params']['body'], body)
+        finally:
+            cfg.O3API_REQUEST_LOG = ''
+            o3api.request_log_handler.close()
+            shutil.rmtree(log_dir)
+
+    def test_api_request_replay(self):
+        """
+        Test that every recorded request replays as the same call
+        """
+        data = SyntheticData()
+        model = 'o3api-test-replay'
+        data.normal(model, np.arange(-85., 90., 10.),
+                    monthly("1975-01", "2000-01"), np.random.default_rng(3))
+        model_vmro3 = 'o3api-test-replay-vmro3'
+        os.makedirs(os.path.join(data.data_dir, model_vmro3))
+        times = monthly("1979-01", "1982-01")
+        ds = xr.Dataset({VMRO3: ((TIME, 'plev', LAT),
+                                 np.ones((times.size, 4, 19)))},
+                        coords={TIME: times, 'plev': [1000., 100., 10., 1.],
+                                LAT: np.arange(-90., 91., 10.)})
+        ds.to_netcdf(os.path.join(data.data_dir, model_vmro3,
+                                  VMRO3 + ".nc"))
+        log_dir = tempfile.mkdtemp()
+        cfg.O3API_REQUEST_LOG = os.path.join(log_dir, "requests.log")
+        pyramid = o3pyramid.pyramid
+        o3pyramid.pyramid = o3pyramid.TilePyramid(log_dir, tile_time=4,
+                                                  tile_lat=8)
+        request_q = (PTYPE + "=" + TCO3 + "&" + MODEL + "=" + model + "&" +
+                     BEGIN + "=1980&" + END + "=1995")
+        calls = [ ('plot', request_q + "&smooth=boxcar:5"),
+                  ('plot', request_q.replace(TCO3, 'tco_return') +
+                           "&bands=-90:-60,-20:20"),
+                  ('plot', PTYPE + "=" + VMRO3 + "&" + MODEL + "=" +
+                           model_vmro3 + "&" + BEGIN + "=1979&" + END +
+                           "=1981&level_min=5&level_max=500&level_time=true"),
+                  ('decompose', request_q + "&component=seasonal"),
+                  ('export', request_q + "&format=netcdf"),
+                  ('get_tile', PTYPE + "=" + TCO3 + "&" + MODEL + "=" +
+                               model + "&tres=annual&lres=10&tx=1&ty=0") ]
+        try:
+            for endpoint, query in calls:
+                sent = self.client.post('/api/' + endpoint,
+                                        headers=self.headers,
+                                        query_string=query)
+                self.assertEqual(200, sent.status_code, msg=query)
+                o3api.request_log_handler.flush()
+                with open(cfg.O3API_REQUEST_LOG) as f:
+                    record = json.loads(f.readlines()[-1])
+                path, replay_q, headers = replay.to_request(record)
+                again = self.client.post(path, headers=headers,
+                                         query_string=replay_q)
+                self.assertEqual(200, again.status_code, msg=record)
+                if endpoint != 'export': # created at: not the same file
+                    self.assertEqual(again.json, sent.json, msg=record)
+        finally:
+            o3pyramid.pyramid = pyramid
+            cfg.O3API_REQUEST_LOG = ''
+            o3api.request_log_handler.close()
+            shutil.rmtree(log_dir)
+            data.restore()
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Tests for the offline computation of series (o3api-batch)
+"""
+import json
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+import xarray as xr
+from o3api import batch as o3batch
+from o3api import plots as o3plots
+from o3api.tests import SyntheticData, monthly
+
+# configuration for netCDF
+TCO3 = 'tco3_zm'
+
+# configuration for API
+BEGIN = 'begin'
+END   = 'end'
+MONTH = 'month'
+LAT_MIN = 'lat_min'
+LAT_MAX = 'lat_max'
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.data = SyntheticData()
+        self.out_dir = tempfile.mkdtemp()
+
+        rng = np.random.default_rng(11)
+        lats = np.arange(-85., 90., 10.)
+        self.models = ['o3api-batch-a', 'o3api-batch-b', 'o3api-batch-c']
+        for i, model in enumerate(self.models):
+            # models with different periods
+            self.data.normal(model, lats,
+                             monthly("{}-01".format(1970 + i), "1991-01"), rng)
+        self.grid = { 'ptype': TCO3, 'begin': 1975, 'end': 1990,
+                      'bands': ["-90:-60", "-20:20"],
+                      'months': [[], [12, 1, 2], [10]] }
+
+    def tearDown(self):
+        self.data.restore()
+        shutil.rmtree(self.out_dir)
+
+    def _write_grid(self, grid, name="grid.json"):
+        path = os.path.join(self.out_dir, name)
+        with open(path, 'w') as f:
+            json.dump(grid, f)
+        return path
+
+    def test_same_as_api(self):
+        """
+        Test the series of the grid against single requests
+        """
+        output = os.path.join(self.out_dir, "series.nc")
+        code = o3batch.main([self._write_grid(self.grid), '--output', output,
+                             '--workers', '2', '--quiet'])
+        self.assertEqual(code, 0)
+        with xr.open_dataset(output) as ds:
+            ds.load()
+        self.assertEqual(list(ds['model'].values), self.models)
+        self.assertEqual(list(ds['band'].values), ['-90..-60', '-20..20'])
+        self.assertEqual(list(ds['months'].values), ['all', '12,1,2', '10'])
+
+        o3plots.series_cache = o3plots.SeriesCache(64)
+        for model in self.models:
+            for band, (lat_min, lat_max) in zip(ds['band'].values,
+                                                [(-90, -60), (-20, 20)]):
+                for label, months in zip(ds['months'].values,
+                                         self.grid['months']):
+                    kwargs = { BEGIN: 1975, END: 1990, MONTH: months,
+                               LAT_MIN: lat_min, LAT_MAX: lat_max }
+                    data = o3plots.ProcessForTCO3(**kwargs)
+                    expected = data.get_raw_data(model)
+                    result = ds[TCO3].sel(model=model, band=band,
+                                          months=label).dropna('time')
+                    np.testing.assert_allclose(result.values,
+                                               expected.values, rtol=1e-6)
+                    np.testing.assert_array_equal(
+                        result['time'].values.astype('datetime64[M]'),
+                        expected.index.values.astype('datetime64[M]'))
+                    self.assertAlmostEqual(
+                        float(ds['ref1980'].sel(model=model, band=band,
+                                                months=label)),
+                        data.get_ref1980(model), places=6)
+
+    def test_yaml_failed_model(self):
+        """
+        Test a YAML grid and that a failing model does not stop the others
+        """
+        bad = os.path.join(self.data.data_dir, 'o3api-batch-bad')
+        os.makedirs(bad)
+        with open(os.path.join(bad, TCO3 + ".nc"), 'w') as f:
+            f.write("not netCDF")
+        path = os.path.join(self.out_dir, "grid.yaml")
+        with open(path, 'w') as f:
+            f.write("ptype: tco3_zm\nbegin: 1980\nend: 1985\n"
+                    "bands: ['-20:20']\nmonths: [[10]]\n")
+        grid = o3batch.load_grid(path)
+        self.assertEqual(len(grid['models']), 4) # all models
+        done = []
+        ds, failed = o3batch.run_batch(grid, workers=1,
+                                       progress=lambda *args: done.append(args))
+        self.assertEqual(list(failed), ['o3api-batch-bad'])
+        self.assertEqual(list(ds['model'].values), self.models)
+        self.assertEqual([ d[:2] for d in done ], [(i, 4) for i in range(1, 5)])
+        self.assertEqual(ds[TCO3].shape, (3, 1, 1, 6))
+
+    def test_invalid_grid(self):
+        """
+        Test that other plot types are rejected
+        """
+        path = self._write_grid(dict(self.grid, ptype='tco_return'))
+        with self.assertRaises(ValueError):
+            o3batch.load_grid(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Tests for the dask execution backend and chunk sizing
+"""
+import dask
+import numpy as np
+import shutil
+import tempfile
+import unittest
+from o3api import catalog as o3catalog
+from o3api import compute as o3compute
+from o3api import config as cfg
+from o3api import loadtest
+from o3api import plots as o3plots
+
+# configuration for netCDF
+TCO3 = 'tco3_zm'
+
+# configuration for API
+BEGIN = 'begin'
+END   = 'end'
+MONTH = 'month'
+LAT_MIN = 'lat_min'
+LAT_MAX = 'lat_max'
+
+
+class TestComputeBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.base_path = cfg.O3AS_DATA_BASEPATH
+        cfg.O3AS_DATA_BASEPATH = self.data_dir
+        # 37 latitudes, 2 files of 96 months
+        self.model = loadtest.make_synthetic_data(self.data_dir, models=1,
+                                                  begin=1975, end=1990)[0]
+        self.entry = o3catalog.catalog.get_entry(self.model, TCO3)
+        self.conf = dict(cfg.dask_conf, scheduler='sync', num_workers=0,
+                         chunk_size='auto', chunk_overrides='',
+                         memory_fraction=1.)
+
+    def tearDown(self):
+        cfg.O3AS_DATA_BASEPATH = self.base_path
+        shutil.rmtree(self.data_dir)
+
+    def test_parse_overrides(self):
+        """
+        Test per model chunk sizes
+        """
+        self.assertEqual(o3compute.parse_overrides('a:8, b-c:32'),
+                         {'a': 8, 'b-c': 32})
+        self.assertEqual(o3compute.parse_overrides(''), {})
+
+    def test_auto_chunks(self):
+        """
+        Test that the chunk is sized to the target bytes
+        """
+        # one latitude row of a file: 96 months x 8 bytes
+        backend = o3compute.ComputeBackend(dict(self.conf,
+                                                chunk_target_bytes=10*96*8))
+        backend.setup()
+        self.assertEqual(backend.chunk_size(self.entry), 10)
+        info = backend.stats()['models'][self.model]
+        self.assertEqual(info['chunk_source'], 'auto')
+        self.assertEqual(info['chunks'], 2*4)
+        self.assertEqual(info['chunk_bytes'], 10*96*8)
+        # large target: all latitudes in one chunk
+        backend = o3compute.ComputeBackend(dict(self.conf,
+                                                chunk_target_bytes=2**30))
+        self.assertEqual(backend.chunk_size(self.entry), 37)
+
+    def test_fixed_and_override(self):
+        """
+        Test fixed chunk size and per model overrides
+        """
+        backend = o3compute.ComputeBackend(dict(self.conf, chunk_size='-1'))
+        self.assertEqual(backend.chunk_size(self.entry), 0)
+        backend = o3compute.ComputeBackend(dict(self.conf, chunk_size='4',
+                        chunk_overrides="{}:16".format(self.model)))
+        self.assertEqual(backend.chunk_size(self.entry), 16)
+        self.assertEqual(backend.stats()['models'][self.model]['chunk_source'],
+                         'override')
+
+    def test_scheduler(self):
+        """
+        Test that the scheduler is configured, distributed falls back
+        to threads if not installed
+        """
+        scheduler = dask.config.get('scheduler', None)
+        try:
+            backend = o3compute.ComputeBackend(self.conf)
+            backend.setup()
+            self.assertEqual(dask.config.get('scheduler'), 'sync')
+            self.assertEqual(backend.workers(), 1)
+            try:
+                import distributed
+            except ImportError:
+                backend = o3compute.ComputeBackend(dict(self.conf,
+                                                   scheduler='distributed'))
+                backend.setup()
+                self.assertEqual(backend.scheduler, 'threads')
+        finally:
+            dask.config.set(scheduler=scheduler)
+
+    def test_chunked_results(self):
+        """
+        Test that small chunks give the same series
+        """
+        kwargs = { BEGIN: 1977, END: 1988, MONTH: [],
+                   LAT_MIN: -40, LAT_MAX: 60 }
+        backend = o3compute.backend
+        reader_mode = cfg.netcdf_reader_conf['mode']
+        series_cache = o3plots.series_cache
+        try:
+            cfg.netcdf_reader_conf['mode'] = 'xarray'
+            results = []
+            for chunk_target in [2**30, 3*96*8]:
+                o3compute.backend = o3compute.ComputeBackend(dict(self.conf,
+                                        chunk_target_bytes=chunk_target))
+                o3plots.series_cache = o3plots.SeriesCache(10)
+                data = o3plots.ProcessForTCO3(**kwargs)
+                results.append(data.get_raw_data(self.model))
+            np.testing.assert_allclose(results[0].values, results[1].values)
+            metrics = o3compute.backend.stats()['models'][self.model]
+            self.assertEqual(metrics['chunk_lat'], 3)
+            self.assertEqual(metrics['computes'], 1)
+        finally:
+            o3compute.backend = backend
+            o3plots.series_cache = series_cache
+            cfg.netcdf_reader_conf['mode'] = reader_mode
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Tests for the decomposition of series (/api/decompose)
+"""
+import numpy as np
+import unittest
+from o3api import decompose as o3decompose
+from o3api import plots as o3plots
+from o3api.tests import SyntheticData, monthly
+
+# configuration for API
+BEGIN = 'begin'
+END   = 'end'
+MONTH = 'month'
+LAT_MIN = 'lat_min'
+LAT_MAX = 'lat_max'
+
+
+class TestDecompose(unittest.TestCase):
+
+    def setUp(self):
+        self.times = monthly("1975-01", "1995-01")
+        months = np.arange(self.times.size)
+        self.cycle = 10.*np.sin(2.*np.pi*np.arange(12)/12.)
+        self.trend = np.vstack([300. - 0.05*months, 280. + 0.02*months])
+        self.values = self.trend + self.cycle[months % 12]
+
+    def test_components(self):
+        """
+        Test that a linear trend and a seasonal cycle are recovered,
+        also with missing values and without data of some months
+        """
+        refs = np.array([290., 285.])
+        trend, cycle, residual, anomaly = o3decompose.decompose(
+                                              self.values, self.times, refs)
+        inner = slice(6, -6) # full windows
+        self.assertTrue(np.isnan(trend[:, :6]).all())
+        self.assertTrue(np.isnan(trend[:, -6:]).all())
+        np.testing.assert_allclose(trend[:, inner], self.trend[:, inner],
+                                   rtol=1e-12)
+        np.testing.assert_allclose(cycle, np.tile(self.cycle, (2, 1)),
+                                   atol=1e-9)
+        np.testing.assert_allclose(residual[:, inner], 0., atol=1e-9)
+        np.testing.assert_allclose(anomaly, self.trend - refs[:, np.newaxis],
+                                   atol=1e-9)
+
+        values = self.values.copy()
+        values[1, :30] = np.nan # later start of the model
+        values[1, 100] = np.nan
+        trend, cycle, residual, anomaly = o3decompose.decompose(
+                                              values, self.times, refs)
+        self.assertTrue(np.isnan(trend[1, :36]).all())
+        self.assertTrue(np.isnan(trend[1, 94:107]).all())
+        self.assertTrue(np.isfinite(trend[1, [93, 107]]).all())
+        self.assertTrue(np.isnan(anomaly[1, 100]))
+        np.testing.assert_allclose(cycle[1], self.cycle, atol=1e-9)
+        np.testing.assert_allclose(trend[0], o3decompose.decompose(
+            self.values[:1], self.times, refs[:1])[0][0])
+
+        # October and November only: no cycle of the other months
+        select = np.isin(self.times.astype('datetime64[M]').astype(int) % 12,
+                         [9, 10])
+        _, cycle, _, _ = o3decompose.decompose(self.values[:, select],
+                                               self.times[select], refs)
+        self.assertTrue(np.isnan(cycle[:, :9]).all())
+        self.assertTrue(np.isfinite(cycle[:, 9:11]).all())
+        np.testing.assert_allclose(cycle[:, 9:11].sum(axis=-1), 0.,
+                                   atol=1e-9)
+
+    def test_get_components(self):
+        """
+        Test the components of the series of a request and their cache
+        """
+        synthetic = SyntheticData(cache_entries=16)
+        models = ['o3api-decompose-a', 'o3api-decompose-b']
+        try:
+            lats = np.arange(-85., 90., 10.)
+            for model, values in zip(models, self.values):
+                synthetic.write(model, np.tile(values, (lats.size, 1)),
+                                lats, self.times)
+            kwargs = { BEGIN: 1975, END: 1994, MONTH: [], LAT_MIN: -90,
+                       LAT_MAX: 90 }
+            data = o3plots.ProcessForTCO3(**kwargs)
+            components = o3decompose.get_components(data, models)
+            self.assertEqual(sorted(components), sorted(o3decompose.COMPONENTS))
+            self.assertEqual(list(components['seasonal'].index),
+                             list(range(1, 13)))
+            np.testing.assert_allclose(components['seasonal'].values,
+                                       np.tile(self.cycle, (2, 1)).T,
+                                       atol=1e-3)
+            trend = components['trend'][models[1]].dropna()
+            self.assertEqual(trend.size, self.times.size - 12)
+            np.testing.assert_allclose(trend.values, self.trend[1, 6:-6],
+                                       rtol=1e-6)
+            anomaly = components['anomaly'][models[0]]
+            np.testing.assert_allclose(anomaly.values,
+                                       self.trend[0] -
+                                       data.get_ref1980(models[0]),
+                                       atol=1e-3)
+            # cached for the same request
+            again = o3decompose.get_components(
+                        o3plots.ProcessForTCO3(**kwargs), models)
+            self.assertIs(again['trend'], components['trend'])
+            # a missing month stays missing, it is not 0 DU
+            gap = 'o3api-decompose-gap'
+            values = self.values[0].copy()
+            values[100] = np.nan
+            synthetic.write(gap, np.tile(values, (lats.size, 1)), lats,
+                            self.times)
+            series = data.get_raw_data(gap)
+            self.assertTrue(np.isnan(series.values[100]))
+            self.assertEqual(np.isnan(series.values).sum(), 1)
+            trend = o3decompose.get_components(data, [gap])['trend'][gap]
+            self.assertTrue(np.isnan(trend.values[94:107]).all())
+        finally:
+            synthetic.restore()
+
+
+if __name__ == '__main__':
+    unittest.main()
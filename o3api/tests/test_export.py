@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Tests for the export of the series of many models (/api/export)
+"""
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+import xarray as xr
+from unittest import mock
+from o3api import config as cfg
+from o3api import export as o3export
+from o3api import plots as o3plots
+from o3api.tests import SyntheticData, monthly
+
+# configuration for netCDF
+TCO3 = 'tco3_zm'
+
+# configuration for API
+BEGIN = 'begin'
+END   = 'end'
+MONTH = 'month'
+LAT_MIN = 'lat_min'
+LAT_MAX = 'lat_max'
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.data = SyntheticData(cache_entries=16)
+        rng = np.random.default_rng(5)
+        lats = np.arange(-85., 90., 10.)
+        self.models = ['o3api-export-a', 'o3api-export-b']
+        # models with different periods, mid-month and start of month
+        periods = [ ("1975-01", "1991-01", 14), ("1980-01", "1996-01", 0) ]
+        for model, (start, stop, day) in zip(self.models, periods):
+            self.data.normal(model, lats, monthly(start, stop, day), rng)
+        self.kwargs = { BEGIN: 1978, END: 1992, MONTH: [10, 11],
+                        LAT_MIN: -90, LAT_MAX: -60 }
+
+    def tearDown(self):
+        self.data.restore()
+
+    def test_netcdf(self):
+        """
+        Test the exported series against single requests
+        """
+        path = o3export.export(TCO3, self.models, 'netcdf', **self.kwargs)
+        try:
+            chunks = list(o3export.stream_file(path, chunk_bytes=1000))
+            self.assertFalse(os.path.exists(path)) # removed after sending
+            self.assertGreater(len(chunks), 1)
+            out_path = path + ".copy"
+            with open(out_path, 'wb') as f:
+                f.write(b"".join(chunks))
+            with xr.open_dataset(out_path) as ds:
+                ds.load()
+        finally:
+            for p in [path, path + ".copy"]:
+                if os.path.exists(p):
+                    os.remove(p)
+
+        self.assertEqual(list(ds['model'].values), self.models)
+        # 1978-1992, October and November of both models
+        self.assertEqual(ds.sizes['time'], 30)
+        self.assertEqual(ds.attrs['months'], '10,11')
+        self.assertEqual(ds.attrs['lat_min'], -90.)
+        self.assertEqual(ds.attrs['begin'], 1978)
+
+        data = o3plots.ProcessForTCO3(**self.kwargs)
+        refs = []
+        for model in self.models:
+            expected = data.get_raw_data(model)
+            result = ds[TCO3].sel(model=model).dropna('time')
+            np.testing.assert_allclose(result.values, expected.values,
+                                       rtol=1e-6)
+            np.testing.assert_array_equal(
+                result['time'].values.astype('datetime64[M]'),
+                expected.index.values.astype('datetime64[M]'))
+            refs.append(data.get_ref1980(model))
+            self.assertAlmostEqual(float(ds['ref1980'].sel(model=model)),
+                                   refs[-1], places=6)
+        self.assertAlmostEqual(ds.attrs['ref1980_mean'], np.mean(refs),
+                               places=6)
+
+    def test_invalid(self):
+        """
+        Test that other plot types, missing models and unavailable
+        formats are rejected without leaving files
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with mock.patch.dict(cfg.export_conf, {'path': tmp_dir}):
+                with self.assertRaises(o3plots.InvalidRequest):
+                    o3export.export('tco3_return', self.models,
+                                    **self.kwargs)
+                with self.assertRaises(o3plots.InvalidRequest):
+                    o3export.export(TCO3, ['o3api-export-none'],
+                                    **self.kwargs)
+                with self.assertRaises(o3plots.InvalidRequest):
+                    o3export.export(TCO3, self.models, 'csv', **self.kwargs)
+                with mock.patch('importlib.util.find_spec',
+                                return_value=None):
+                    with self.assertRaises(o3export.ExportUnavailable):
+                        o3export.export(TCO3, self.models, 'parquet',
+                                        **self.kwargs)
+                self.assertEqual(os.listdir(tmp_dir), [])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Tests for the pool of netCDF handles and their locks
+"""
+import numpy as np
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import xarray as xr
+from xarray.backends.locks import HDF5_LOCK
+from o3api import fileaccess as o3fileaccess
+
+# configuration for netCDF
+LAT  = 'lat'
+TCO3 = 'tco3_zm'
+
+
+class TestFileAccessManager(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.files = [ self._write("file-{}.nc".format(i), float(i))
+                       for i in range(3) ]
+        self.manager = o3fileaccess.FileAccessManager(max_handles=2)
+
+    def tearDown(self):
+        self.manager.close_all()
+        shutil.rmtree(self.data_dir)
+
+    def _write(self, name, value, size=10):
+        path = os.path.join(self.data_dir, name)
+        ds = xr.Dataset({TCO3: ((LAT,), np.full(size, value))},
+                        coords={LAT: np.arange(size, dtype=float)})
+        ds.to_netcdf(path)
+        return path
+
+    def _read(self, path):
+        with self.manager.open(path) as nc:
+            return nc.variables[TCO3][:].mean()
+
+    def test_reuse_and_lru(self):
+        """
+        Test that handles are reused and the least recently used is closed
+        """
+        self.assertEqual(self._read(self.files[0]), 0.)
+        self.assertEqual(self._read(self.files[0]), 0.)
+        stats = self.manager.stats()
+        self.assertEqual((stats['opens'], stats['reuses']), (1, 1))
+        self._read(self.files[1])
+        self._read(self.files[2])
+        stats = self.manager.stats()
+        self.assertEqual((stats['open_handles'], stats['evictions']), (2, 1))
+        self._read(self.files[0]) # was evicted
+        self.assertEqual(self.manager.stats()['opens'], 4)
+
+    def test_changed_file(self):
+        """
+        Test that a replaced file is reopened
+        """
+        self.assertEqual(self._read(self.files[0]), 0.)
+        new_file = self._write("new.nc", 5., size=20)
+        os.replace(new_file, self.files[0])
+        self.assertEqual(self._read(self.files[0]), 5.)
+        self.assertEqual(self.manager.stats()['opens'], 2)
+
+    def test_idle_handles(self):
+        """
+        Test that idle handles are closed
+        """
+        self.manager.max_idle = 0.
+        self._read(self.files[0])
+        self._read(self.files[1])
+        self.assertEqual(self.manager.stats()['open_handles'], 1)
+
+    def test_per_file_locks(self):
+        """
+        Test that different files are read in parallel,
+        the same file waits for the lock
+        """
+        self.manager = o3fileaccess.FileAccessManager(max_handles=2,
+                                                      per_file_locks=True)
+        holding = threading.Event()
+        release = threading.Event()
+
+        def _hold():
+            with self.manager.open(self.files[0]):
+                holding.set()
+                release.wait(5.)
+
+        holder = threading.Thread(target=_hold)
+        holder.start()
+        holding.wait(5.)
+        # other file: no wait
+        self.assertEqual(self._read(self.files[1]), 1.)
+        self.assertEqual(self.manager.stats()['lock_waits'], 0)
+        # same file: waits for the holder
+        same = threading.Thread(target=self._read, args=(self.files[0],))
+        same.start()
+        same.join(0.2)
+        self.assertTrue(same.is_alive())
+        release.set()
+        same.join(5.)
+        holder.join(5.)
+        self.assertEqual(self.manager.stats()['lock_waits'], 1)
+
+    def test_xarray_lock(self):
+        """
+        Test that by default reads hold the netCDF lock of xarray
+        """
+        taken = []
+
+        def _try():
+            taken.append(HDF5_LOCK.acquire(blocking=False))
+
+        with self.manager.open(self.files[0]):
+            thread = threading.Thread(target=_try)
+            thread.start()
+            thread.join(5.)
+        self.assertEqual(taken, [False])
+        _try() # free again
+        HDF5_LOCK.release()
+        self.assertEqual(taken, [False, True])
+
+    def test_concurrent_reads(self):
+        """
+        Test many threads reading the files concurrently
+        """
+        errors = []
+
+        def _reader(i):
+            for j in range(20):
+                path = self.files[(i + j) % len(self.files)]
+                expected = float(self.files.index(path))
+                if self._read(path) != expected:
+                    errors.append(path)
+
+        threads = [ threading.Thread(target=_reader, args=(i,))
+                    for i in range(8) ]
+        [ t.start() for t in threads ]
+        [ t.join(30.) for t in threads ]
+        self.assertEqual(errors, [])
+        stats = self.manager.stats()
+        self.assertEqual(stats['opens'] + stats['reuses'], 8*20)
+        # handles in use are not closed, the pool shrinks on the next access
+        self._read(self.files[0])
+        self.assertLessEqual(self.manager.stats()['open_handles'], 2)
+
+    def test_no_pool(self):
+        """
+        Test that without a pool files are closed after use
+        and can be rewritten in place
+        """
+        self.manager.max_handles = 0
+        self.assertEqual(self._read(self.files[0]), 0.)
+        self.assertEqual(self.manager.stats()['open_handles'], 0)
+        self._write("file-0.nc", 7.)
+        self.assertEqual(self._read(self.files[0]), 7.)
+
+    def test_fork(self):
+        """
+        Test that a forked child drops the inherited handles
+        without closing them, the parent keeps using them
+        """
+        with self.manager.open(self.files[0]) as nc:
+            inherited = nc
+        self.manager._after_fork() # as in the child
+        self.assertEqual(self.manager.stats()['open_handles'], 0)
+        self.assertTrue(inherited.isopen())
+        with self.manager.open(self.files[0]) as nc:
+            self.assertIsNot(nc, inherited)
+        inherited.close()
+
+    def test_discard_global_lock(self):
+        """
+        Test that with one lock for all files discard waits for reads
+        """
+        manager = o3fileaccess.FileAccessManager(max_handles=2,
+                                                 per_file_locks=False)
+        holding = threading.Event()
+        release = threading.Event()
+        closed = []
+
+        def _hold():
+            with manager.open(self.files[0]) as nc:
+                holding.set()
+                release.wait(5.)
+                closed.append(not nc.isopen())
+
+        holder = threading.Thread(target=_hold)
+        holder.start()
+        holding.wait(5.)
+        discard = threading.Thread(target=manager.discard,
+                                   args=([self.files[0]],))
+        discard.start()
+        discard.join(0.2)
+        self.assertTrue(discard.is_alive())
+        release.set()
+        holder.join(5.)
+        discard.join(5.)
+        self.assertEqual(closed, [False])
+        self.assertEqual(manager.stats()['open_handles'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Tests for the local copies of data files from a slow mount
+"""
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from o3api import config as cfg
+from o3api import filecache as o3filecache
+from o3api import loadtest
+from o3api import plots as o3plots
+
+# configuration for netCDF
+TCO3 = 'tco3_zm'
+VMRO3 = 'vmro3_zm'
+
+# configuration for API
+BEGIN = 'begin'
+END   = 'end'
+MONTH = 'month'
+LAT_MIN = 'lat_min'
+LAT_MAX = 'lat_max'
+
+# simulated latency of the mount, per copied file
+LATENCY = 0.2
+
+
+class SlowFileCache(o3filecache.LocalFileCache):
+    """File cache reading from a mount with latency
+    """
+    def _copy(self, path, tmp_path):
+        time.sleep(LATENCY)
+        super()._copy(path, tmp_path)
+
+
+class TestLocalFileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.remote_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.model_dir = os.path.join(self.remote_dir, 'o3api-model')
+        os.makedirs(self.model_dir)
+        self.files = [ self._write(TCO3 + "-{}.nc".format(i), 1000)
+                       for i in range(3) ]
+        self.vmro3_file = self._write(VMRO3 + "-0.nc", 1000)
+        self.cache = SlowFileCache(self.cache_dir, max_bytes=10000,
+                                   prefetch=True, prefetch_workers=2)
+
+    def tearDown(self):
+        self.cache.wait_prefetch()
+        shutil.rmtree(self.remote_dir)
+        shutil.rmtree(self.cache_dir)
+
+    def _write(self, name, size):
+        path = os.path.join(self.model_dir, name)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        return path
+
+    def _same(self, path, local_path):
+        with open(path, 'rb') as f, open(local_path, 'rb') as f_local:
+            return f.read() == f_local.read()
+
+    def test_copy_and_hit(self):
+        """
+        Test that the file is copied once and read locally afterwards
+        """
+        local_path = self.cache.local_path(self.files[0])
+        self.assertTrue(local_path.startswith(self.cache_dir))
+        self.assertTrue(self._same(self.files[0], local_path))
+        time_start = time.time()
+        self.assertEqual(self.cache.local_path(self.files[0]), local_path)
+        self.assertLess(time.time() - time_start, LATENCY)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_prefetch(self):
+        """
+        Test that other files of the model and plot type are prefetched
+        """
+        self.cache.local_path(self.files[0])
+        self.cache.wait_prefetch()
+        self.assertEqual(self.cache.stats()['prefetched'], 2)
+        for path in self.files[1:]:
+            time_start = time.time()
+            self.cache.local_path(path)
+            self.assertLess(time.time() - time_start, LATENCY)
+        self.assertFalse(os.path.exists(
+                         self.cache.cache_path(self.vmro3_file)))
+        self.assertEqual(self.cache.stats()['hits'], 2)
+
+    def test_changed_file(self):
+        """
+        Test that the copy is refreshed if the original changes
+        """
+        self.cache.prefetch = False
+        self.cache.local_path(self.files[0])
+        os.remove(self.files[0])
+        self._write(os.path.basename(self.files[0]), 2000)
+        local_path = self.cache.local_path(self.files[0])
+        self.assertTrue(self._same(self.files[0], local_path))
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_lru_eviction(self):
+        """
+        Test that least recently used copies are evicted
+        """
+        self.cache.prefetch = False
+        self.cache.max_bytes = 2500
+        self.cache.local_path(self.files[0])
+        time.sleep(0.01)
+        self.cache.local_path(self.files[1])
+        time.sleep(0.01)
+        self.cache.local_path(self.files[0]) # files[1] is now the oldest
+        time.sleep(0.01)
+        self.cache.local_path(self.files[2])
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+        self.assertTrue(os.path.exists(self.cache.cache_path(self.files[0])))
+        self.assertFalse(os.path.exists(self.cache.cache_path(self.files[1])))
+
+
+class TestFileCacheProcessing(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.model = loadtest.make_synthetic_data(self.data_dir, models=1,
+                                                  begin=1975, end=1990)[0]
+        self.base_path = cfg.O3AS_DATA_BASEPATH
+        cfg.O3AS_DATA_BASEPATH = self.data_dir
+        self.file_cache = o3filecache.file_cache
+        self.series_cache = o3plots.series_cache
+
+    def tearDown(self):
+        o3filecache.file_cache.wait_prefetch()
+        o3filecache.file_cache = self.file_cache
+        o3plots.series_cache = self.series_cache
+        cfg.file_cache_conf['enabled'] = False
+        cfg.O3AS_DATA_BASEPATH = self.base_path
+        shutil.rmtree(self.data_dir)
+        shutil.rmtree(self.cache_dir)
+
+    def test_same_series(self):
+        """
+        Test that series read from the local copies (xarray path) are the same
+        """
+        kwargs = { BEGIN: 1978, END: 1985, MONTH: [],
+                   LAT_MIN: -30, LAT_MAX: 30 }
+        expected = o3plots.ProcessForTCO3(**kwargs).get_raw_data(self.model)
+        cfg.file_cache_conf['enabled'] = True
+        o3filecache.file_cache = o3filecache.LocalFileCache(self.cache_dir,
+                                                            2**30)
+        o3plots.series_cache = o3plots.SeriesCache(10)
+        reader_mode = cfg.netcdf_reader_conf['mode']
+        try:
+            cfg.netcdf_reader_conf['mode'] = 'xarray'
+            data = o3plots.ProcessForTCO3(**kwargs)
+            series = data.get_raw_data(self.model)
+        finally:
+            cfg.netcdf_reader_conf['mode'] = reader_mode
+        np.testing.assert_allclose(series.values, expected.values)
+        self.assertGreater(o3filecache.file_cache.stats()['misses'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
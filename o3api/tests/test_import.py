@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Tests for the import-time and memory budget of the service start
+"""
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+# budget for 'import o3api' in a fresh interpreter
+IMPORT_TIME_BUDGET = float(os.getenv('O3API_IMPORT_TIME_BUDGET', 10.)) # s
+IMPORT_RSS_BUDGET = float(os.getenv('O3API_IMPORT_RSS_BUDGET', 200.))  # MB
+
+# modules which should be loaded only when first needed
+LAZY_MODULES = ['matplotlib', 'fpdf', 'statsmodels', 'cProfile']
+
+# ru_maxrss survives exec() on Linux, i.e. reports the forking (pytest)
+# process, therefore the peak RSS is taken from /proc where available
+IMPORT_SCRIPT = """
+import json, resource, sys, threading, time
+time_start = time.perf_counter()
+import o3api
+import o3api.api
+import_time = time.perf_counter() - time_start
+threads = sorted(t.name for t in threading.enumerate())
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+try:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                rss = int(line.split()[1])/1024.
+except OSError:
+    pass
+print(json.dumps({
+    'time': import_time,
+    'rss': rss,
+    'modules': sorted(m for m in sys.modules if '.' not in m),
+    'threads': threads
+}))
+"""
+
+
+class TestImportBudget(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # warm-up and data scan as when serving, they must not start
+        env = dict(os.environ, O3API_WARMUP='background',
+                   O3API_RESCAN_INTERVAL='300')
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT],
+                                         env=env)
+        cls.result = json.loads(output.decode('utf-8').splitlines()[-1])
+
+    def test_lazy_modules(self):
+        """
+        Test that the plotting stack and extras are not imported
+        """
+        loaded = [ m for m in LAZY_MODULES if m in self.result['modules'] ]
+        self.assertEqual(loaded, [])
+
+    def test_import_time(self):
+        """
+        Test that 'import o3api' stays within the time budget
+        """
+        self.assertLess(self.result['time'], IMPORT_TIME_BUDGET)
+
+    def test_import_rss(self):
+        """
+        Test that 'import o3api' stays within the memory budget
+        """
+        self.assertLess(self.result['rss'], IMPORT_RSS_BUDGET)
+
+    def test_no_threads(self):
+        """
+        Test that 'import o3api' starts no background threads
+        (warm-up, data scan), they are started by create_app()
+        """
+        self.assertEqual(self.result['threads'], ['MainThread'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Tests for the operators of latitude grids
+"""
+import numpy as np
+import unittest
+from o3api import aggregates as o3aggregates
+from o3api import latgrid as o3latgrid
+
+
+class TestLatGrid(unittest.TestCase):
+
+    def setUp(self):
+        self.lats = np.arange(-85., 90., 10.)
+        self.values = np.random.default_rng(9).normal(300., 20.,
+                                                      (self.lats.size, 50))
+        self.values[4, 10:20] = np.nan # missing data
+
+    def test_bands(self):
+        """
+        Test the band selection for both latitude orders
+        """
+        grids = o3latgrid.GridCache(4, 'cos')
+        ascending = grids.get(self.lats).band(-30, 50)
+        descending = grids.get(self.lats[::-1]).band(-30, 50)
+        selected = (self.lats >= -30) & (self.lats <= 50)
+        self.assertEqual(ascending.index, slice(6, 14))
+        self.assertEqual(descending.index, slice(4, 12))
+        np.testing.assert_array_equal(ascending.mask, selected)
+        np.testing.assert_array_equal(descending.mask, selected[::-1])
+        np.testing.assert_allclose(ascending.weights,
+                                   np.cos(np.deg2rad(self.lats[selected])))
+        np.testing.assert_allclose(
+            o3latgrid.weighted_mean(self.values[ascending.index],
+                                    ascending.weights),
+            o3latgrid.weighted_mean(self.values[::-1][descending.index],
+                                    descending.weights))
+        empty = grids.get(self.lats).band(86, 90)
+        self.assertEqual(empty.weights.size, 0)
+        self.assertTrue(np.isnan(o3latgrid.weighted_mean(
+                            self.values[empty.index], empty.weights)).all())
+
+    def test_cache(self):
+        """
+        Test that models on the same grid share the operators
+        """
+        grids = o3latgrid.GridCache(2, 'cos')
+        grid = grids.get(self.lats)
+        self.assertIs(grids.get(self.lats.copy()), grid)
+        self.assertIs(grid.band(-90, 0), grid.band(-90., 0.))
+        grids.get(self.lats[::-1])
+        grids.get(np.arange(-89.5, 90., 1.))
+        self.assertEqual(grids.stats()['grids'], 2)
+        self.assertEqual(grids.stats()['hits'], 1)
+        with self.assertRaises(ValueError):
+            o3latgrid.GridCache(2, 'gauss')
+
+    def test_bands_bounded(self):
+        """
+        Test that a grid keeps only the most recently used bands
+        """
+        grid = o3latgrid.GridCache(2, 'cos', max_bands=3).get(self.lats)
+        south = grid.band(-90, -60)
+        north = grid.band(0, 90)
+        for lat in range(10, 60, 10):
+            grid.band(lat, 90)
+            self.assertIs(grid.band(-90, -60), south) # recently used
+        self.assertEqual(len(grid._bands), 3)
+        again = grid.band(0, 90) # dropped, computed again
+        self.assertIsNot(again, north)
+        np.testing.assert_array_equal(again.mask, north.mask)
+
+    def test_means(self):
+        """
+        Test the weighted means against numpy, equal weights as plain means
+        """
+        bands = [(-90, -60), (-20, 20), (60, 90)]
+        weights = np.cos(np.deg2rad(self.lats))
+        valid = ~np.isnan(self.values)
+        means = o3aggregates.band_means(self.values, self.lats, bands)
+        for mean, (lat_a, lat_b) in zip(means.T, bands):
+            sel = (self.lats >= lat_a) & (self.lats <= lat_b)
+            expected = ((weights[sel] @ np.where(valid, self.values, 0.)[sel])/
+                        (weights[sel] @ valid[sel]))
+            np.testing.assert_allclose(mean, expected, rtol=1e-12)
+        grid = o3latgrid.LatGrid(self.lats, 'none')
+        band = grid.band(-30, 50)
+        np.testing.assert_allclose(
+            o3latgrid.weighted_mean(self.values[band.index], band.weights),
+            np.nanmean(self.values[band.index], axis=0), rtol=1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()
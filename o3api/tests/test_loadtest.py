@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Tests for the load generator helpers
+"""
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+from o3api import loadtest
+from o3api import replay
+
+
+class TestLoadtestMethods(unittest.TestCase):
+
+    def test_parse_mix(self):
+        """
+        Test that the request mix is parsed and normalized
+        """
+        kinds, weights = loadtest.parse_mix('plot_json=3,list_models=1')
+        self.assertEqual(kinds, ['plot_json', 'list_models'])
+        self.assertEqual(weights, [0.75, 0.25])
+        with self.assertRaises(ValueError):
+            loadtest.parse_mix('unknown=1')
+
+    def test_build_request(self):
+        """
+        Test that plot requests have a valid parameter range
+        """
+        rng = random.Random(1)
+        path, query, headers = loadtest.build_request('plot_pdf',
+                                                      ['a', 'b'], rng)
+        params = dict(query)
+        self.assertEqual(path, '/api/plot')
+        self.assertEqual(headers['Accept'], 'application/pdf')
+        self.assertLess(params['begin'], params['end'])
+        self.assertLess(params['lat_min'], params['lat_max'])
+
+    def test_summarize(self):
+        """
+        Test summary statistics and comparison to a baseline
+        """
+        results = [('plot_json', 200, 0.1, 10)]*9 + [('plot_json', 500, 1., 0)]
+        summary = loadtest.summarize(results, elapsed=2.)
+        self.assertEqual(summary['requests'], 10)
+        self.assertEqual(summary['error_rate'], 0.1)
+        self.assertEqual(summary['throughput_rps'], 5.)
+        self.assertEqual(summary['p50_ms'], 100.)
+        diff = loadtest.compare(summary, dict(summary, p50_ms=50.))
+        self.assertEqual(diff['p50_ms'], 1.)
+        self.assertEqual(loadtest.regressed(summary, summary, 0.1), [])
+        self.assertEqual(loadtest.regressed(summary, dict(summary,
+                                            p50_ms=50.), 0.1), ['p50_ms'])
+        self.assertEqual(loadtest.regressed(summary, dict(summary,
+                                            error_rate=0.), 0.1),
+                         ['error_rate'])
+
+    def test_rate_latency(self):
+        """
+        Test that open-loop latencies include the wait behind a slow
+        service (measured from the scheduled send time)
+        """
+        class _Response:
+            status = 200
+
+            def read(self):
+                return b'[]'
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                return False
+
+        def _urlopen(req, timeout):
+            time.sleep(0.05)
+            return _Response()
+
+        with mock.patch.object(loadtest.urllib.request, 'urlopen',
+                               side_effect=_urlopen):
+            results, _ = loadtest.run_load('http://127.0.0.1:1', ['m'],
+                                           mix='list_models=1',
+                                           concurrency=1, rate=100.,
+                                           duration=5., requests=10)
+        latencies = sorted(latency for _, _, latency, _ in results)
+        self.assertEqual(len(latencies), 10)
+        # 10 requests of 50 ms, one every 10 ms: the last waits ~400 ms
+        self.assertGreater(latencies[-1], 0.3)
+
+    def test_server_env(self):
+        """
+        Test that the started server has admission control and the
+        scheduler off unless asked for
+        """
+        with mock.patch.object(loadtest.subprocess, 'Popen') as popen, \
+             mock.patch.object(loadtest, 'send_request',
+                               return_value=(200, 0., 0)):
+            popen.return_value.poll.return_value = None
+            loadtest.start_server('/data', port=1)
+            env = popen.call_args[1]['env']
+            self.assertEqual(env['O3API_ADMISSION'], 'false')
+            self.assertEqual(env['O3API_SCHEDULER'], 'false')
+            loadtest.start_server('/data', port=1, admission=True)
+            self.assertEqual(popen.call_args[1]['env']['O3API_ADMISSION'],
+                             'true')
+
+    def test_make_synthetic_data(self):
+        """
+        Test that synthetic models are created as netCDF files
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            models = loadtest.make_synthetic_data(tmp_dir, models=2,
+                                                  begin=2000, end=2001)
+            self.assertEqual(len(models), 2)
+            for m in models:
+                files = os.listdir(os.path.join(tmp_dir, m))
+                self.assertTrue(all(f.endswith('.nc') for f in files))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestReplayMethods(unittest.TestCase):
+
+    def test_to_request(self):
+        """
+        Test that a recorded request is converted back to the API call
+        """
+        record = {'ts': 0., 'endpoint': 'plot', 'accept': 'application/pdf',
+                  'params': {'ptype': 'tco3_zm', 'model': ['a', 'b'],
+                             'month': [1, 2], 'begin': 1980}}
+        path, query, headers = replay.to_request(record)
+        self.assertEqual(path, '/api/plot')
+        self.assertIn(('model', 'a,b'), query)
+        self.assertIn(('month', '1,2'), query)
+        self.assertIn(('begin', 1980), query)
+        self.assertEqual(replay.request_kind(record), 'plot_pdf')
+        record = {'endpoint': 'plot_batch', 'accept': 'application/json',
+                  'params': {'body': [{'ptype': 'tco3_zm', 'model': ['a']}]}}
+        path, query, headers = replay.to_request(record)
+        self.assertEqual(query, [])
+        self.assertEqual(headers['Content-Type'], 'application/json')
+
+    def test_diff(self):
+        """
+        Test the comparison of two replays
+        """
+        results = [('plot_json', 200, 0.1, 10)]*10
+        summary_a = loadtest.summarize(results, elapsed=1.)
+        summary_b = loadtest.summarize([(k, s, 2*l, n)
+                                        for k, s, l, n in results], 1.)
+        change = replay.diff(summary_a, summary_b)
+        self.assertEqual(change['kinds']['plot_json']['p99_ms'], 1.)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(tmp_dir, name) for name in ['a', 'b']]
+            for path, summary in zip(paths, [summary_a, summary_b]):
+                with open(path, 'w') as f:
+                    json.dump(summary, f)
+            with contextlib.redirect_stdout(io.StringIO()), \
+                 contextlib.redirect_stderr(io.StringIO()):
+                self.assertEqual(replay.main(['diff'] + paths), 1)
+                self.assertEqual(replay.main(['diff'] + paths[::-1]), 0)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Tests for the tile pyramid of the (lat x time) field
+"""
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+from o3api import pyramid as o3pyramid
+from o3api.tests import SyntheticData, monthly
+
+# configuration for netCDF
+TIME = 'time'
+LAT  = 'lat'
+TCO3 = 'tco3_zm'
+
+
+class TestTilePyramid(unittest.TestCase):
+
+    def setUp(self):
+        self.data = SyntheticData()
+        self.pyramid_dir = tempfile.mkdtemp()
+        self.model = 'o3api-pyramid'
+        # 2 degree, monthly, 1960-1999, latitudes descending, two files
+        self.lats = np.arange(89., -90., -2.)
+        self.times = monthly("1960-01", "2000-01")
+        self.values = np.random.default_rng(1).normal(
+                          300., 20., (self.lats.size, self.times.size))
+        self.values[10, 5:30] = np.nan
+        self._write(self.values)
+        self.pyramid = o3pyramid.TilePyramid(self.pyramid_dir, tile_time=16,
+                                             tile_lat=8)
+
+    def _write(self, values):
+        self.data.write(self.model, values, self.lats, self.times, files=2,
+                        dims=(TIME, LAT))
+
+    def tearDown(self):
+        self.data.restore()
+        shutil.rmtree(self.pyramid_dir)
+
+    def _level(self, tres, lres):
+        """Whole level assembled from its tiles
+        """
+        first = self.pyramid.get_tile(self.model, TCO3, tres, lres, 0, 0)
+        rows = []
+        for ty in range(first['n_ty']):
+            tiles = [ self.pyramid.get_tile(self.model, TCO3, tres, lres,
+                                            tx, ty)
+                      for tx in range(first['n_tx']) ]
+            for tile in tiles:
+                self.assertLessEqual(tile['values'].shape[0], 8)
+                self.assertLessEqual(tile['values'].shape[1], 16)
+            rows.append((np.concatenate([t['values'] for t in tiles],
+                                        axis=1),
+                         tiles[0]['lat'],
+                         np.concatenate([t['time'] for t in tiles])))
+        return (np.concatenate([r[0] for r in rows]),
+                np.concatenate([r[1] for r in rows]), rows[0][2])
+
+    def test_levels(self):
+        """
+        Test the levels against means computed with numpy
+        """
+        values, lats, time_axis = self._level('monthly', 'native')
+        order = np.argsort(self.lats)
+        np.testing.assert_allclose(values, self.values[order], rtol=1e-6)
+        np.testing.assert_array_equal(lats, self.lats[order])
+        self.assertEqual(time_axis.size, self.times.size)
+
+        values, lats, time_axis = self._level('decadal', '10')
+        self.assertEqual(values.shape, (18, 4))
+        np.testing.assert_allclose(lats, np.arange(-85., 90., 10.))
+        self.assertEqual(str(time_axis[1]), '1970-01')
+        # 5 latitudes of 2 degrees per 10 degree band, NaN skipped
+        with np.errstate(invalid='ignore'):
+            expected = np.nanmean(
+                self.values[order][:, :120].reshape(18, 5, 120),
+                axis=(1, 2))
+        np.testing.assert_allclose(values[:, 0], expected, rtol=1e-6)
+
+    def test_lazy_build_and_rebuild(self):
+        """
+        Test that the pyramid is built once and rebuilt if data changes
+        """
+        self.assertFalse(self.pyramid.is_built(self.model, TCO3))
+        self.pyramid.get_tile(self.model, TCO3, 'annual', '5', 0, 0)
+        self.pyramid.get_tile(self.model, TCO3, 'annual', '5', 1, 1)
+        self.assertEqual(self.pyramid.stats()['builds'], 1)
+        self.assertTrue(self.pyramid.is_built(self.model, TCO3))
+        time.sleep(0.01)
+        self._write(self.values + 1.)
+        self.assertFalse(self.pyramid.is_built(self.model, TCO3))
+        tile = self.pyramid.get_tile(self.model, TCO3, 'monthly', 'native',
+                                     0, 0)
+        self.assertEqual(self.pyramid.stats()['builds'], 2)
+        order = np.argsort(self.lats)
+        np.testing.assert_allclose(tile['values'],
+                                   self.values[order][:8, :16] + 1.,
+                                   rtol=1e-6)
+        # the pyramid of the old data is removed
+        self.assertEqual(len(os.listdir(os.path.join(self.pyramid_dir, TCO3,
+                                                     self.model))), 1)
+
+    def test_out_of_range(self):
+        """
+        Test that unknown resolutions and tiles are rejected
+        """
+        with self.assertRaises(o3pyramid.TileError):
+            self.pyramid.get_tile(self.model, TCO3, 'weekly', 'native', 0, 0)
+        with self.assertRaises(o3pyramid.TileError):
+            self.pyramid.get_tile(self.model, TCO3, 'annual', 'native', 3, 0)
+
+    def test_offline_build(self):
+        """
+        Test the command line build
+        """
+        pyramid = o3pyramid.pyramid
+        o3pyramid.pyramid = self.pyramid
+        try:
+            self.assertEqual(o3pyramid.main(['--model', self.model]), 0)
+            with mock.patch.object(self.pyramid, 'build',
+                                   side_effect=o3pyramid.TileError("test")):
+                self.assertEqual(o3pyramid.main(['--model', self.model]), 1)
+        finally:
+            o3pyramid.pyramid = pyramid
+        self.assertEqual(self.pyramid.stats()['builds'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
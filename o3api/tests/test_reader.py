@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Tests for the direct netCDF4 reader against the xarray path
+"""
+import numpy as np
+import os
+import tracemalloc
+import unittest
+import xarray as xr
+from o3api import config as cfg
+from o3api import plots as o3plots
+from o3api.tests import SyntheticData, monthly
+
+# configuration for netCDF
+TIME = 'time'
+LAT  = 'lat'
+VMRO3 = 'vmro3_zm'
+PLEV = 'plev'
+
+# configuration for API
+BEGIN = 'begin'
+END   = 'end'
+MONTH = 'month'
+LAT_MIN = 'lat_min'
+LAT_MAX = 'lat_max'
+LEVEL_MIN = 'level_min'
+LEVEL_MAX = 'level_max'
+
+
+def lat_mean(values, lats):
+    """Mean over the last axis (latitude) with cos(lat) weights, NaNs skipped
+    """
+    weights = np.cos(np.deg2rad(lats))
+    valid = ~np.isnan(values)
+    return (np.where(valid, values, 0.) @ weights)/(valid @ weights)
+
+
+class TestNetCDFReader(unittest.TestCase):
+
+    def setUp(self):
+        self.data = SyntheticData()
+        self.reader_mode = cfg.netcdf_reader_conf['mode']
+
+        rng = np.random.default_rng(7)
+        lats = np.arange(-85., 90., 10.)
+        times = monthly("1975-01", "1991-01")
+        values = rng.normal(300., 20., (lats.size, times.size))
+        values[3, 10:20] = np.nan # missing data
+        # same data: (lat, time) with -90..90, (time, lat) with 90..-90
+        self.models = ['o3api-reader-asc', 'o3api-reader-desc']
+        self.data.write(self.models[0], values, lats, times, files=3)
+        self.data.write(self.models[1], values[::-1], lats[::-1], times,
+                        files=3, dims=(TIME, LAT))
+
+    def tearDown(self):
+        cfg.netcdf_reader_conf['mode'] = self.reader_mode
+        self.data.restore()
+
+    def _process(self, mode, **kwargs):
+        cfg.netcdf_reader_conf['mode'] = mode
+        # clear processed data of the other mode
+        o3plots.series_cache = o3plots.SeriesCache(
+                                   cfg.series_cache_conf['max_entries'])
+        data = o3plots.ProcessForTCO3(**kwargs)
+        return [ (data.get_raw_data(m), data.get_ref1980(m))
+                 for m in self.models ]
+
+    def test_same_as_xarray(self):
+        """
+        Test that the netCDF4 reader gives the xarray results,
+        for both latitude orders and across files
+        """
+        block_bytes = cfg.netcdf_reader_conf['block_bytes']
+        # small blocks, crossing file borders
+        cfg.netcdf_reader_conf['block_bytes'] = 8*8*5
+        for month, mode in [([], 'netcdf4'), ([2, 11], 'netcdf4'),
+                            ([], 'stream'), ([2, 11], 'stream')]:
+            kwargs = { BEGIN: 1977, END: 1987, MONTH: month,
+                       LAT_MIN: -30, LAT_MAX: 50 }
+            expected = self._process('xarray', **kwargs)
+            result = self._process(mode, **kwargs)
+            for (series, ref), (exp_series, exp_ref) in zip(result, expected):
+                np.testing.assert_allclose(series.values, exp_series.values,
+                                           rtol=1e-6)
+                np.testing.assert_array_equal(series.index, exp_series.index)
+                self.assertAlmostEqual(ref, exp_ref, places=4)
+            # both latitude orders give the same
+            np.testing.assert_allclose(result[0][0].values,
+                                       result[1][0].values)
+        cfg.netcdf_reader_conf['block_bytes'] = block_bytes
+
+    def test_float32(self):
+        """
+        Test that float32 results agree with float64 ones for all readers
+        """
+        kwargs = { BEGIN: 1977, END: 1987, MONTH: [],
+                   LAT_MIN: -30, LAT_MAX: 50 }
+        expected = self._process('netcdf4', **kwargs)
+        dtype = cfg.precision_conf['dtype']
+        cfg.precision_conf['dtype'] = 'float32'
+        try:
+            for mode in ['netcdf4', 'stream', 'xarray']:
+                result = self._process(mode, **kwargs)
+                for (series, ref), (exp_series, exp_ref) in zip(result,
+                                                                expected):
+                    self.assertEqual(series.dtype, np.float32)
+                    np.testing.assert_allclose(series.values,
+                                               exp_series.values, rtol=1e-6)
+                    self.assertAlmostEqual(ref, exp_ref, places=3)
+        finally:
+            cfg.precision_conf['dtype'] = dtype
+
+    def test_auto_selection(self):
+        """
+        Test that the reader is selected for small selections only
+        """
+        kwargs = { BEGIN: 1977, END: 1987, MONTH: [],
+                   LAT_MIN: -30, LAT_MAX: 50 }
+        data = o3plots.ProcessForTCO3(**kwargs)
+        cfg.netcdf_reader_conf['mode'] = 'auto'
+        # 11 years x 12 months x 8 latitudes
+        max_points = cfg.netcdf_reader_conf['max_points']
+        try:
+            cfg.netcdf_reader_conf['max_points'] = 11*12*8
+            self.assertEqual(data.select_reader(self.models[0], 1977, 1987),
+                             'netcdf4')
+            cfg.netcdf_reader_conf['max_points'] = 11*12*8 - 1
+            self.assertEqual(data.select_reader(self.models[1], 1977, 1987),
+                             'stream')
+        finally:
+            cfg.netcdf_reader_conf['max_points'] = max_points
+
+
+
+class TestVMRO3Reader(unittest.TestCase):
+
+    def setUp(self):
+        self.data = SyntheticData()
+        self.reader_mode = cfg.netcdf_reader_conf['mode']
+
+        rng = np.random.default_rng(11)
+        self.lats = np.arange(-85., 90., 10.)
+        self.levels = np.array([1000., 500., 200., 100., 50., 10., 1.]) # hPa
+        times = monthly("1978-01", "1984-01")
+        self.values = rng.normal(5., 1., (times.size, self.levels.size,
+                                          self.lats.size))
+        self.values[5:9, 2, 4] = np.nan # missing data
+        self.times = times
+        self.model = 'o3api-reader-vmro3'
+        model_dir = os.path.join(self.data.data_dir, self.model)
+        os.makedirs(model_dir)
+        # levels in Pa, as in CF conventions, two files
+        for i, t_idx in enumerate(np.array_split(np.arange(times.size), 2)):
+            ds = xr.Dataset({VMRO3: ((TIME, PLEV, LAT),
+                                     self.values[t_idx])},
+                            coords={TIME: times[t_idx],
+                                    PLEV: (PLEV, self.levels*100.,
+                                           {'units': 'Pa'}),
+                                    LAT: self.lats})
+            ds.to_netcdf(os.path.join(model_dir,
+                                      "{}-{}.nc".format(VMRO3, i)))
+
+    def tearDown(self):
+        cfg.netcdf_reader_conf['mode'] = self.reader_mode
+        self.data.restore()
+
+    def _process(self, mode, **kwargs):
+        cfg.netcdf_reader_conf['mode'] = mode
+        o3plots.series_cache = o3plots.SeriesCache(
+                                   cfg.series_cache_conf['max_entries'])
+        data = o3plots.ProcessForVMRO3(**kwargs)
+        return (data.get_raw_data(self.model), data.get_ref1980(self.model),
+                data.get_level_time(self.model))
+
+    def test_level_selection(self):
+        """
+        Test the selected levels and latitudes against numpy,
+        for all readers
+        """
+        kwargs = { BEGIN: 1979, END: 1982, MONTH: [3, 4, 5],
+                   LAT_MIN: -30, LAT_MAX: 50,
+                   LEVEL_MIN: 10, LEVEL_MAX: 200 }
+        t_sel = ((self.times >= np.datetime64('1979-01')) &
+                 (self.times < np.datetime64('1983-01')) &
+                 np.isin(self.times.astype('datetime64[M]').astype(int) % 12,
+                         [2, 3, 4]))
+        lev_sel = (self.levels >= 10) & (self.levels <= 200)
+        lat_sel = (self.lats >= -30) & (self.lats <= 50)
+        selected = self.values[t_sel][:, lev_sel][:, :, lat_sel]
+        exp_field = lat_mean(selected, self.lats[lat_sel])
+        exp_series = np.nanmean(exp_field, axis=1)
+        t_1980 = self.times.astype('datetime64[Y]') == np.datetime64('1980')
+        t_1980 &= np.isin(self.times.astype('datetime64[M]').astype(int) % 12,
+                          [2, 3, 4])
+        exp_ref = np.nanmean(lat_mean(self.values[t_1980][:, lev_sel]
+                                      [:, :, lat_sel], self.lats[lat_sel]))
+
+        stream_bytes = cfg.netcdf_reader_conf['block_bytes']
+        cfg.netcdf_reader_conf['block_bytes'] = 8*3*8*2 # 2 time points
+        try:
+            for mode in ['netcdf4', 'stream', 'xarray']:
+                series, ref, field = self._process(mode, **kwargs)
+                np.testing.assert_allclose(series.values, exp_series,
+                                           rtol=1e-6)
+                np.testing.assert_array_equal(series.index,
+                                              self.times[t_sel])
+                np.testing.assert_allclose(field.values, exp_field,
+                                           rtol=1e-6)
+                np.testing.assert_allclose(field.columns,
+                                           self.levels[lev_sel])
+                self.assertAlmostEqual(ref, exp_ref, places=6)
+        finally:
+            cfg.netcdf_reader_conf['block_bytes'] = stream_bytes
+
+    def test_all_levels(self):
+        """
+        Test that all levels are used without a level range
+        """
+        kwargs = { BEGIN: 1978, END: 1983, MONTH: [],
+                   LAT_MIN: -90, LAT_MAX: 90 }
+        series, _, field = self._process('netcdf4', **kwargs)
+        self.assertEqual(field.shape, (self.times.size, self.levels.size))
+        # mean over latitude first, then over levels
+        np.testing.assert_allclose(series.values,
+                                   np.nanmean(lat_mean(self.values, self.lats),
+                                              axis=1),
+                                   rtol=1e-6)
+
+
+class TestStreamMemory(unittest.TestCase):
+
+    def setUp(self):
+        self.data = SyntheticData()
+        self.model = 'o3api-reader-large'
+        # 1 degree, daily data: 181 x 14610 x 8 bytes ~ 21 MB
+        lats = np.arange(-90., 91., 1.)
+        times = np.arange("1960-01-01", "2000-01-01",
+                          dtype='datetime64[D]').astype('datetime64[ns]')
+        values = np.random.default_rng(3).normal(300., 20.,
+                                                 (lats.size, times.size))
+        self.data_bytes = values.nbytes
+        self.data.write(self.model, values, lats, times)
+        self.expected = lat_mean(values.T, lats)
+
+    def tearDown(self):
+        self.data.restore()
+
+    def _peak(self, func):
+        tracemalloc.start()
+        try:
+            result = func()
+            return result, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_bounded_memory(self):
+        """
+        Test that the peak memory of streaming is bounded by the block size
+        """
+        kwargs = { BEGIN: 1960, END: 1999, MONTH: [],
+                   LAT_MIN: -90, LAT_MAX: 90 }
+        data = o3plots.ProcessForTCO3(**kwargs)
+        # coordinates are read (and cached) before measuring
+        data.select_reader(self.model, 1960, 1999)
+        block_bytes = 1024*1024
+        (means, time_axis), peak = self._peak(
+            lambda: data.stream_lat_mean(self.model, 1960, 1999, block_bytes))
+        np.testing.assert_allclose(means, self.expected)
+        self.assertEqual(time_axis.size, self.expected.size)
+        print("[READER] peak: stream {:.1f} MB".format(peak/2**20))
+        # a few copies of the block (read, NaN handling) plus the result
+        self.assertLess(peak, 5*block_bytes + 4*self.expected.nbytes)
+        _, peak = self._peak(lambda: data.read_slice(self.model, 1960, 1999))
+        print("[READER] peak: whole slice {:.1f} MB".format(peak/2**20))
+        self.assertGreater(peak, self.data_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Tests for the results stored on disk
+"""
+import multiprocessing
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+from o3api import config as cfg
+from o3api import plots as o3plots
+from o3api import resultstore as o3resultstore
+from o3api.tests import SyntheticData, monthly
+
+# configuration for netCDF
+TCO3 = 'tco3_zm'
+
+# configuration for API
+MODEL = 'model'
+BEGIN = 'begin'
+END   = 'end'
+MONTH = 'month'
+LAT_MIN = 'lat_min'
+LAT_MAX = 'lat_max'
+
+
+def _put_many(directory, worker):
+    """Store results from another process
+    """
+    store = o3resultstore.ResultStore(directory, 10*1024**2)
+    for i in range(20):
+        store.put(('worker', worker, i), np.full(100, float(i)))
+
+
+class TestResultStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.store = o3resultstore.ResultStore(self.store_dir, 10*1024**2)
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_values(self):
+        """
+        Test that all kinds of results are stored and read back
+        """
+        time_axis = pd.DatetimeIndex(np.arange("1980-01", "1981-01",
+                                               dtype='datetime64[M]'))
+        series = pd.Series(np.arange(12, dtype=np.float32), index=time_axis,
+                           name='model-a')
+        frame = pd.DataFrame(np.ones((12, 3)), index=time_axis,
+                             columns=pd.Index([10., 50., 100.], name='plev'))
+        table = (pd.DataFrame([[2040., np.nan]], index=['model-a'],
+                              columns=['-90..-60', '-20..20']),
+                 pd.DataFrame([[290., 280.]], index=['model-a'],
+                              columns=['-90..-60', '-20..20']))
+        values = { 'series': series, 'frame': frame, 'table': table,
+                   'ref': np.float64(301.5), 'annual': np.eye(3) }
+        for kind, value in values.items():
+            self.store.put(kind, value)
+        pd.testing.assert_series_equal(self.store.get('series'), series,
+                                       check_freq=False)
+        pd.testing.assert_frame_equal(self.store.get('frame'), frame,
+                                      check_freq=False)
+        for stored, expected in zip(self.store.get('table'), table):
+            pd.testing.assert_frame_equal(stored, expected)
+        self.assertEqual(self.store.get('ref'), 301.5)
+        np.testing.assert_array_equal(self.store.get('annual'), np.eye(3))
+        self.assertIsNone(self.store.get('other'))
+        stats = self.store.stats()
+        self.assertEqual(stats['entries'], 5)
+        self.assertEqual((stats['hits'], stats['misses']), (5, 1))
+
+    def test_eviction(self):
+        """
+        Test that least recently used results are removed
+        """
+        value = np.zeros(1000)
+        self.store.put('a', value)
+        size = self.store.stats()['bytes']
+        self.store.max_bytes = 3*size
+        for key in ['b', 'c']:
+            self.store.put(key, value)
+        self.store.get('a')
+        self.store.put('d', value)
+        self.assertIsNone(self.store.get('b'))
+        for key in ['a', 'c', 'd']:
+            self.assertIsNotNone(self.store.get(key))
+        self.assertEqual(self.store.stats()['evictions'], 1)
+        self.assertEqual(len([ f for f in os.listdir(self.store_dir)
+                               if f.endswith(".npz") ]), 3)
+
+    def test_workers(self):
+        """
+        Test concurrent writes of several processes
+        """
+        ctx = multiprocessing.get_context('fork')
+        workers = [ ctx.Process(target=_put_many, args=(self.store_dir, w))
+                    for w in range(4) ]
+        [ w.start() for w in workers ]
+        [ w.join() for w in workers ]
+        self.assertEqual([ w.exitcode for w in workers ], [0]*4)
+        self.assertEqual(self.store.stats()['entries'], 80)
+        np.testing.assert_array_equal(self.store.get(('worker', 3, 7)),
+                                      np.full(100, 7.))
+
+    def test_discard(self):
+        """
+        Test that results of the data fingerprint are removed
+        """
+        old = (('/data/m/tco3_zm.nc', 1.5, 100),)
+        new = (('/data/m/tco3_zm.nc', 2.5, 110),)
+        self.store.put((TCO3, 'm', 'raw', old), np.ones(3))
+        self.store.put(('tco_return', (('m', old), ('n', new))), np.ones(3))
+        self.store.put((TCO3, 'm', 'raw', new), np.ones(3))
+        self.assertEqual(self.store.discard(old), 2)
+        self.assertIsNone(self.store.get((TCO3, 'm', 'raw', old)))
+        self.assertIsNotNone(self.store.get((TCO3, 'm', 'raw', new)))
+        # a failed discard does not leave the transaction open
+        with mock.patch.object(self.store, '_remove',
+                               side_effect=sqlite3.OperationalError("test")):
+            self.assertEqual(self.store.discard(new), 0)
+        self.assertFalse(self.store._db().in_transaction)
+        self.store.put((TCO3, 'm', 'raw', old), np.ones(3))
+        self.assertIsNotNone(self.store.get((TCO3, 'm', 'raw', old)))
+
+
+class TestStoredResults(unittest.TestCase):
+
+    def setUp(self):
+        self.data = SyntheticData()
+        self.store_dir = tempfile.mkdtemp()
+        self.enabled = cfg.result_store_conf['enabled']
+        self.store = o3resultstore.result_store
+        cfg.result_store_conf['enabled'] = True
+        o3resultstore.result_store = o3resultstore.ResultStore(
+                                         self.store_dir, 10*1024**2)
+
+        self.model = 'o3api-results'
+        self.data.normal(self.model, np.arange(-85., 90., 10.),
+                         monthly("1975-01", "1986-01"),
+                         np.random.default_rng(3))
+
+    def tearDown(self):
+        cfg.result_store_conf['enabled'] = self.enabled
+        o3resultstore.result_store = self.store
+        self.data.restore()
+        shutil.rmtree(self.store_dir)
+
+    def _process(self, data_class, **kwargs):
+        """Process with a new (empty) series cache, as a new worker
+        """
+        o3plots.series_cache = o3plots.SeriesCache(
+                                   cfg.series_cache_conf['max_entries'])
+        data = data_class(**kwargs)
+        return (data.get_raw_data(self.model), data.get_ref1980(self.model))
+
+    def test_shared(self):
+        """
+        Test that a new worker reads the results from the store
+        """
+        kwargs = { MODEL: self.model, BEGIN: 1975, END: 1985,
+                   MONTH: [12, 1, 2], LAT_MIN: -30, LAT_MAX: 30 }
+        for data_class in [o3plots.ProcessForTCO3,
+                           o3plots.ProcessForTCO3Return]:
+            series, ref = self._process(data_class, **kwargs)
+            writes = o3resultstore.result_store.stats()['writes']
+            self.assertGreater(writes, 0)
+            stored, stored_ref = self._process(data_class, **kwargs)
+            stats = o3resultstore.result_store.stats()
+            self.assertEqual(stats['writes'], writes)
+            pd.testing.assert_series_equal(stored, series, check_freq=False)
+            np.testing.assert_array_equal(np.asarray(stored_ref),
+                                          np.asarray(ref))
+
+
+if __name__ == '__main__':
+    unittest.main()
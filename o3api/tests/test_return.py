@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Tests for the vectorized ozone return analysis (tco3_return)
+"""
+import numpy as np
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from o3api import aggregates as o3aggregates
+from o3api import config as cfg
+from o3api import plots as o3plots
+from o3api.tests import SyntheticData, monthly
+
+# configuration for API
+MODEL = 'model'
+BEGIN = 'begin'
+END   = 'end'
+MONTH = 'month'
+LAT_MIN = 'lat_min'
+LAT_MAX = 'lat_max'
+BANDS = 'bands'
+
+
+class TestTCO3Return(unittest.TestCase):
+
+    def setUp(self):
+        # compare with band means computed from the files
+        self.data = SyntheticData()
+
+        rng = np.random.default_rng(5)
+        lats = np.arange(-85., 90., 10.)
+        times = monthly("1960-01", "2061-01")
+        years = times.astype('datetime64[Y]').astype(int) + 1970
+        t = years + (times.astype('datetime64[M]').astype(int) % 12)/12.
+        self.models = ['o3api-return-a', 'o3api-return-b', 'o3api-return-c']
+        # depletion from 1980 to 2000, recovery until a year depending on
+        # the model and the hemisphere, model c does not recover
+        for i, model in enumerate(self.models):
+            recovery = np.where(lats < 0, 2040. + 5*i, 2030. + 5*i)
+            depletion = np.clip((t[np.newaxis, :] - 1980.)/20., 0., 1.)
+            recovered = np.clip((t[np.newaxis, :] - 2000.)/
+                                (recovery[:, np.newaxis] - 2000.), 0., 1.1)
+            if i == 2:
+                recovered *= 0.5
+            values = (300. - 30.*(depletion - recovered) +
+                      rng.normal(0., 2., (lats.size, times.size)))
+            self.data.write(model, values, lats, times)
+
+    def tearDown(self):
+        self.data.restore()
+
+    def _expected(self, model, band, month):
+        """Return year computed per model and band with pandas
+        """
+        kwargs = { BEGIN: 1960, END: 2060, MONTH: month,
+                   LAT_MIN: band[0], LAT_MAX: band[1] }
+        series = o3plots.ProcessForTCO3(**kwargs).get_raw_data(model)
+        annual = series.groupby(series.index.year).mean()
+        smooth = annual.rolling(cfg.tco3_return_conf['boxcar'],
+                                center=True, min_periods=1).mean()
+        ref = smooth.loc[1980]
+        after = smooth.loc[1980:]
+        if after.min() >= ref: # no dip, no return
+            return np.nan
+        after = after.loc[after.idxmin():].iloc[1:]
+        returned = after[after >= ref]
+        return returned.index[0] if len(returned) else np.nan
+
+    def test_same_as_per_model(self):
+        """
+        Test the vectorized return years against a per-model computation
+        """
+        bands = ["-90:-60", "-60:-35", "-20:20", "35:60", "60:90"]
+        for month in [[], [10]]:
+            kwargs = { MODEL: self.models, BEGIN: 1960, END: 2060,
+                       MONTH: month, LAT_MIN: -10, LAT_MAX: 10,
+                       BANDS: bands }
+            data = o3plots.ProcessForTCO3Return(**kwargs)
+            for model in self.models:
+                result = data.get_raw_data(model)
+                self.assertEqual(list(result.index),
+                                 ['-90..-60', '-60..-35', '-20..20',
+                                  '35..60', '60..90'])
+                for band, label in zip(data.bands, result.index):
+                    expected = self._expected(model, band, month)
+                    if np.isnan(expected):
+                        self.assertTrue(np.isnan(result[label]))
+                    else:
+                        self.assertEqual(result[label], expected)
+            # model c does not return
+            self.assertTrue(data.get_raw_data(self.models[2]).isna().all())
+            self.assertTrue(data.get_raw_data(self.models[0]).notna().all())
+
+    def test_no_dip(self):
+        """
+        Test that series never below the 1980 value do not return
+        """
+        years = np.arange(1970, 2031)
+        smooth = np.stack([ np.full(years.size, 300.), # constant
+                            270. + (years - 1970.), # rising
+                            280. + np.clip(np.abs(years - 2000.), 0., 20.) ])
+        return_years, ref = o3plots.ProcessForTCO3Return.return_years(
+                                smooth, years)
+        np.testing.assert_array_equal(ref, [300., 280., 300.])
+        self.assertTrue(np.isnan(return_years[:2]).all())
+        self.assertEqual(return_years[2], 2020.)
+
+    def test_readers(self):
+        """
+        Test that the band means are the same from every reader, the
+        stored standard bands and the fields of a batch
+        """
+        bands = ["-90:-60", "-20:20"]
+        kwargs = { MODEL: self.models, BEGIN: 1970, END: 2000, MONTH: [10],
+                   LAT_MIN: -10, LAT_MAX: 10, BANDS: bands }
+        mode = cfg.netcdf_reader_conf['mode']
+        store = o3aggregates.store
+        store_dir = tempfile.mkdtemp()
+        results = {}
+        try:
+            for reader in ['netcdf4', 'stream', 'xarray']:
+                cfg.netcdf_reader_conf['mode'] = reader
+                data = o3plots.ProcessForTCO3Return(**kwargs)
+                results[reader] = data.get_band_means(self.models[0])
+            data = o3plots.ProcessForTCO3Return(shared_fields={}, **kwargs)
+            results['field'] = data.get_band_means(self.models[0])
+            cfg.aggregates_conf['enabled'] = True
+            o3aggregates.store = o3aggregates.AggregateStore(
+                                     store_dir, [(-90, -60), (-20, 20)])
+            with mock.patch.object(o3plots.DataSelection, 'read_slice',
+                                   side_effect=AssertionError) as read_slice:
+                data = o3plots.ProcessForTCO3Return(**kwargs)
+                results['stored'] = data.get_band_means(self.models[0])
+            read_slice.assert_not_called()
+        finally:
+            cfg.netcdf_reader_conf['mode'] = mode
+            o3aggregates.store = store
+            shutil.rmtree(store_dir)
+        means, time_axis = results.pop('netcdf4')
+        self.assertEqual(means.shape, (time_axis.size, len(bands)))
+        for reader, (other, other_time) in results.items():
+            np.testing.assert_array_equal(other_time, time_axis)
+            np.testing.assert_allclose(other, means, rtol=1e-6,
+                                       err_msg=reader)
+
+    def test_cached(self):
+        """
+        Test that the table is computed once for all requested models
+        """
+        kwargs = { MODEL: self.models, BEGIN: 1960, END: 2060, MONTH: [],
+                   LAT_MIN: 20, LAT_MAX: -20 }
+        data = o3plots.ProcessForTCO3Return(**kwargs)
+        self.assertEqual(data.bands, [(-20, 20)])
+        data.get_raw_data(self.models[0])
+        misses = o3plots.series_cache.misses
+        [ data.get_raw_data(m) for m in self.models ]
+        self.assertEqual(o3plots.series_cache.misses, misses)
+
+    def test_invalid_bands(self):
+        """
+        Test that malformed bands are rejected
+        """
+        kwargs = { BEGIN: 1960, END: 2060, MONTH: [], LAT_MIN: -10,
+                   LAT_MAX: 10, BANDS: ["-90"] }
+        with self.assertRaises(o3plots.InvalidRequest):
+            o3plots.ProcessForTCO3Return(**kwargs)
+
+
+if __name__ == '__main__':
+    unittest.main()
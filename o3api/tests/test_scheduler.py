@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Tests for the cost-aware request scheduler
+"""
+import threading
+import time
+import unittest
+from o3api import admission as o3admission
+from o3api import scheduler as o3scheduler
+
+
+class TestSchedulerMethods(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = o3scheduler.Scheduler(fast_slots=1, bulk_slots=1,
+                                               fast_max_cost=10.,
+                                               max_wait=0.2)
+
+    def _run_async(self, cost, identity, hold, order):
+        def _job():
+            with self.scheduler.run(cost, identity):
+                order.append(identity)
+                time.sleep(hold)
+        thread = threading.Thread(target=_job)
+        thread.start()
+        return thread
+
+    def test_classify(self):
+        """
+        Test that requests are classified by cost
+        """
+        self.assertEqual(self.scheduler.classify(5.), o3scheduler.FAST)
+        self.assertEqual(self.scheduler.classify(50.), o3scheduler.BULK)
+
+    def test_fast_not_blocked_by_bulk(self):
+        """
+        Test that a small request runs while a bulk request is processed
+        """
+        order = []
+        bulk = self._run_async(100., 'bulk-user', 0.5, order)
+        time.sleep(0.05)
+        time_start = time.time()
+        with self.scheduler.run(1., 'fast-user'):
+            waited = time.time() - time_start
+        bulk.join()
+        self.assertLess(waited, 0.2)
+
+    def test_fair_sharing(self):
+        """
+        Test that identities are served in turns inside a lane
+        """
+        order = []
+        blocker = self._run_async(100., 'blocker', 0.3, order)
+        time.sleep(0.05)
+        threads = []
+        for identity in ['a', 'a', 'a', 'b']:
+            threads.append(self._run_async(100., identity, 0., order))
+            time.sleep(0.02)
+        [ t.join() for t in [blocker] + threads ]
+        # 'b' is served right after the first 'a', not after all of them
+        self.assertEqual(order[:3], ['blocker', 'a', 'b'])
+
+    def test_starvation(self):
+        """
+        Test that a long waiting bulk request takes a free fast slot
+        """
+        order = []
+        blocker = self._run_async(100., 'blocker', 1., order)
+        time.sleep(0.05)
+        time_start = time.time()
+        with self.scheduler.run(100., 'starving'):
+            waited = time.time() - time_start
+        blocker.join()
+        self.assertLess(waited, 0.9)
+        self.assertEqual(self.scheduler.stats()['promoted'], 1)
+        self.assertEqual(self.scheduler.stats()[o3scheduler.BULK]['served'], 2)
+
+    def test_queue_timeout(self):
+        """
+        Test that a request waiting longer than max_queue_wait is rejected
+        """
+        self.scheduler.max_queue_wait = 0.2
+        self.scheduler.max_wait = 10. # no promotion to the fast lane
+        order = []
+        blocker = self._run_async(100., 'blocker', 0.6, order)
+        time.sleep(0.05)
+        with self.assertRaises(o3admission.Overloaded) as ctx:
+            with self.scheduler.run(100., 'late'):
+                pass
+        blocker.join()
+        self.assertEqual(ctx.exception.status, 503)
+        self.assertGreater(ctx.exception.retry_after, 0)
+        stats = self.scheduler.stats()
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats[o3scheduler.BULK]['queued'], 0)
+        # the lane is usable afterwards
+        with self.scheduler.run(100., 'late'):
+            pass
+
+    def test_last_served_pruned(self):
+        """
+        Test that the turns of identities are forgotten once nobody waits
+        """
+        for i in range(100):
+            with self.scheduler.run(1., 'user-{}'.format(i)):
+                pass
+        self.assertEqual(self.scheduler.stats()['identities'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
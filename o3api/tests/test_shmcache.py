@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Tests for the cache of model arrays shared between workers
+"""
+import numpy as np
+import shutil
+import tempfile
+import unittest
+from o3api import config as cfg
+from o3api import loadtest
+from o3api import plots as o3plots
+from o3api import shmcache as o3shmcache
+
+# configuration for API
+BEGIN = 'begin'
+END   = 'end'
+MONTH = 'month'
+LAT_MIN = 'lat_min'
+LAT_MAX = 'lat_max'
+
+
+class TestSharedArrayCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.array = np.arange(100, dtype=np.float64) # 800 bytes
+        self.cache = o3shmcache.SharedArrayCache(self.cache_dir,
+                                                 max_bytes=2000)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_put_get(self):
+        """
+        Test that arrays are stored and mapped read-only
+        """
+        arrays, meta = self.cache.put('a', {'values': self.array}, {'m': 1})
+        self.cache.release('a')
+        other = o3shmcache.SharedArrayCache(self.cache_dir, max_bytes=2000)
+        arrays, meta = other.get('a')
+        np.testing.assert_array_equal(arrays['values'], self.array)
+        self.assertFalse(arrays['values'].flags.writeable)
+        self.assertEqual(meta, {'m': 1})
+        other.release('a')
+
+    def test_lru_eviction(self):
+        """
+        Test that the least recently used unreferenced entry is evicted
+        and referenced entries are kept
+        """
+        self.cache.put('a', {'values': self.array}, {})
+        self.cache.put('b', {'values': self.array}, {})
+        self.cache.release('b')
+        # 'a' is still referenced, so 'b' is evicted
+        self.cache.put('c', {'values': self.array}, {})
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+        self.assertLessEqual(self.cache.stats()['bytes'], 2000)
+
+
+class TestSharedFieldProcessing(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.models = loadtest.make_synthetic_data(self.data_dir, models=1,
+                                                   begin=1975, end=1990)
+        self.base_path = cfg.O3AS_DATA_BASEPATH
+        cfg.O3AS_DATA_BASEPATH = self.data_dir
+        self.reader_mode = cfg.netcdf_reader_conf['mode']
+        self.shm_cache = o3shmcache.shm_cache
+        o3shmcache.shm_cache = o3shmcache.SharedArrayCache(self.cache_dir,
+                                                           2**24)
+
+    def tearDown(self):
+        cfg.O3AS_DATA_BASEPATH = self.base_path
+        cfg.shm_cache_conf['enabled'] = False
+        cfg.netcdf_reader_conf['mode'] = self.reader_mode
+        o3shmcache.shm_cache = self.shm_cache
+        shutil.rmtree(self.data_dir)
+        shutil.rmtree(self.cache_dir)
+
+    def test_same_as_xarray(self):
+        """
+        Test that series from the shared array equal the xarray ones
+        """
+        kwargs = { BEGIN: 1978, END: 1985, MONTH: [1, 10],
+                   LAT_MIN: -32, LAT_MAX: 47 }
+        model = self.models[0]
+        cfg.shm_cache_conf['enabled'] = False
+        cfg.netcdf_reader_conf['mode'] = 'xarray'
+        reference = o3plots.ProcessForTCO3(**kwargs)
+        expected = reference.get_raw_data(model)
+        expected_1980 = reference.get_ref1980(model)
+        o3plots.series_cache.put(reference._cache_key(model, 'raw'), None)
+
+        cfg.shm_cache_conf['enabled'] = True
+        # another band to avoid the series cache
+        kwargs[LAT_MAX] = 46
+        data = o3plots.ProcessForTCO3(**kwargs)
+        series = data.get_raw_data(model)
+        np.testing.assert_allclose(series.values, expected.values)
+        np.testing.assert_array_equal(series.index, expected.index)
+        self.assertAlmostEqual(data.get_ref1980(model), expected_1980)
+        self.assertEqual(o3shmcache.shm_cache.stats()['entries'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Tests for the smoothing of series
+"""
+import numpy as np
+import pandas as pd
+import unittest
+from o3api import smoothing as o3smoothing
+
+
+class TestSmoothing(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.values = rng.normal(300., 10., (4, 120))
+
+    def test_boxcar_as_before(self):
+        """
+        Test boxcar:3 against the former per-model scipy convolution
+        (end points kept) and the truncated edges of the return years
+        """
+        from scipy import signal
+        smooth = o3smoothing.smooth(self.values, 'boxcar:3')
+        for row, values in zip(smooth, self.values):
+            expected = signal.convolve(values, np.ones(3), mode='same')/3.
+            expected[0] = values[0]
+            expected[-1] = values[-1]
+            np.testing.assert_allclose(row, expected, rtol=1e-12)
+
+        truncated = o3smoothing.boxcar(self.values, 5, edges='truncate')
+        expected = pd.DataFrame(self.values.T).rolling(
+                       5, center=True, min_periods=1).mean().values.T
+        np.testing.assert_allclose(truncated, expected, rtol=1e-12)
+
+    def test_filters(self):
+        """
+        Test even windows, the 2x12 average and the exponential average
+        """
+        frame = pd.DataFrame(self.values.T)
+        inner = slice(6, -6) # full windows
+        np.testing.assert_allclose(
+            o3smoothing.smooth(self.values, 'boxcar:4')[:, inner],
+            frame.rolling(4, center=True).mean().values.T[:, inner],
+            rtol=1e-12)
+        expected = frame.rolling(12, center=True).mean().rolling(2).mean() \
+                        .shift(-1).values.T
+        np.testing.assert_allclose(
+            o3smoothing.smooth(self.values, 'centered:12')[:, inner],
+            expected[:, inner], rtol=1e-12)
+        times = np.arange("2000-01", "2010-01", dtype='datetime64[M]')
+        np.testing.assert_allclose(
+            o3smoothing.smooth(self.values, 'annual', times),
+            o3smoothing.smooth(self.values, 'centered:12'))
+        np.testing.assert_allclose(
+            o3smoothing.smooth(self.values, 'exp:0.2'),
+            frame.ewm(alpha=0.2, adjust=False).mean().values.T, rtol=1e-12)
+        np.testing.assert_array_equal(
+            o3smoothing.smooth(self.values, 'none'), self.values)
+
+    def test_nan_and_edges(self):
+        """
+        Test that NaNs are skipped and stay NaN, windows shrink
+        at the first and last valid point of every model
+        """
+        values = self.values.copy()
+        values[1, :10] = np.nan
+        values[1, 50] = np.nan
+        smooth = o3smoothing.smooth(values, 'centered:5')
+        self.assertTrue(np.isnan(smooth[1, :10]).all())
+        self.assertTrue(np.isnan(smooth[1, 50]))
+        self.assertEqual(smooth[1, 10], values[1, 10])
+        self.assertAlmostEqual(smooth[1, 11], values[1, 10:13].mean())
+        self.assertAlmostEqual(smooth[1, 49],
+                               np.nanmean(values[1, 47:52]))
+        np.testing.assert_allclose(smooth[[0, 2, 3]],
+            o3smoothing.smooth(self.values[[0, 2, 3]], 'centered:5'))
+
+        # series of different periods, mid-month and start of month
+        times_a = pd.date_range("1980-01-15", periods=36, freq='MS') + \
+                  pd.Timedelta(days=14)
+        times_b = pd.date_range("1981-01-01", periods=36, freq='MS')
+        a = pd.Series(self.values[0, :36], index=times_a, name='a')
+        b = pd.Series(self.values[1, 60:96].astype(np.float32),
+                      index=times_b, name='b')
+        smooth_a, smooth_b = o3smoothing.smooth_series([a, b], 'boxcar:3')
+        self.assertTrue(smooth_a.index.equals(a.index))
+        self.assertEqual(smooth_b.dtype, np.float32)
+        np.testing.assert_allclose(smooth_b.values,
+            o3smoothing.smooth(b.values[np.newaxis], 'boxcar:3')[0],
+            rtol=1e-6)
+
+    def test_parse(self):
+        """
+        Test the filter specifications
+        """
+        self.assertEqual(o3smoothing.parse(None), ('none', None))
+        self.assertEqual(o3smoothing.parse('boxcar'), ('boxcar', 3))
+        self.assertEqual(o3smoothing.parse('Centered:24'), ('centered', 24))
+        self.assertEqual(o3smoothing.parse('exp:0.5'), ('exp', 0.5))
+        for spec in ['gauss:3', 'boxcar:0', 'boxcar:x', 'exp:2',
+                     'annual:3']:
+            with self.assertRaises(o3smoothing.SmoothingError):
+                o3smoothing.parse(spec)
+
+
+if __name__ == '__main__':
+    unittest.main()
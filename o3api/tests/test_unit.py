@@ -14,12 +14,15 @@ import pandas as pd
 import pkg_resources
 import xarray as xr
 import pytest
-#import time
+import time
 import unittest
+from unittest import mock
+from o3api import admission as o3admission
 from o3api import api as o3api
 from o3api import config as cfg
 from o3api import plots as o3plots
 from o3api import plothelpers as phlp
+from o3api import warmup as o3warmup
 
 import flask
 import connexion
@@ -229,6 +232,49 @@ class TestPackageMethods(unittest.TestCase):
         #changed from xr.Dataset to pd.Series
         #self.assertTrue(type(ds) is xr.Dataset)
 
+    def test_estimate_cost(self):
+        """
+        Test the request cost: time points x latitude points
+        """
+        ptype = self.kwargs[PTYPE]
+        cost = o3admission.estimate_cost(ptype, self.kwargs[MODEL],
+                                         **self.kwargs)
+        self.assertEqual(cost, 24*3)
+        cost_pdf = o3admission.estimate_cost(ptype, self.kwargs[MODEL],
+                                             pdf=True, **self.kwargs)
+        self.assertEqual(cost_pdf, cost*cfg.admission_conf['pdf_factor'])
+
+    def test_warmup(self):
+        """
+        Test that the warm-up indexes models and precomputes series
+        """
+        o3warmup.run(precompute=True)
+        state = o3warmup.get_state()
+        self.assertEqual(state['status'], 'done')
+        self.assertEqual(state['progress'], 1.)
+        self.assertTrue(o3warmup.is_ready())
+
+        band = cfg.warmup_conf['bands'][0]
+        kwargs = {
+            BEGIN: cfg.warmup_conf['begin'],
+            END: cfg.warmup_conf['end'],
+            MONTH: [],
+            LAT_MIN: band[0],
+            LAT_MAX: band[1]
+        }
+        hits = o3plots.series_cache.hits
+        o3plots.ProcessForTCO3(**kwargs).get_raw_data(self.kwargs[MODEL][0])
+        self.assertEqual(o3plots.series_cache.hits, hits + 1)
+
+    def test_json_values(self):
+        """
+        Test that float32 values are rounded for JSON
+        """
+        values = np.array([300.12, np.float32(299.9)], dtype=np.float32)
+        self.assertEqual(o3api._to_json_values(values), [300.12, 299.9])
+        values = np.array([300.123456789])
+        self.assertEqual(o3api._to_json_values(values), [300.123456789])
+
     def test_get_date_range(self):
         """
         Test correctness of returned min/max dates
@@ -260,5 +306,63 @@ class TestPackageMethods(unittest.TestCase):
         self.assertEqual(self.plot_title, o3plot_title)
 
 
+class TestAdmissionMethods(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = o3admission.AdmissionController(
+                              identity_budget=100., identity_refill=10.,
+                              max_inflight_cost=150.)
+
+    def test_identity_budget(self):
+        """
+        Test that an identity is rejected (429) once its budget is used
+        """
+        self.controller.release(self.controller.admit('user-a', 80.))
+        with self.assertRaises(o3admission.QuotaExceeded) as ctx:
+            self.controller.admit('user-a', 80.)
+        self.assertEqual(ctx.exception.status, 429)
+        self.assertGreater(ctx.exception.retry_after, 0)
+        # other identities are not affected
+        self.controller.release(self.controller.admit('user-b', 80.))
+
+    def test_buckets_pruned(self):
+        """
+        Test that buckets refilled to the whole budget are dropped
+        """
+        now = time.time()
+        with mock.patch.object(o3admission.time, 'time', return_value=now):
+            for i in range(10):
+                self.controller.release(self.controller.admit(
+                                            'user-{}'.format(i), 50.))
+            self.assertEqual(self.controller.stats()['identities'], 10)
+        # one refill period (100/10 s) later: only the new identity
+        with mock.patch.object(o3admission.time, 'time',
+                               return_value=now + 10.):
+            self.controller.release(self.controller.admit('user-x', 50.))
+            self.assertEqual(self.controller.stats()['identities'], 1)
+            # a dropped identity has the whole budget again
+            self.controller.release(self.controller.admit('user-0', 100.))
+
+    def test_zero_refill(self):
+        """
+        Test that a budget without refill is rejected in the configuration
+        """
+        with self.assertRaises(ValueError):
+            o3admission.AdmissionController(identity_budget=100.,
+                                            identity_refill=0.,
+                                            max_inflight_cost=150.)
+
+    def test_inflight_limit(self):
+        """
+        Test that the global in-flight cost limit is enforced (503)
+        """
+        ticket = self.controller.admit('user-a', 100.)
+        with self.assertRaises(o3admission.Overloaded) as ctx:
+            self.controller.admit('user-b', 100.)
+        self.assertEqual(ctx.exception.status, 503)
+        self.controller.release(ticket)
+        self.controller.release(self.controller.admit('user-b', 100.))
+
+
 if __name__ == '__main__':
     unittest.main()
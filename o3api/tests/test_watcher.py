@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+"""
+Tests for the detection of changed data files
+"""
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import xarray as xr
+from o3api import catalog as o3catalog
+from o3api import config as cfg
+from o3api import fileaccess as o3fileaccess
+from o3api import plots as o3plots
+from o3api import pyramid as o3pyramid
+from o3api import watcher as o3watcher
+
+# configuration for netCDF
+TIME = 'time'
+LAT  = 'lat'
+TCO3 = 'tco3_zm'
+
+# configuration for API
+BEGIN = 'begin'
+END   = 'end'
+MONTH = 'month'
+LAT_MIN = 'lat_min'
+LAT_MAX = 'lat_max'
+
+
+class TestDataWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.pyramid_dir = tempfile.mkdtemp()
+        self.base_path = cfg.O3AS_DATA_BASEPATH
+        self.series_cache = o3plots.series_cache
+        self.pyramid = o3pyramid.pyramid
+        cfg.O3AS_DATA_BASEPATH = self.data_dir
+        o3plots.series_cache = o3plots.SeriesCache(
+                                   cfg.series_cache_conf['max_entries'])
+        o3pyramid.pyramid = o3pyramid.TilePyramid(self.pyramid_dir,
+                                                  tile_time=12, tile_lat=8)
+        self.watcher = o3watcher.DataWatcher(interval=0)
+        self.models = ['o3api-watch-a', 'o3api-watch-b']
+        for model in self.models:
+            self._write(model, 300.)
+        self.kwargs = { BEGIN: 1990, END: 1999, MONTH: [],
+                        LAT_MIN: -10, LAT_MAX: 10 }
+
+    def tearDown(self):
+        cfg.O3AS_DATA_BASEPATH = self.base_path
+        o3plots.series_cache = self.series_cache
+        o3pyramid.pyramid = self.pyramid
+        o3fileaccess.file_manager.close_all()
+        shutil.rmtree(self.data_dir)
+        shutil.rmtree(self.pyramid_dir)
+
+    def _write(self, model, value, years=10):
+        """Write (replace) the tco3_zm file of the model
+        """
+        lats = np.arange(-85., 90., 10.)
+        times = np.arange("1990-01", "{}-01".format(1990 + years),
+                          dtype='datetime64[M]').astype('datetime64[ns]')
+        ds = xr.Dataset({TCO3: ((LAT, TIME),
+                                np.full((lats.size, times.size), value))},
+                        coords={LAT: lats, TIME: times})
+        os.makedirs(os.path.join(self.data_dir, model), exist_ok=True)
+        path = os.path.join(self.data_dir, model, TCO3 + ".nc")
+        ds.to_netcdf(path + ".new")
+        os.replace(path + ".new", path)
+
+    def _series(self, model):
+        return o3plots.ProcessForTCO3(**self.kwargs).get_raw_data(model)
+
+    def _models(self, report, kind):
+        return [ item['model'] for item in report[kind] ]
+
+    def test_changed_model(self):
+        """
+        Test that only the changed model is refreshed
+        """
+        self.watcher.scan()
+        for model in self.models:
+            self.assertEqual(self._series(model).iloc[0], 300.)
+            o3pyramid.pyramid.get_tile(model, TCO3, 'annual', '10', 0, 0)
+        # newer runs of model a, one more year
+        time.sleep(0.01)
+        self._write(self.models[0], 310., years=11)
+
+        report = self.watcher.scan()
+        print(F"[WATCHER] report: {report}")
+        self.assertEqual(self._models(report, 'changed'), [self.models[0]])
+        self.assertEqual(report['added'], [])
+        self.assertEqual(report['removed'], [])
+        self.assertEqual(report['refreshed']['catalog'], 1)
+        self.assertEqual(report['refreshed']['series_cache'], 1)
+        self.assertEqual(report['refreshed']['pyramid'], 1)
+        # the series of model b is still cached, model a is read again
+        misses = o3plots.series_cache.misses
+        self.assertEqual(self._series(self.models[1]).iloc[0], 300.)
+        self.assertEqual(o3plots.series_cache.misses, misses)
+        self.assertEqual(self._series(self.models[0]).iloc[0], 310.)
+        entry = o3catalog.catalog.get_entry(self.models[0], TCO3)
+        self.assertEqual(entry.axes[0][-1], 2000)
+
+        # nothing changed since
+        report = self.watcher.scan()
+        self.assertEqual(report['changed'], [])
+        self.assertEqual(report['refreshed']['series_cache'], 0)
+
+    def test_added_removed_model(self):
+        """
+        Test that added and removed models are reported
+        """
+        self.watcher.scan()
+        self._series(self.models[1])
+        self._write('o3api-watch-c', 320.)
+        shutil.rmtree(os.path.join(self.data_dir, self.models[1]))
+
+        report = self.watcher.scan()
+        print(F"[WATCHER] report: {report}")
+        self.assertEqual(self._models(report, 'added'), ['o3api-watch-c'])
+        self.assertEqual(self._models(report, 'removed'), [self.models[1]])
+        self.assertEqual(report['refreshed']['series_cache'], 1)
+        self.assertEqual(o3catalog.catalog.get_datafiles(self.models[1],
+                                                         TCO3), [])
+        self.assertEqual(self._series('o3api-watch-c').iloc[0], 320.)
+
+    def test_first_scan(self):
+        """
+        Test that the first scan compares with the catalog entries
+        """
+        self._series(self.models[0])
+        time.sleep(0.01)
+        self._write(self.models[0], 310.)
+        report = self.watcher.scan()
+        self.assertEqual(self._models(report, 'changed'), [self.models[0]])
+        self.assertEqual(report['added'], [])
+        self.assertEqual(self._series(self.models[0]).iloc[0], 310.)
+
+
+if __name__ == '__main__':
+    unittest.main()
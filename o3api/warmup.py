@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Warm-up of the service: scan the catalog, read the coordinate axes of
+# every model and, optionally, precompute series for standard requests.
+# Run with mode 'sync' under gunicorn --preload, the master process builds
+# everything before the workers fork, so the memory is shared copy-on-write.
+# The progress is reported by /healthz and /readyz (see o3api/__init__.py).
+
+import gc
+import logging
+import o3api.catalog as o3catalog
+import o3api.config as cfg
+import o3api.fileaccess as o3fileaccess
+import o3api.plots as o3plots
+import threading
+import time
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+# configuration for netCDF
+TCO3 = cfg.netCDF_conf['tco3']
+PLOT_TYPES = [cfg.netCDF_conf['tco3'],
+              cfg.netCDF_conf['vmro3'],
+              cfg.netCDF_conf['tco3_r']]
+
+# configuration for API
+api_c = cfg.api_conf
+
+# configuration for warm-up
+warmup_c = cfg.warmup_conf
+
+# warm-up progress
+state = {
+    'status': 'off',  # off, pending, running, done, failed
+    'total': 0,
+    'done': 0,
+    'started': None,
+    'finished': None,
+    'errors': []
+}
+_lock = threading.Lock()
+
+
+def _update(**kwargs):
+    with _lock:
+        state.update(kwargs)
+
+
+def get_state():
+    """Return a copy of the warm-up progress
+
+    :rtype: dict
+    """
+    with _lock:
+        progress = dict(state, errors=list(state['errors']))
+    progress['progress'] = (round(progress['done']/progress['total'], 3)
+                            if progress['total'] else 0.)
+    return progress
+
+
+def is_ready():
+    """Whether the service is ready to serve requests:
+    warm-up is disabled or has finished (also with errors)
+
+    :rtype: bool
+    """
+    with _lock:
+        return state['status'] in ['off', 'done', 'failed']
+
+
+def _precompute(model):
+    """Precompute series for the standard requests of the model
+    """
+    for lat_min, lat_max in warmup_c['bands']:
+        kwargs = {
+            api_c['begin']: warmup_c['begin'],
+            api_c['end']: warmup_c['end'],
+            api_c['month']: [],
+            api_c['lat_min']: lat_min,
+            api_c['lat_max']: lat_max
+        }
+        data = o3plots.ProcessForTCO3(**kwargs)
+        data.get_raw_data(model)
+        data.get_ref1980(model)
+
+
+def run(precompute=None):
+    """Run the warm-up
+
+    :param precompute: Precompute standard series,
+                       default from warmup_conf['precompute']
+    """
+    precompute = warmup_c['precompute'] if precompute is None else precompute
+    time_start = time.time()
+    _update(status='running', started=time_start, done=0, errors=[])
+    try:
+        models = o3catalog.catalog.list_models()
+    except OSError as e:
+        logger.error("[WARMUP] Failed to scan the catalog: {}".format(e))
+        _update(status='failed', finished=time.time(), errors=[str(e)])
+        return
+
+    _update(total=len(models))
+    errors = []
+    for model in models:
+        try:
+            for plot_type in PLOT_TYPES:
+                entry = o3catalog.catalog.get_entry(model, plot_type)
+                if entry.files:
+                    entry.axes # read the coordinate axes
+            if precompute and o3catalog.catalog.get_datafiles(model, TCO3):
+                _precompute(model)
+        except Exception as e:
+            logger.warning("[WARMUP] {} failed: {}".format(model, e))
+            errors.append("{}: {}".format(model, e))
+        with _lock:
+            state['done'] += 1
+
+    _update(status='failed' if errors else 'done',
+            finished=time.time(), errors=errors)
+    logger.info("[WARMUP] {} models in {:.1f}s, errors: {}".format(
+                len(models), time.time() - time_start, len(errors)))
+
+
+def start(mode=None):
+    """Start the warm-up according to the mode
+
+    :param mode: 'off', 'sync' or 'background',
+                 default from warmup_conf['mode']
+    """
+    mode = warmup_c['mode'] if mode is None else mode
+    if mode == 'sync':
+        run()
+        # handles must not be shared with forked workers
+        o3fileaccess.file_manager.close_all()
+        # keep objects created during the warm-up out of the garbage
+        # collector, otherwise it touches (and copies) the shared pages
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+    elif mode == 'background':
+        _update(status='pending')
+        threading.Thread(target=run, name='o3api-warmup', daemon=True).start()
+    elif mode != 'off':
+        logger.warning("[WARMUP] Unknown mode '{}', skipping".format(mode))
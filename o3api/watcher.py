@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017 - 2020 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+#
+# Detection of changed data: O3AS_DATA_BASEPATH is scanned periodically
+# (file names, mtime and size per model and plot type, no data is read)
+# and compared with the previous scan. For every added, changed or removed
+# model only its state is refreshed: catalog entry and coordinates, open
+# file handles, local file copies, cached and stored results, shared-memory
+# arrays, tile pyramids and stored band means. A scan can also be triggered
+# by /api/rescan, e.g. right after new model runs are copied. Every worker
+# process scans for itself, as most of the caches are per process.
+
+import logging
+import o3api.aggregates as o3aggregates
+import o3api.catalog as o3catalog
+import o3api.config as cfg
+import o3api.fileaccess as o3fileaccess
+import o3api.filecache as o3filecache
+import o3api.plots as o3plots
+import o3api.pyramid as o3pyramid
+import o3api.resultstore as o3resultstore
+import o3api.shmcache as o3shmcache
+import os
+import threading
+import time
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+# configuration for netCDF
+PLOT_TYPES = [cfg.netCDF_conf['tco3'],
+              cfg.netCDF_conf['vmro3'],
+              cfg.netCDF_conf['tco3_r']]
+
+REFRESHED = ['catalog', 'file_handles', 'file_cache', 'series_cache',
+             'result_store', 'shm_cache', 'pyramid', 'aggregates']
+
+
+def _refers(key, fingerprint):
+    """Whether the cache key contains the data fingerprint
+    (also nested, e.g. keys of several models)
+    """
+    if key == fingerprint:
+        return True
+    return isinstance(key, tuple) and any(_refers(k, fingerprint)
+                                          for k in key)
+
+
+class DataWatcher:
+    """Scan of the data files, refreshing the state of changed models
+
+    :param interval: Seconds between periodic scans, 0 to disable them
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self._snapshot = {} # base path -> {(model, plot_type): fingerprint}
+        self._thread = None
+        self._stop = threading.Event()
+        self.scans = 0
+        self.changes = 0
+        self.errors = 0
+        self.last_scan = None
+
+    @staticmethod
+    def _current():
+        """Fingerprints of the models and plot types having files
+
+        :return: {(model, plot_type): fingerprint}
+        """
+        current = {}
+        for model in o3catalog.catalog.list_models():
+            for plot_type in PLOT_TYPES:
+                files, fingerprint = o3catalog.Catalog.find_files(model,
+                                                                  plot_type)
+                if files:
+                    current[(model, plot_type)] = fingerprint
+        return current
+
+    def _refresh(self, model, plot_type, old_fingerprint):
+        """Drop the state of the model for its old files
+
+        :return: number of dropped items per component
+        :rtype: dict
+        """
+        counts = dict.fromkeys(REFRESHED, 0)
+        old_files = [ f[0] for f in old_fingerprint ]
+        old = o3catalog.catalog.invalidate(model, plot_type)
+        if old is not None:
+            counts['catalog'] += 1
+            old_files = sorted(set(old_files) | set(old.files))
+        counts['file_handles'] = o3fileaccess.file_manager.discard(old_files)
+        if cfg.file_cache_conf['enabled']:
+            counts['file_cache'] = len([ f for f in old_files
+                                         if o3filecache.file_cache.discard(f) ])
+        if old_fingerprint: # an empty one is in many keys, e.g. no months
+            counts['series_cache'] = o3plots.series_cache.discard(
+                lambda key: _refers(key, old_fingerprint))
+            if cfg.result_store_conf['enabled']:
+                counts['result_store'] = \
+                    o3resultstore.result_store.discard(old_fingerprint)
+        if cfg.shm_cache_conf['enabled']:
+            counts['shm_cache'] = o3shmcache.shm_cache.discard(model,
+                                                               plot_type)
+        entry = o3catalog.catalog.get_entry(model, plot_type)
+        if entry.files:
+            entry.axes # read the coordinate axes
+        counts['pyramid'] = o3pyramid.pyramid.discard(entry)
+        if cfg.aggregates_conf['enabled']:
+            counts['aggregates'] = o3aggregates.store.discard(entry)
+        return counts
+
+    def scan(self):
+        """Compare the data files with the previous scan and refresh
+        the added, changed and removed models. The first scan compares
+        with the catalog entries built so far.
+
+        :return: changed models and the number of refreshed items
+        :rtype: dict
+        """
+        time_start = time.time()
+        with self._scan_lock:
+            base_path = cfg.O3AS_DATA_BASEPATH
+            current = self._current()
+            snapshot = self._snapshot.get(base_path)
+            previous = { (e.model, e.plot_type): e.fingerprint
+                         for e in o3catalog.catalog.list_entries()
+                         if e.files }
+            previous.update(snapshot or {})
+
+            report = { 'scanned': len(current),
+                       'added': [], 'changed': [], 'removed': [],
+                       'refreshed': dict.fromkeys(REFRESHED, 0),
+                       'errors': [] }
+            for key in sorted(set(current) | set(previous)):
+                if key not in previous:
+                    if snapshot is None:
+                        continue # not seen before the first scan
+                    kind = 'added'
+                elif key not in current:
+                    kind = 'removed'
+                elif current[key] != previous[key]:
+                    kind = 'changed'
+                else:
+                    continue
+                model, plot_type = key
+                report[kind].append({ 'model': model,
+                                      'plot_type': plot_type })
+                try:
+                    counts = self._refresh(model, plot_type,
+                                           previous.get(key, ()))
+                except Exception as e:
+                    logger.warning("[WATCHER] refresh of {} {} failed: {}"
+                                   .format(model, plot_type, e))
+                    report['errors'].append("{} {}: {}".format(model,
+                                                               plot_type, e))
+                    continue
+                for component, n in counts.items():
+                    report['refreshed'][component] += n
+            self._snapshot[base_path] = current
+
+        n_changes = sum(len(report[k]) for k in ['added', 'changed',
+                                                 'removed'])
+        report['duration'] = round(time.time() - time_start, 4)
+        with self._lock:
+            self.scans += 1
+            self.changes += n_changes
+            self.errors += len(report['errors'])
+            self.last_scan = time_start
+        if n_changes:
+            logger.info("[WATCHER] added: {}, changed: {}, removed: {}"
+                        .format(len(report['added']), len(report['changed']),
+                                len(report['removed'])))
+        return report
+
+    def _run(self, stop):
+        while not stop.wait(self.interval):
+            try:
+                self.scan()
+            except Exception as e:
+                logger.warning("[WATCHER] scan failed: {}".format(e))
+                with self._lock:
+                    self.errors += 1
+
+    def start(self):
+        """Start the periodic scan in a background thread (if enabled)
+        """
+        if self.interval <= 0:
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run,
+                                            args=(self._stop,),
+                                            name='o3api-watcher',
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the periodic scan
+        """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+            self._stop.set()
+        if thread is not None:
+            thread.join()
+
+    def _after_fork(self):
+        """Restart the periodic scan in a forked worker,
+        threads do not survive fork (e.g. gunicorn --preload)
+        """
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        if self._thread is not None:
+            self._thread = None
+            self.start()
+
+    def stats(self):
+        """Return scan counters of this process
+
+        :rtype: dict
+        """
+        with self._lock:
+            return { 'interval': self.interval,
+                     'running': (self._thread is not None and
+                                 self._thread.is_alive()),
+                     'scans': self.scans,
+                     'changes': self.changes,
+                     'errors': self.errors,
+                     'last_scan': self.last_scan }
+
+
+watcher = DataWatcher(cfg.watcher_conf['interval'])
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=watcher._after_fork)
@@ -16,14 +16,30 @@ if [[ -z "${O3API_WORKERS}" ]]; then
     export O3API_WORKERS=1
 fi
 
+# threads per worker, with O3API_THREADS > 1 requests are scheduled
+# on fast and bulk lanes inside every worker (see o3api/scheduler.py)
+if [[ -z "${O3API_THREADS}" ]]; then
+    export O3API_THREADS=1
+fi
+
+# load the application (and run the warm-up) before forking workers,
+# so that workers share the warmed caches
+if [ "${O3API_PRELOAD}" == "True" ]; then
+    export O3API_WARMUP=${O3API_WARMUP:-sync}
+    O3API_PRELOAD_OPT="--preload"
+else
+    export O3API_WARMUP=${O3API_WARMUP:-background}
+    O3API_PRELOAD_OPT=""
+fi
+
 if [ "${ENABLE_HTTPS}" == "True" ]; then
   if test -e /certs/cert.pem && test -f /certs/key.pem ; then
-    exec gunicorn --bind $O3API_LISTEN_IP:$O3API_PORT -w "$O3API_WORKERS" \
-    --certfile /certs/cert.pem --keyfile /certs/key.pem --timeout "$O3API_TIMEOUT"  o3api:app
+    exec gunicorn --bind $O3API_LISTEN_IP:$O3API_PORT -w "$O3API_WORKERS" --threads "$O3API_THREADS" $O3API_PRELOAD_OPT \
+    --certfile /certs/cert.pem --keyfile /certs/key.pem --timeout "$O3API_TIMEOUT"  'o3api:create_app()'
   else
     echo "[ERROR] File /certs/cert.pem or /certs/key.pem NOT FOUND!"
     exit 1
   fi
 else
-  exec gunicorn --bind $O3API_LISTEN_IP:$O3API_PORT -w "$O3API_WORKERS" --timeout "$O3API_TIMEOUT"  o3api:app
+  exec gunicorn --bind $O3API_LISTEN_IP:$O3API_PORT -w "$O3API_WORKERS" --threads "$O3API_THREADS" $O3API_PRELOAD_OPT --timeout "$O3API_TIMEOUT"  'o3api:create_app()'
 fi